@@ -0,0 +1,115 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Stage read only reference data (the atlas, the BCD model files) into an
+experiment cache directory without copying it.
+
+Each file is hard linked into the staged directory, or symbolically linked
+when the staged directory is on another file system.  A manifest of
+(relative_path,size,mtime,sha1) is written next to the staged files, and
+later runs only compare the manifest with a stat of the source files.
+Templated files such as ExtendedAtlasDefinition.xml.in are excluded, and
+regenerated by the caller when StageDirectory() reports a change.
+"""
+import csv
+import errno
+import os
+
+from FastContentHash import SHA1DigestFile
+
+MANIFEST_FILE_NAME = 'StagingManifest.csv'
+MANIFEST_FIELDS = ['relative_path','size','mtime','sha1']
+
+def _local_listFiles(sourceDir, fileNames, excludeNames):
+    """ The relative paths of the files to stage from sourceDir """
+    if fileNames is not None:
+        return sorted(fileNames)
+    relativePaths=list()
+    for dirPath,dirNames,dirFileNames in os.walk(sourceDir):
+        for fileName in dirFileNames:
+            if fileName in excludeNames:
+                continue
+            relativePaths.append(os.path.relpath(os.path.join(dirPath,fileName),sourceDir))
+    return sorted(relativePaths)
+
+def _local_linkFile(source, destination):
+    """ Hard link source to destination, or symbolic link it across file systems """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source,destination)
+    except OSError, err:
+        if err.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK):
+            raise
+        os.symlink(os.path.realpath(source),destination)
+
+def ReadManifest(stagedDir):
+    """ Returns {relative_path: row} of the manifest in stagedDir, empty when there is none """
+    manifestFile=os.path.join(stagedDir,MANIFEST_FILE_NAME)
+    if not os.path.exists(manifestFile):
+        return dict()
+    manifest=dict()
+    for row in csv.DictReader(open(manifestFile,'rb')):
+        manifest[row['relative_path']]=row
+    return manifest
+
+def ManifestIsCurrent(sourceDir, stagedDir, fileNames=None, excludeNames=()):
+    """ True when every source file still has the size and mtime recorded when it was staged """
+    manifest=ReadManifest(stagedDir)
+    relativePaths=_local_listFiles(sourceDir,fileNames,excludeNames)
+    if len(manifest) == 0 or set(manifest.keys()) != set(relativePaths):
+        return False
+    for relativePath in relativePaths:
+        row=manifest[relativePath]
+        try:
+            st=os.stat(os.path.join(sourceDir,relativePath))
+        except OSError:
+            return False
+        if int(row['size']) != st.st_size or repr(st.st_mtime) != row['mtime']:
+            return False
+        if not os.path.lexists(os.path.join(stagedDir,relativePath)):
+            return False
+    return True
+
+def StageDirectory(sourceDir, stagedDir, fileNames=None, excludeNames=()):
+    """
+    Link the files of sourceDir (all of them, or only fileNames) into stagedDir
+    and write its manifest.  Returns False when the manifest showed that the
+    staged directory was already current, True when it was (re)staged.
+    """
+    if ManifestIsCurrent(sourceDir,stagedDir,fileNames,excludeNames):
+        return False
+    print("Staging links to {0}\n    in: {1}".format(sourceDir,stagedDir))
+    oldManifest=ReadManifest(stagedDir)
+    manifestRows=list()
+    for relativePath in _local_listFiles(sourceDir,fileNames,excludeNames):
+        source=os.path.join(sourceDir,relativePath)
+        destination=os.path.join(stagedDir,relativePath)
+        if not os.path.exists(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        st=os.stat(source)
+        _local_linkFile(source,destination)
+        oldRow=oldManifest.get(relativePath)
+        if oldRow is not None and int(oldRow['size']) == st.st_size and oldRow['mtime'] == repr(st.st_mtime):
+            digest=oldRow['sha1']
+        else:
+            digest=SHA1DigestFile(source)
+        manifestRows.append(dict(relative_path=relativePath,size=st.st_size,mtime=repr(st.st_mtime),sha1=digest))
+    if not os.path.exists(stagedDir):
+        os.makedirs(stagedDir)
+    manifestFile=open(os.path.join(stagedDir,MANIFEST_FILE_NAME),'wb')
+    writer=csv.DictWriter(manifestFile,MANIFEST_FIELDS)
+    writer.writerow(dict(zip(MANIFEST_FIELDS,MANIFEST_FIELDS)))
+    writer.writerows(manifestRows)
+    manifestFile.close()
+    return True
@@ -311,6 +311,7 @@ class ANTSInputSpec(CommandLineInputSpec):
     regularization_gradient_field_sigma = traits.Float(requires=['regularization'], desc='')
     regularization_deformation_field_sigma = traits.Float(requires=['regularization'], desc='')
     number_of_affine_iterations = traits.List(traits.Int(), argstr='--number-of-affine-iterations %s', sep='x')
+    initial_affine = File(exists=True, argstr='--initial-affine %s', desc='use the input file as the initial affine parameter')
 
     # fixed_image_mask = File(exists=True, argstr='--mask-image %s', desc="this mask -- defined in the 'fixed' image space defines the region of interest over which the registration is computed ==> above 0.1 means inside mask ==> continuous values in range [0.1,1.0] effect optimization like a probability. ==> values > 1 are treated as = 1.0")
     # moving_image_mask = File(exists=True, argstr='--mask-image %s', desc="this mask -- defined in the 'moving' image space defines the region of interest over which the registration is computed ==> above 0.1 means inside mask ==> continuous values in range [0.1,1.0] effect optimization like a probability. ==> values > 1 are treated as = 1.0")
@@ -12,10 +12,10 @@
 #################################################################################
 
 ### USE ANTS
-#from BRAINSTools.BTants.buildtemplateparallel import antsSimpleAverageWF, BRAINSTools.BTants.antsTemplateBuildSingleIterationWF
+from BRAINSTools.BTants.buildtemplateparallel import ANTSTemplateBuildAdaptiveWF
 ### USE ANTS REGISTRATION
 from BRAINSTools.BTants.antsSimpleAverageWF import antsSimpleAverageWF
-from BRAINSTools.BTants.buildtemplateparallel_antsRegistration import antsTemplateBuildSingleIterationWF
+#from BRAINSTools.BTants.buildtemplateparallel_antsRegistration import antsTemplateBuildSingleIterationWF
 import nipype.pipeline.engine as pe
 import argparse
 import nipype.interfaces.utility as util
@@ -59,14 +59,11 @@ def BuildTemplateParallelWorkFlow(ExperimentBaseDirectoryCache, ExperimentBaseDi
     infosource.inputs.images = image_list
 
     myInitAvgWF = antsSimpleAverageWF()
-    myMainWF = antsTemplateBuildSingleIterationWF()
+    ## Iterates until successive templates agree, instead of a fixed myMainWF and secondRun.
+    myMainWF = ANTSTemplateBuildAdaptiveWF('')
 
     btp.connect(infosource, 'images', myInitAvgWF, 'InputSpec.images')
     btp.connect(infosource, 'images', myMainWF, 'InputSpec.images')
     btp.connect(myInitAvgWF, 'OutputSpec.average_image', myMainWF, 'InputSpec.fixed_image')
 
-    secondRun = myMainWF.clone(name='secondRun')
-    btp.connect(infosource, 'images', secondRun, 'InputSpec.images')
-    btp.connect(myMainWF, 'OutputSpec.template', secondRun, 'InputSpec.fixed_image')
-
     return btp
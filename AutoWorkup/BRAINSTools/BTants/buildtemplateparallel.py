@@ -12,6 +12,7 @@
 
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
+from nipype.interfaces.base import InterfaceResult, isdefined
 from nipype.interfaces.io import DataGrabber
 from nipype.interfaces.utility import Merge, Split, Function, Rename, IdentityInterface
 
@@ -22,10 +23,62 @@ from BRAINSTools.BTants.antsAverageImages import *
 from BRAINSTools.BTants.antsAverageAffineTransform import *
 from BRAINSTools.BTants.antsMultiplyImages import *
 
+import ResourceProfiles
+import LightweightNodes
+import RegistrationCache
+
+## Successive templates whose normalized cross correlation reaches this are considered converged.
+TEMPLATE_CONVERGENCE_NCC = 0.995
+## The most template iterations ANTSTemplateBuildAdaptiveWF builds.
+TEMPLATE_MAX_ITERATIONS = 4
+## A warm started BeginANTS begins at the affine of the previous iteration, so its coarse levels
+## get a smaller budget than the 50x35x15 SyN and 10000 iteration affine levels of a cold start.
+WARM_START_NUMBER_OF_ITERATIONS = [15, 35, 15]
+WARM_START_NUMBER_OF_AFFINE_ITERATIONS = [1000,1000,1000,10000,10000]
+
+class GatedMapNode(pe.MapNode):
+    """
+    A MapNode that runs no subnodes when none of its iterfields are defined.  The iterfields of a MapNode
+    are InputMultiPath traits, which store the empty list GateConvergedIteration hands a converged
+    iteration as Undefined, and a plain MapNode refuses to run with an undefined iterfield.
+    """
+    def _local_isGated(self):
+        return not any([ isdefined(getattr(self.inputs,field)) for field in self.iterfield ])
+
+    def _check_iterfield(self):
+        if not self._local_isGated():
+            super(GatedMapNode,self)._check_iterfield()
+
+    def num_subnodes(self):
+        if not self._got_inputs:
+            self._get_inputs()
+            self._got_inputs = True
+        if self._local_isGated():
+            return 0
+        return super(GatedMapNode,self).num_subnodes()
+
+    def write_report(self, report_type=None, cwd=None):
+        if self._local_isGated():
+            ## The MapNode report lists the subnodes, and there are none.
+            return pe.Node.write_report(self,report_type=report_type,cwd=cwd)
+        return super(GatedMapNode,self).write_report(report_type=report_type,cwd=cwd)
+
+    def _run_interface(self, execute=True, updatehash=False):
+        if not self._local_isGated():
+            return super(GatedMapNode,self)._run_interface(execute=execute,updatehash=updatehash)
+        if execute:
+            self._result = InterfaceResult(interface=[], runtime=[], outputs=self.outputs)
+            self._save_results(self._result,self.output_dir())
+        else:
+            self._result = self._load_results(self.output_dir())
+
+class GatedRegistrationCacheMapNode(RegistrationCache.RegistrationCacheMapNode,GatedMapNode):
+    """ What EnableRegistrationCache converts a GatedMapNode to, a gated iteration still runs no subnodes """
+RegistrationCache.REGISTRATION_CACHE_MAPNODE_CLASSES[GatedMapNode]=GatedRegistrationCacheMapNode
+
 ## Flatten and return equal length transform and images lists.
 def FlattenTransformAndImagesList(ListOfPassiveImagesDictionararies,transformation_series):
     import sys
-    print("HACK:  DEBUG: ListOfPassiveImagesDictionararies\n{lpi}\n".format(lpi=ListOfPassiveImagesDictionararies))
     subjCount=len(ListOfPassiveImagesDictionararies)
     tranCount=len(transformation_series)
     if subjCount != tranCount:
@@ -34,32 +87,186 @@ def FlattenTransformAndImagesList(ListOfPassiveImagesDictionararies,transformati
     flattened_images=list()
     flattened_image_nametypes=list()
     flattened_transforms=list()
-    passiveImagesCount = len(ListOfPassiveImagesDictionararies[0])
     for subjIndex in range(0,subjCount):
-        #if passiveImagesCount != len(ListOfPassiveImagesDictionararies[subjIndex]):
-        #    print "ERROR:  all image lengths must be equal {0} != {1}".format(passiveImagesCount,len(ListOfPassiveImagesDictionararies[subjIndex]))
-        #    sys.exit(-1)
         subjImgDictionary=ListOfPassiveImagesDictionararies[subjIndex]
         subjToAtlasTransform=transformation_series[subjIndex]
         for imgname,img in subjImgDictionary.items():
             flattened_images.append(img)
             flattened_image_nametypes.append(imgname)
             flattened_transforms.append(subjToAtlasTransform)
-    print("HACK: flattened images    {0}\n".format(flattened_images))
-    print("HACK: flattened nametypes {0}\n".format(flattened_image_nametypes))
-    print("HACK: flattened txfms     {0}\n".format(flattened_transforms))
     return flattened_images,flattened_transforms,flattened_image_nametypes
+
+## One job for the template update of an iteration, replacing the AverageImages, AverageAffineTransform,
+## MultiplyImages and WarpImageMultiTransform chain of buildtemplateparallel.sh.  The outputs keep the names
+## of that chain.  A converged iteration registers no images, so its lists are undefined and it returns None
+## for IterationResult to discard.
+def FusedTemplateUpdate(iterationPhasePrefix,gradientStep,deformedImages=(),warpTransforms=(),affineTransforms=(),
+                        deformedPassiveImages=(),passiveImageNametypes=()):
+    import os
+    import subprocess
+    import numpy as np
+    import SimpleITK as sitk
+    if len(deformedImages) == 0:
+        return None,None
+    ## Each input is read once, one at a time, and summed into a memory mapped float64
+    ## accumulator in the node directory, so neither the number of subjects nor the number
+    ## of passive image types changes how much memory the job holds.
+    references=dict()
+    sums=dict()
+    counts=dict()
+    def Accumulate(key,fileName,normalize):
+        image=sitk.ReadImage(fileName)
+        values=sitk.GetArrayFromImage(image).astype(np.float64)
+        if normalize:
+            ## As AverageImages with normalize 1, every image is divided by its mean.
+            meanValue=values.mean()
+            if meanValue != 0:
+                values/=meanValue
+        if key not in sums:
+            references[key]=image
+            sums[key]=np.memmap(os.path.abspath(key+'.accumulator'),dtype=np.float64,mode='w+',shape=values.shape)
+            counts[key]=0
+        sums[key]+=values
+        counts[key]+=1
+    def WriteMean(key,outputName,scale=1.0):
+        meanValues=sums[key]*(scale/counts[key])
+        isVector=references[key].GetNumberOfComponentsPerPixel() > 1
+        meanImage=sitk.GetImageFromArray(meanValues.astype(np.float32),isVector)
+        meanImage.CopyInformation(references[key])
+        sitk.WriteImage(meanImage,os.path.abspath(outputName))
+        del sums[key]
+        os.remove(os.path.abspath(key+'.accumulator'))
+        return os.path.abspath(outputName)
+    def WarpImage(movingImage,referenceImage,postfix,transformList):
+        ## The file naming of the nipype WarpImageMultiTransform interface.
+        baseName=os.path.basename(movingImage)
+        for extension in ('.nii.gz','.nii'):
+            if baseName.endswith(extension):
+                break
+        outputImage=os.path.abspath(baseName[:-len(extension)]+postfix+extension)
+        subprocess.check_call(['WarpImageMultiTransform','3',movingImage,outputImage,'-R',referenceImage]+transformList)
+        return outputImage
+
+    for fileName in deformedImages:
+        Accumulate('TEMPLATE',fileName,True)
+    ## The warps are averaged without normalization, as with 'AverageImages 3 warp.nii.gz 0' in
+    ## buildtemplateparallel.sh.  The AvgWarpImages node this replaces passed normalize 1, but a normalized
+    ## displacement field no longer has the length that gradientStep is meant to scale.
+    for fileName in warpTransforms:
+        Accumulate('WARP',fileName,False)
+    for fileName,imageType in zip(deformedPassiveImages,passiveImageNametypes):
+        Accumulate('PASSIVE_'+imageType,fileName,False)
+    ## The passive templates are in sorted type order, as SingleImageTemplate emits them.
+    passiveTypes=sorted(set(passiveImageNametypes))
+
+    averageAffineTransform=os.path.abspath(iterationPhasePrefix+'Affine.mat')
+    subprocess.check_call(['AverageAffineTransform','3',averageAffineTransform]+list(affineTransforms))
+    averageTemplate=WriteMean('TEMPLATE',iterationPhasePrefix+'.nii.gz')
+    gradientStepWarp=WriteMean('WARP',iterationPhasePrefix+'warp.nii.gz',-1.0*gradientStep)
+    ## The shape update is the gradient step warp taken through the inverse average affine,
+    ## applied after the inverse average affine four times, as buildtemplateparallel.sh does.
+    shapeUpdateWarp=WarpImage(gradientStepWarp,averageTemplate,'_wimt',['-i',averageAffineTransform])
+    shapeUpdateTransforms=['-i',averageAffineTransform]+[shapeUpdateWarp]*4
+    template=WarpImage(averageTemplate,averageTemplate,'_Reshaped',shapeUpdateTransforms)
+    passive_deformed_templates=list()
+    for imageType in passiveTypes:
+        averagePassive=WriteMean('PASSIVE_'+imageType,'AVG_'+imageType+'.nii.gz')
+        passive_deformed_templates.append(WarpImage(averagePassive,averagePassive,'WARP_AVG_'+imageType,shapeUpdateTransforms))
+    return template,passive_deformed_templates
+
+## The normalized cross correlation of two successive templates, and whether it reached nccThreshold.
+def MeasureTemplateChange(previousTemplate,currentTemplate,nccThreshold):
+    import numpy as np
+    import SimpleITK as sitk
+    if previousTemplate == currentTemplate:
+        return 1.0,True
+    previousImage=sitk.Cast(sitk.ReadImage(previousTemplate),sitk.sitkFloat32)
+    currentImage=sitk.Cast(sitk.ReadImage(currentTemplate),sitk.sitkFloat32)
+    if ( previousImage.GetSize() != currentImage.GetSize() or previousImage.GetOrigin() != currentImage.GetOrigin()
+         or previousImage.GetSpacing() != currentImage.GetSpacing() or previousImage.GetDirection() != currentImage.GetDirection() ):
+        currentImage=sitk.Resample(currentImage,previousImage)
+    previousValues=sitk.GetArrayFromImage(previousImage).astype(np.float64).ravel()
+    currentValues=sitk.GetArrayFromImage(currentImage).astype(np.float64).ravel()
+    previousValues-=previousValues.mean()
+    currentValues-=currentValues.mean()
+    denominator=np.sqrt(np.dot(previousValues,previousValues)*np.dot(currentValues,currentValues))
+    if denominator > 0:
+        ncc=float(np.dot(previousValues,currentValues)/denominator)
+    else:
+        ncc=0.0
+    converged=ncc >= nccThreshold
+    print "Template change {0} -> {1}: NCC {2:.5f}, converged {3}".format(previousTemplate,currentTemplate,ncc,converged)
+    return ncc,converged
+
+## A converged iteration hands no images to its registrations, so the BeginANTS and WarpImageMultiTransform
+## MapNodes have no subnodes to run and FusedTemplateUpdate returns at once.
+def GateConvergedIteration(converged,images,ListOfPassiveImagesDictionararies,initial_affine_transforms=()):
+    if converged:
+        return [],[],[]
+    return images,ListOfPassiveImagesDictionararies,initial_affine_transforms
+
+## A converged iteration passes the template and passive templates it was given through unchanged.
+def SelectIterationResult(converged,previousTemplate,previousPassiveTemplates,template,passiveTemplates):
+    if converged:
+        return previousTemplate,previousPassiveTemplates
+    return template,passiveTemplates
+
+## The template of a single image is the image itself.  The outputs get the names a registered
+## iteration gives them, so MakeNewAtlasTemplate and the SUBJECT_TEMPLATES substitutions work unchanged.
+def SingleImageTemplate(iterationPhasePrefix,images,ListOfPassiveImagesDictionararies):
+    import os
+    import shutil
+    from ImageFormatPolicy import CompressImageFile
+    def StoreAs(source,destination):
+        destination=os.path.abspath(destination)
+        if os.path.exists(destination):
+            os.remove(destination)
+        if source.endswith('.nii') and destination.endswith('.nii.gz'):
+            CompressImageFile(source,destination)
+        else:
+            try:
+                os.link(source,destination)
+            except OSError:
+                shutil.copyfile(source,destination)
+        return destination
+    if len(images) != 1:
+        raise ValueError("SINGLE_IMAGE template needs exactly one image, got {0}".format(images))
+    template=StoreAs(images[0],iterationPhasePrefix+'_Reshaped.nii.gz')
+    passive_deformed_templates=list()
+    for imageType,imageFile in sorted(ListOfPassiveImagesDictionararies[0].items()):
+        passive_deformed_templates.append(StoreAs(imageFile,'AVG_'+imageType+'WARP_AVG_'+imageType+'.nii.gz'))
+    identityTransform=os.path.abspath(iterationPhasePrefix+'_IdentityAffine.txt')
+    transformFile=open(identityTransform,'w')
+    transformFile.write("#Insight Transform File V1.0\n#Transform 0\n"
+                        "Transform: MatrixOffsetTransformBase_double_3_3\n"
+                        "Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\n"
+                        "FixedParameters: 0 0 0\n")
+    transformFile.close()
+    return template,[[identityTransform]],passive_deformed_templates
+
 ##
 ## NOTE:  The modes can be either 'SINGLE_IMAGE' or 'MULTI'
-##        'SINGLE_IMAGE' is quick shorthand when you are building an atlas with a single subject, then registration can
-##                    be short-circuted
+##        'SINGLE_IMAGE' is quick shorthand when you are building an atlas with a single subject, then registration is
+##                    skipped entirely and the image is the template, see SingleImageTemplate
 ##        any other string indicates the normal mode that you would expect and replicates the shell script build_template_parallel.sh
-def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='MULTI'):
+##
+## NOTE:  An adaptive iteration has the extra 'converged' and 'previous_passive_deformed_templates' inputs.  When
+##        converged is True it registers no images and passes fixed_image and the previous passive templates
+##        through, see ANTSTemplateBuildAdaptiveWF.
+##
+## NOTE:  A warmStart iteration has the extra 'initial_affine_transforms' input, one affine per image, usually the
+##        'affine_transforms' output of the previous iteration.  Its registrations start from those affines and
+##        use the smaller WARM_START_ iteration budgets.
+def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='MULTI',adaptive=False,warmStart=False):
 
     antsTemplateBuildSingleIterationWF = pe.Workflow(name = 'ANTSTemplateBuildSingleIterationWF_'+iterationPhasePrefix)
 
-    inputSpec = pe.Node(interface=util.IdentityInterface(fields=['images', 'fixed_image',
-                'ListOfPassiveImagesDictionararies']),
+    inputFields=['images', 'fixed_image', 'ListOfPassiveImagesDictionararies']
+    if adaptive:
+        inputFields+=['converged', 'previous_passive_deformed_templates']
+    if warmStart:
+        inputFields+=['initial_affine_transforms']
+    inputSpec = pe.Node(interface=util.IdentityInterface(fields=inputFields),
                 run_without_submitting=True,
                 name='InputSpec')
     ## HACK: TODO: Need to move all local functions to a common untility file, or at the top of the file so that
@@ -68,30 +275,30 @@ def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='
     ## HACK: TODO: REMOVE 'transforms_list' it is not used.  That will change all the hashes
     ## HACK: TODO: Need to run all python files through the code beutifiers.  It has gotten pretty ugly.
     outputSpec = pe.Node(interface=util.IdentityInterface(fields=['template','transforms_list',
-                'passive_deformed_templates']),
+                'passive_deformed_templates','affine_transforms']),
                 run_without_submitting=True,
                 name='OutputSpec')
 
-    if mode == 'SINGLE_IMAGEXX':
-        ### HACK:  A more general utility that is reused should be created.
-        print "HACK: DOING SINGLE_IMAGE ", mode
-        def GetFirstListElement(this_list):
-            return this_list[0]
-        antsTemplateBuildSingleIterationWF.connect( [ (inputSpec, outputSpec, [(('images', GetFirstListElement ), 'template')] ), ])
-        ##HACK THIS DOES NOT WORK BECAUSE FILE NAMES ARE WRONG.
-        antsTemplateBuildSingleIterationWF.connect( [ (inputSpec, outputSpec, [(('ListOfPassiveImagesDictionararies', GetFirstListElement ), 'passive_deformed_templates')] ), ])
+    if mode == 'SINGLE_IMAGE':
+        SingleImage = pe.Node(interface=util.Function(function=SingleImageTemplate,
+                                  input_names=['iterationPhasePrefix','images','ListOfPassiveImagesDictionararies'],
+                                  output_names=['template','transforms_list','passive_deformed_templates']),
+                                  name='SingleImageTemplate')
+        SingleImage.inputs.iterationPhasePrefix = iterationPhasePrefix
+        LightweightNodes.MarkLightweightNode(SingleImage)
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'images', SingleImage, 'images')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'ListOfPassiveImagesDictionararies', SingleImage, 'ListOfPassiveImagesDictionararies')
+        antsTemplateBuildSingleIterationWF.connect(SingleImage, 'template', outputSpec, 'template')
+        antsTemplateBuildSingleIterationWF.connect(SingleImage, 'transforms_list', outputSpec, 'transforms_list')
+        antsTemplateBuildSingleIterationWF.connect(SingleImage, 'passive_deformed_templates', outputSpec, 'passive_deformed_templates')
         return antsTemplateBuildSingleIterationWF
 
-    print "HACK: DOING MULTI_IMAGE ", mode
-    ##import sys
-    ##sys.exit(-1)
-
-
-
     ### NOTE MAP NODE! warp each of the original images to the provided fixed_image as the template
-    BeginANTS=pe.MapNode(interface=ANTS(), name = 'BeginANTS', iterfield=['moving_image'])
-    many_cpu_BeginANTS_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 8-12 -l mem_free=6000M -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    BeginANTS.plugin_args=many_cpu_BeginANTS_options_dictionary
+    BeginANTSIterfield=['moving_image']
+    if warmStart:
+        BeginANTSIterfield.append('initial_affine')
+    BeginANTS=GatedMapNode(interface=ANTS(), name = 'BeginANTS', iterfield=BeginANTSIterfield)
+    BeginANTS.plugin_args=ResourceProfiles.GetPluginArgs('ANTS_SyN',CLUSTER_QUEUE)
     BeginANTS.inputs.dimension = 3
     BeginANTS.inputs.output_transform_prefix = iterationPhasePrefix+'_tfm'
     BeginANTS.inputs.metric = ['CC']
@@ -99,10 +306,9 @@ def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='
     BeginANTS.inputs.radius = [5]
     BeginANTS.inputs.transformation_model = 'SyN'
     BeginANTS.inputs.gradient_step_length = 0.25
-    if mode == 'SINGLE_IMAGE_IMAGE':
-        ## HACK:  Just short circuit time consuming step if only registering a single image.
-        BeginANTS.inputs.number_of_iterations = [1]
-        BeginANTS.inputs.number_of_affine_iterations = [1]
+    if warmStart:
+        BeginANTS.inputs.number_of_iterations = WARM_START_NUMBER_OF_ITERATIONS
+        BeginANTS.inputs.number_of_affine_iterations = WARM_START_NUMBER_OF_AFFINE_ITERATIONS
     else:
         BeginANTS.inputs.number_of_iterations = [50, 35, 15]
         BeginANTS.inputs.number_of_affine_iterations = [10000,10000,10000,10000,10000]
@@ -111,8 +317,27 @@ def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='
     BeginANTS.inputs.regularization = 'Gauss'
     BeginANTS.inputs.regularization_gradient_field_sigma = 3
     BeginANTS.inputs.regularization_deformation_field_sigma = 0
-    antsTemplateBuildSingleIterationWF.connect(inputSpec, 'images', BeginANTS, 'moving_image')
+    ## The images, passive images and initial affines every registration and warp of this iteration starts from
+    if adaptive:
+        Gate = pe.Node(interface=util.Function(function=GateConvergedIteration,
+                                  input_names=['converged','images','ListOfPassiveImagesDictionararies','initial_affine_transforms'],
+                                  output_names=['images','ListOfPassiveImagesDictionararies','initial_affine_transforms']),
+                                  run_without_submitting=True,
+                                  name='GateConvergedIteration')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'converged', Gate, 'converged')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'images', Gate, 'images')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'ListOfPassiveImagesDictionararies', Gate, 'ListOfPassiveImagesDictionararies')
+        if warmStart:
+            antsTemplateBuildSingleIterationWF.connect(inputSpec, 'initial_affine_transforms', Gate, 'initial_affine_transforms')
+        iterationInputs = Gate
+    else:
+        iterationInputs = inputSpec
+    if warmStart:
+        antsTemplateBuildSingleIterationWF.connect(iterationInputs, 'initial_affine_transforms', BeginANTS, 'initial_affine')
+    antsTemplateBuildSingleIterationWF.connect(iterationInputs, 'images', BeginANTS, 'moving_image')
     antsTemplateBuildSingleIterationWF.connect(inputSpec, 'fixed_image', BeginANTS, 'fixed_image')
+    ## ANTS writes the whole affine, including the initial affine, so it can start the next iteration.
+    antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'affine_transform', outputSpec, 'affine_transforms')
 
     ## Utility Function
     ## This will make a list of list pairs for defining the concatenation of transforms
@@ -121,7 +346,8 @@ def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='
     ## ll=map(list,zip(af,wp))
     ## ll
     ##[['af1.mat', 'wp1.nii'], ['af2.mat', 'wp2.nii'], ['af3.mat', 'wp3.nii']]
-    def MakeListsOfTransformLists(warpTransformList, AffineTransformList):
+    ## Both lists are undefined when a converged iteration registered no images.
+    def MakeListsOfTransformLists(warpTransformList=(), AffineTransformList=()):
         return map(list, zip(warpTransformList,AffineTransformList))
     MakeTransformsLists = pe.Node(interface=util.Function(function=MakeListsOfTransformLists,
                     input_names=['warpTransformList', 'AffineTransformList'],
@@ -133,70 +359,13 @@ def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='
     antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'affine_transform', MakeTransformsLists, 'AffineTransformList')
 
     ## Now warp all the moving_images images
-    wimtdeformed = pe.MapNode(interface = WarpImageMultiTransform(),
+    wimtdeformed = GatedMapNode(interface = WarpImageMultiTransform(),
                      iterfield=['transformation_series', 'moving_image'],
                      name ='wimtdeformed')
-    antsTemplateBuildSingleIterationWF.connect(inputSpec, 'images', wimtdeformed, 'moving_image')
+    antsTemplateBuildSingleIterationWF.connect(iterationInputs, 'images', wimtdeformed, 'moving_image')
     antsTemplateBuildSingleIterationWF.connect(MakeTransformsLists, 'out', wimtdeformed, 'transformation_series')
 
 
-    ##  Shape Update Next =====
-    ## Now  Average All moving_images deformed images together to create an updated template average
-    AvgDeformedImages=pe.Node(interface=AntsAverageImages(), name='AvgDeformedImages')
-    AvgDeformedImages.inputs.dimension = 3
-    AvgDeformedImages.inputs.output_average_image = iterationPhasePrefix+'.nii.gz'
-    AvgDeformedImages.inputs.normalize = 1
-    antsTemplateBuildSingleIterationWF.connect(wimtdeformed, "output_image", AvgDeformedImages, 'images')
-
-    ## Now average all affine transforms together
-    AvgAffineTransform = pe.Node(interface=AntsAverageAffineTransform(), name = 'AvgAffineTransform')
-    AvgAffineTransform.inputs.dimension = 3
-    AvgAffineTransform.inputs.output_affine_transform = iterationPhasePrefix+'Affine.mat'
-    antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'affine_transform', AvgAffineTransform, 'transforms')
-
-    ## Now average the warp fields togther
-    AvgWarpImages=pe.Node(interface=AntsAverageImages(), name='AvgWarpImages')
-    AvgWarpImages.inputs.dimension = 3
-    AvgWarpImages.inputs.output_average_image = iterationPhasePrefix+'warp.nii.gz'
-    AvgWarpImages.inputs.normalize = 1
-    antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'warp_transform', AvgWarpImages, 'images')
-
-    ## Now average the images together
-    ## TODO:  For now GradientStep is set to 0.25 as a hard coded default value.
-    GradientStep = 0.25
-    GradientStepWarpImage=pe.Node(interface=AntsMultiplyImages(), name='GradientStepWarpImage')
-    GradientStepWarpImage.inputs.dimension = 3
-    GradientStepWarpImage.inputs.second_input = -1.0 * GradientStep
-    GradientStepWarpImage.inputs.output_product_image = iterationPhasePrefix+'warp.nii.gz'
-    antsTemplateBuildSingleIterationWF.connect(AvgWarpImages, 'average_image', GradientStepWarpImage, 'first_input')
-
-    ## Now create the new template shape based on the average of all deformed images
-    UpdateTemplateShape = pe.Node(interface = WarpImageMultiTransform(), name = 'UpdateTemplateShape')
-    UpdateTemplateShape.inputs.invert_affine = [1]
-    antsTemplateBuildSingleIterationWF.connect(AvgDeformedImages, 'average_image', UpdateTemplateShape, 'reference_image')
-    antsTemplateBuildSingleIterationWF.connect(AvgAffineTransform, 'affine_transform', UpdateTemplateShape, 'transformation_series')
-    antsTemplateBuildSingleIterationWF.connect(GradientStepWarpImage, 'product_image', UpdateTemplateShape, 'moving_image')
-
-    def MakeTransformListWithGradientWarps(averageAffineTranform, gradientStepWarp):
-        return [averageAffineTranform, gradientStepWarp, gradientStepWarp, gradientStepWarp, gradientStepWarp]
-    ApplyInvAverageAndFourTimesGradientStepWarpImage = pe.Node(interface=util.Function(function=MakeTransformListWithGradientWarps,
-                                         input_names=['averageAffineTranform', 'gradientStepWarp'],
-                                         output_names=['TransformListWithGradientWarps']),
-                 run_without_submitting=True,
-                 name='MakeTransformListWithGradientWarps')
-    ApplyInvAverageAndFourTimesGradientStepWarpImage.inputs.ignore_exception = True
-
-    antsTemplateBuildSingleIterationWF.connect(AvgAffineTransform, 'affine_transform', ApplyInvAverageAndFourTimesGradientStepWarpImage, 'averageAffineTranform')
-    antsTemplateBuildSingleIterationWF.connect(UpdateTemplateShape, 'output_image', ApplyInvAverageAndFourTimesGradientStepWarpImage, 'gradientStepWarp')
-
-    ReshapeAverageImageWithShapeUpdate = pe.Node(interface = WarpImageMultiTransform(), name = 'ReshapeAverageImageWithShapeUpdate')
-    ReshapeAverageImageWithShapeUpdate.inputs.invert_affine = [1]
-    ReshapeAverageImageWithShapeUpdate.inputs.out_postfix = '_Reshaped'
-    antsTemplateBuildSingleIterationWF.connect(AvgDeformedImages, 'average_image', ReshapeAverageImageWithShapeUpdate, 'moving_image')
-    antsTemplateBuildSingleIterationWF.connect(AvgDeformedImages, 'average_image', ReshapeAverageImageWithShapeUpdate, 'reference_image')
-    antsTemplateBuildSingleIterationWF.connect(ApplyInvAverageAndFourTimesGradientStepWarpImage, 'TransformListWithGradientWarps', ReshapeAverageImageWithShapeUpdate, 'transformation_series')
-    antsTemplateBuildSingleIterationWF.connect(ReshapeAverageImageWithShapeUpdate, 'output_image', outputSpec, 'template')
-
     ######
     ######
     ######  Process all the passive deformed images in a way similar to the main image used for registration
@@ -209,66 +378,101 @@ def ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='
                                   input_names = ['ListOfPassiveImagesDictionararies','transformation_series'],
                                   output_names = ['flattened_images','flattened_transforms','flattened_image_nametypes']),
                                   run_without_submitting=True, name="99_FlattenTransformAndImagesList")
-    antsTemplateBuildSingleIterationWF.connect( inputSpec,'ListOfPassiveImagesDictionararies', FlattenTransformAndImagesListNode, 'ListOfPassiveImagesDictionararies' )
+    antsTemplateBuildSingleIterationWF.connect( iterationInputs,'ListOfPassiveImagesDictionararies', FlattenTransformAndImagesListNode, 'ListOfPassiveImagesDictionararies' )
     antsTemplateBuildSingleIterationWF.connect( MakeTransformsLists ,'out', FlattenTransformAndImagesListNode, 'transformation_series' )
-    wimtPassivedeformed = pe.MapNode(interface = WarpImageMultiTransform(),
+    wimtPassivedeformed = GatedMapNode(interface = WarpImageMultiTransform(),
                      iterfield=['transformation_series', 'moving_image'],
                      name ='wimtPassivedeformed')
     antsTemplateBuildSingleIterationWF.connect(FlattenTransformAndImagesListNode, 'flattened_images',     wimtPassivedeformed, 'moving_image')
     antsTemplateBuildSingleIterationWF.connect(FlattenTransformAndImagesListNode, 'flattened_transforms', wimtPassivedeformed, 'transformation_series')
 
-    def RenestDeformedPassiveImages(deformedPassiveImages,flattened_image_nametypes):
-        import os
-        """ Now make a list of lists of images where the outter list is per image type,
-        and the inner list is the same size as the number of subjects to be averaged.
-        In this case, the first element will be a list of all the deformed T2's, and
-        the second element will be a list of all deformed POSTERIOR_AIR,  etc..
-        """
-        all_images_size=len(deformedPassiveImages)
-        image_dictionary_of_lists=dict()
-        nested_imagetype_list=list()
-        outputAverageImageName_list=list()
-        image_type_list=list()
-        ## make empty_list, this is not efficient, but it works
-        for name in flattened_image_nametypes:
-            image_dictionary_of_lists[name]=list()
-        for index in range(0,all_images_size):
-            curr_name=flattened_image_nametypes[index]
-            curr_file=deformedPassiveImages[index]
-            image_dictionary_of_lists[curr_name].append(curr_file)
-        for image_type,image_list in image_dictionary_of_lists.items():
-            nested_imagetype_list.append(image_list)
-            outputAverageImageName_list.append('AVG_'+image_type+'.nii.gz')
-            image_type_list.append('WARP_AVG_'+image_type)
-        print "\n"*10
-        print "HACK: ", nested_imagetype_list
-        print "HACK: ", outputAverageImageName_list
-        print "HACK: ", image_type_list
-        return nested_imagetype_list,outputAverageImageName_list,image_type_list
-    RenestDeformedPassiveImagesNode = pe.Node( Function(function=RenestDeformedPassiveImages,
-                                  input_names = ['deformedPassiveImages','flattened_image_nametypes'],
-                                  output_names = ['nested_imagetype_list','outputAverageImageName_list','image_type_list']),
-                                  run_without_submitting=True, name="99_RenestDeformedPassiveImages")
-    antsTemplateBuildSingleIterationWF.connect(wimtPassivedeformed, 'output_image', RenestDeformedPassiveImagesNode, 'deformedPassiveImages')
-    antsTemplateBuildSingleIterationWF.connect(FlattenTransformAndImagesListNode, 'flattened_image_nametypes', RenestDeformedPassiveImagesNode, 'flattened_image_nametypes')
-    ## Now  Average All passive moving_images deformed images together to create an updated template average
-    AvgDeformedPassiveImages=pe.MapNode(interface=AntsAverageImages(),
-      iterfield=['images','output_average_image'],
-      name='AvgDeformedPassiveImages')
-    AvgDeformedPassiveImages.inputs.dimension = 3
-    AvgDeformedPassiveImages.inputs.normalize = 0
-    antsTemplateBuildSingleIterationWF.connect(RenestDeformedPassiveImagesNode, "nested_imagetype_list", AvgDeformedPassiveImages, 'images')
-    antsTemplateBuildSingleIterationWF.connect(RenestDeformedPassiveImagesNode, "outputAverageImageName_list", AvgDeformedPassiveImages, 'output_average_image')
-
-    ## -- TODO:  Now neeed to reshape all the passive images as well
-    ReshapeAveragePassiveImageWithShapeUpdate = pe.MapNode(interface = WarpImageMultiTransform(),
-      iterfield=['moving_image','reference_image','out_postfix'],
-      name = 'ReshapeAveragePassiveImageWithShapeUpdate')
-    ReshapeAveragePassiveImageWithShapeUpdate.inputs.invert_affine = [1]
-    antsTemplateBuildSingleIterationWF.connect(RenestDeformedPassiveImagesNode, "image_type_list", ReshapeAveragePassiveImageWithShapeUpdate, 'out_postfix')
-    antsTemplateBuildSingleIterationWF.connect(AvgDeformedPassiveImages, 'average_image', ReshapeAveragePassiveImageWithShapeUpdate, 'moving_image')
-    antsTemplateBuildSingleIterationWF.connect(AvgDeformedPassiveImages, 'average_image', ReshapeAveragePassiveImageWithShapeUpdate, 'reference_image')
-    antsTemplateBuildSingleIterationWF.connect(ApplyInvAverageAndFourTimesGradientStepWarpImage, 'TransformListWithGradientWarps', ReshapeAveragePassiveImageWithShapeUpdate, 'transformation_series')
-    antsTemplateBuildSingleIterationWF.connect(ReshapeAveragePassiveImageWithShapeUpdate, 'output_image', outputSpec, 'passive_deformed_templates')
+    ##  Shape Update Next =====
+    ## The averages of the deformed images, the warps, the affines and every passive image type, the
+    ## gradient step and the reshaping with the shape update are all done by one FusedTemplateUpdate job.
+    ## TODO:  For now GradientStep is set to 0.25 as a hard coded default value.
+    GradientStep = 0.25
+    TemplateUpdate = pe.Node(interface=util.Function(function=FusedTemplateUpdate,
+                                  input_names=['iterationPhasePrefix','gradientStep','deformedImages','warpTransforms','affineTransforms',
+                                               'deformedPassiveImages','passiveImageNametypes'],
+                                  output_names=['template','passive_deformed_templates']),
+                                  name='FusedTemplateUpdate')
+    TemplateUpdate.plugin_args=ResourceProfiles.GetPluginArgs('TemplateUpdate',CLUSTER_QUEUE)
+    TemplateUpdate.inputs.iterationPhasePrefix = iterationPhasePrefix
+    TemplateUpdate.inputs.gradientStep = GradientStep
+    antsTemplateBuildSingleIterationWF.connect(wimtdeformed, 'output_image', TemplateUpdate, 'deformedImages')
+    antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'warp_transform', TemplateUpdate, 'warpTransforms')
+    antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'affine_transform', TemplateUpdate, 'affineTransforms')
+    antsTemplateBuildSingleIterationWF.connect(wimtPassivedeformed, 'output_image', TemplateUpdate, 'deformedPassiveImages')
+    antsTemplateBuildSingleIterationWF.connect(FlattenTransformAndImagesListNode, 'flattened_image_nametypes', TemplateUpdate, 'passiveImageNametypes')
+    if adaptive:
+        IterationResult = pe.Node(interface=util.Function(function=SelectIterationResult,
+                                  input_names=['converged','previousTemplate','previousPassiveTemplates','template','passiveTemplates'],
+                                  output_names=['template','passive_deformed_templates']),
+                                  run_without_submitting=True,
+                                  name='IterationResult')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'converged', IterationResult, 'converged')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'fixed_image', IterationResult, 'previousTemplate')
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'previous_passive_deformed_templates', IterationResult, 'previousPassiveTemplates')
+        antsTemplateBuildSingleIterationWF.connect(TemplateUpdate, 'template', IterationResult, 'template')
+        antsTemplateBuildSingleIterationWF.connect(TemplateUpdate, 'passive_deformed_templates', IterationResult, 'passiveTemplates')
+        antsTemplateBuildSingleIterationWF.connect(IterationResult, 'template', outputSpec, 'template')
+        antsTemplateBuildSingleIterationWF.connect(IterationResult, 'passive_deformed_templates', outputSpec, 'passive_deformed_templates')
+    else:
+        antsTemplateBuildSingleIterationWF.connect(TemplateUpdate, 'template', outputSpec, 'template')
+        antsTemplateBuildSingleIterationWF.connect(TemplateUpdate, 'passive_deformed_templates', outputSpec, 'passive_deformed_templates')
 
     return antsTemplateBuildSingleIterationWF
+
+##
+## Chains up to maxIterations template iterations.  The first iteration always runs, every later one
+## first compares the two templates before it with MeasureTemplateChange, and once they agree to
+## nccThreshold the remaining iterations skip their registrations and pass the template through.
+## The nipype graph is static, so the skipped iterations are still in the graph, but their MapNodes
+## have no subnodes and their template update returns at once.  With warmStart every iteration after
+## the first starts its registrations from the affines of the iteration before it.
+## NOTE:  warmStart is off until a warm started template has been compared against a cold started one.
+def ANTSTemplateBuildAdaptiveWF(CLUSTER_QUEUE,mode='MULTI',maxIterations=TEMPLATE_MAX_ITERATIONS,nccThreshold=TEMPLATE_CONVERGENCE_NCC,
+                                warmStart=False):
+
+    adaptiveWF = pe.Workflow(name = 'ANTSTemplateBuildAdaptiveWF')
+
+    inputSpec = pe.Node(interface=util.IdentityInterface(fields=['images', 'fixed_image',
+                'ListOfPassiveImagesDictionararies']),
+                run_without_submitting=True,
+                name='InputSpec')
+    outputSpec = pe.Node(interface=util.IdentityInterface(fields=['template','passive_deformed_templates']),
+                run_without_submitting=True,
+                name='OutputSpec')
+
+    if mode == 'SINGLE_IMAGE':
+        ## A single image is its own template, there is nothing to iterate.
+        maxIterations = 1
+    previousIteration = None
+    for iteration in range(1,maxIterations+1):
+        iterationPhasePrefix = 'Iteration{0:02d}'.format(iteration)
+        currentIteration = ANTSTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode,adaptive=(previousIteration is not None),
+                                                              warmStart=(warmStart and previousIteration is not None))
+        adaptiveWF.connect(inputSpec, 'images', currentIteration, 'InputSpec.images')
+        adaptiveWF.connect(inputSpec, 'ListOfPassiveImagesDictionararies', currentIteration, 'InputSpec.ListOfPassiveImagesDictionararies')
+        if previousIteration is None:
+            if mode != 'SINGLE_IMAGE':
+                adaptiveWF.connect(inputSpec, 'fixed_image', currentIteration, 'InputSpec.fixed_image')
+        else:
+            TemplateChange = pe.Node(interface=util.Function(function=MeasureTemplateChange,
+                                  input_names=['previousTemplate','currentTemplate','nccThreshold'],
+                                  output_names=['ncc','converged']),
+                                  name='TemplateChange_'+iterationPhasePrefix)
+            TemplateChange.inputs.nccThreshold = nccThreshold
+            LightweightNodes.MarkLightweightNode(TemplateChange)
+            adaptiveWF.connect(previousIteration, 'InputSpec.fixed_image', TemplateChange, 'previousTemplate')
+            adaptiveWF.connect(previousIteration, 'OutputSpec.template', TemplateChange, 'currentTemplate')
+            adaptiveWF.connect(TemplateChange, 'converged', currentIteration, 'InputSpec.converged')
+            adaptiveWF.connect(previousIteration, 'OutputSpec.template', currentIteration, 'InputSpec.fixed_image')
+            adaptiveWF.connect(previousIteration, 'OutputSpec.passive_deformed_templates', currentIteration, 'InputSpec.previous_passive_deformed_templates')
+            if warmStart:
+                adaptiveWF.connect(previousIteration, 'OutputSpec.affine_transforms', currentIteration, 'InputSpec.initial_affine_transforms')
+        previousIteration = currentIteration
+    adaptiveWF.connect(previousIteration, 'OutputSpec.template', outputSpec, 'template')
+    adaptiveWF.connect(previousIteration, 'OutputSpec.passive_deformed_templates', outputSpec, 'passive_deformed_templates')
+
+    return adaptiveWF
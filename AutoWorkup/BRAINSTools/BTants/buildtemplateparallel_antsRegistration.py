@@ -22,10 +22,15 @@ from BRAINSTools.BTants.antsAverageImages import *
 from BRAINSTools.BTants.antsAverageAffineTransform import *
 from BRAINSTools.BTants.antsMultiplyImages import *
 
+import ResourceProfiles
+
+## A warm started BeginANTS begins at the affine of an earlier iteration, so the coarse levels
+## get a smaller budget than a cold start.
+WARM_START_NUMBER_OF_ITERATIONS = [[100, 500, 1000], [15, 35, 15]]
+
 ## Flatten and return equal length transform and images lists.
 def FlattenTransformAndImagesList(ListOfPassiveImagesDictionararies,transformation_series):
     import sys
-    print("HACK:  DEBUG: ListOfPassiveImagesDictionararies\n{lpi}\n".format(lpi=ListOfPassiveImagesDictionararies))
     subjCount=len(ListOfPassiveImagesDictionararies)
     tranCount=len(transformation_series)
     if subjCount != tranCount:
@@ -45,21 +50,37 @@ def FlattenTransformAndImagesList(ListOfPassiveImagesDictionararies,transformati
             flattened_images.append(img)
             flattened_image_nametypes.append(imgname)
             flattened_transforms.append(subjToAtlasTransform)
-    print("HACK: flattened images    {0}\n".format(flattened_images))
-    print("HACK: flattened nametypes {0}\n".format(flattened_image_nametypes))
-    print("HACK: flattened txfms     {0}\n".format(flattened_transforms))
     return flattened_images,flattened_transforms,flattened_image_nametypes
+
+## The forward_transforms of antsRegistration are the initial moving transform, when there is one, the
+## affine stage and the SyN warp.  The next iteration starts from all of them but the warp, composed
+## into one affine with ComposeMultiTransform.
+def ComposeAffineTransforms(forward_transforms):
+    import os
+    import subprocess
+    affine_transforms=forward_transforms[:-1]
+    if len(affine_transforms) == 1:
+        return affine_transforms[0]
+    composed_affine=os.path.abspath('ComposedAffine.txt')
+    subprocess.check_call(['ComposeMultiTransform','3',composed_affine]+affine_transforms)
+    return composed_affine
 ##
 ## NOTE:  The modes can be either 'SINGLE_IMAGE' or 'MULTI'
 ##        'SINGLE_IMAGE' is quick shorthand when you are building an atlas with a single subject, then registration can
 ##                    be short-circuted
 ##        any other string indicates the normal mode that you would expect and replicates the shell script build_template_parallel.sh
-def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,,CLUSTER_QUEUE,mode='MULTI'):
+##
+## NOTE:  A warmStart iteration has the extra 'initial_moving_transforms' input, one affine per image, usually the
+##        'affine_transforms' output of the previous iteration.  Its registrations start from those affines and
+##        use the smaller WARM_START_NUMBER_OF_ITERATIONS budget.
+def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,CLUSTER_QUEUE,mode='MULTI',warmStart=False):
 
     antsTemplateBuildSingleIterationWF = pe.Workflow(name = 'antsRegistrationTemplateBuildSingleIterationWF_'+iterationPhasePrefix)
 
-    inputSpec = pe.Node(interface=util.IdentityInterface(fields=['images', 'fixed_image',
-                'ListOfPassiveImagesDictionararies']),
+    inputFields=['images', 'fixed_image', 'ListOfPassiveImagesDictionararies']
+    if warmStart:
+        inputFields+=['initial_moving_transforms']
+    inputSpec = pe.Node(interface=util.IdentityInterface(fields=inputFields),
                 run_without_submitting=True,
                 name='InputSpec')
     ## HACK: TODO: Need to move all local functions to a common untility file, or at the top of the file so that
@@ -68,13 +89,12 @@ def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,,CLUSTER
     ## HACK: TODO: REMOVE 'transforms_list' it is not used.  That will change all the hashes
     ## HACK: TODO: Need to run all python files through the code beutifiers.  It has gotten pretty ugly.
     outputSpec = pe.Node(interface=util.IdentityInterface(fields=['template','transforms_list',
-                'passive_deformed_templates']),
+                'passive_deformed_templates','affine_transforms']),
                 run_without_submitting=True,
                 name='OutputSpec')
 
     if mode == 'SINGLE_IMAGEXX':
         ### HACK:  A more general utility that is reused should be created.
-        print "HACK: DOING SINGLE_IMAGE ", mode
         def GetFirstListElement(this_list):
             return this_list[0]
         antsTemplateBuildSingleIterationWF.connect( [ (inputSpec, outputSpec, [(('images', GetFirstListElement ), 'template')] ), ])
@@ -82,16 +102,12 @@ def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,,CLUSTER
         antsTemplateBuildSingleIterationWF.connect( [ (inputSpec, outputSpec, [(('ListOfPassiveImagesDictionararies', GetFirstListElement ), 'passive_deformed_templates')] ), ])
         return antsTemplateBuildSingleIterationWF
 
-    print "HACK: DOING MULTI_IMAGE ", mode
-    ##import sys
-    ##sys.exit(-1)
-
-
-
     ### NOTE MAP NODE! warp each of the original images to the provided fixed_image as the template
-    BeginANTS=pe.MapNode(interface=antsRegistration(), name = 'BeginANTS', iterfield=['moving_image'])
-    many_cpu_BeginANTS_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 8-12 -l mem_free=6000M -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    BeginANTS.plugin_args=many_cpu_BeginANTS_options_dictionary
+    BeginANTSIterfield=['moving_image']
+    if warmStart:
+        BeginANTSIterfield.append('initial_moving_transform')
+    BeginANTS=pe.MapNode(interface=antsRegistration(), name = 'BeginANTS', iterfield=BeginANTSIterfield)
+    BeginANTS.plugin_args=ResourceProfiles.GetPluginArgs('ANTS_SyN',CLUSTER_QUEUE)
     BeginANTS.inputs.dimension = 3
     BeginANTS.inputs.output_transform_prefix = iterationPhasePrefix+'_tfm'
     BeginANTS.inputs.transforms =               ["Affine",           "SyN"]
@@ -102,6 +118,8 @@ def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,,CLUSTER
     if mode == 'SINGLE_IMAGE_IMAGE':
         ## HACK:  Just short circuit time consuming step if only registering a single image.
         BeginANTS.inputs.number_of_iterations = [[1],                [1]]
+    elif warmStart:
+        BeginANTS.inputs.number_of_iterations = WARM_START_NUMBER_OF_ITERATIONS
     else:
         BeginANTS.inputs.number_of_iterations = [[1000, 1000, 1000], [50, 35, 15]]
     BeginANTS.inputs.use_histogram_matching =   [True,               True]
@@ -109,6 +127,18 @@ def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,,CLUSTER
     BeginANTS.inputs.smoothing_sigmas =         [[0,0,0],            [0,0,0]]
     antsTemplateBuildSingleIterationWF.connect(inputSpec, 'images', BeginANTS, 'moving_image')
     antsTemplateBuildSingleIterationWF.connect(inputSpec, 'fixed_image', BeginANTS, 'fixed_image')
+    if warmStart:
+        antsTemplateBuildSingleIterationWF.connect(inputSpec, 'initial_moving_transforms', BeginANTS, 'initial_moving_transform')
+    ## The affine stage is relative to the initial moving transform, so the affine that starts the next
+    ## iteration is both of them composed.
+    ComposeAffines = pe.MapNode(interface=util.Function(function=ComposeAffineTransforms,
+                                input_names=['forward_transforms'],
+                                output_names=['affine_transform']),
+                                iterfield=['forward_transforms'],
+                                run_without_submitting=True,
+                                name='ComposeAffineTransforms')
+    antsTemplateBuildSingleIterationWF.connect(BeginANTS, 'forward_transforms', ComposeAffines, 'forward_transforms')
+    antsTemplateBuildSingleIterationWF.connect(ComposeAffines, 'affine_transform', outputSpec, 'affine_transforms')
 
     ## Now transform all the images
     wimtdeformed = pe.MapNode(interface = AntsApplyTransforms(), name ='wimtdeformed',
@@ -240,10 +270,6 @@ def antsRegistrationTemplateBuildSingleIterationWF(iterationPhasePrefix,,CLUSTER
             nested_imagetype_list.append(image_list)
             outputAverageImageName_list.append('AVG_'+image_type+'.nii.gz')
             image_type_list.append('WARP_AVG_'+image_type)
-        print "\n"*10
-        print "HACK: ", nested_imagetype_list
-        print "HACK: ", outputAverageImageName_list
-        print "HACK: ", image_type_list
         return nested_imagetype_list,outputAverageImageName_list,image_type_list
     RenestDeformedPassiveImagesNode = pe.Node( Function(function=RenestDeformedPassiveImages,
                                   input_names = ['deformedPassiveImages','flattened_image_nametypes'],
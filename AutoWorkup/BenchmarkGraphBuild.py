@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Measure how long building the AutoWorkup graphs takes as the cohort grows.
+
+A synthetic experiment (placeholder atlas, BCD model and session images) is
+written to a scratch directory, and for each subject count the WorkupT1T2
+graphs are built the way baw_exp does, then combined and flattened the way
+nipype does before the first job starts.  Nothing is run.
+
+    python BenchmarkGraphBuild.py --subjectCounts 1,4,16,64 --output GraphBuildTimes.csv
+
+Run it from the AutoWorkup directory with the same PYTHONPATH as baw_exp.
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+## The synthetic files only need to pass the existence and read checks.
+PLACEHOLDER_BYTES = 'x'*1024
+
+def _local_touch(fileName):
+    if not os.path.exists(os.path.dirname(fileName)):
+        os.makedirs(os.path.dirname(fileName))
+    placeholder=open(fileName,'wb')
+    placeholder.write(PLACEHOLDER_BYTES)
+    placeholder.close()
+
+def MakeSyntheticExperiment(baseDir, numSubjects, sessionsPerSubject, writeSessionImage=_local_touch):
+    """ Returns (session csv file,atlas directory,BCD model directory) of a synthetic experiment in baseDir """
+    from WorkupT1T2AtlasNode import atlas_file_names
+    atlasDir=os.path.join(baseDir,'Atlas')
+    for atlasFile in atlas_file_names:
+        _local_touch(os.path.join(atlasDir,atlasFile))
+    bcdModelDir=os.path.join(baseDir,'BCDModels')
+    for modelFile in ['LLSModel-2ndVersion.hdf5','T1-2ndVersion.mdl']:
+        _local_touch(os.path.join(bcdModelDir,modelFile))
+    sessionFile=os.path.join(baseDir,'SyntheticSessions.csv')
+    csvFile=open(sessionFile,'wb')
+    sessionWriter=csv.writer(csvFile,delimiter=',',quotechar='"')
+    sessionWriter.writerow(['project','subj','session','imagefiles'])
+    for subject in range(numSubjects):
+        subjectid='{0:04d}'.format(subject)
+        for session in range(sessionsPerSubject):
+            sessionid='{0}{1:02d}'.format(subjectid,session)
+            scans=dict()
+            for scanType in ['T1-30','T2-30']:
+                imageFile=os.path.join(baseDir,'images',subjectid,sessionid,scanType+'.nii.gz')
+                writeSessionImage(imageFile)
+                scans[scanType]=[imageFile]
+            sessionWriter.writerow(['SYNTHETIC',subjectid,sessionid,repr(scans)])
+    csvFile.close()
+    return sessionFile,atlasDir,bcdModelDir
+
+def TimeCohortGraphBuild(experimentDir, ExperimentDatabase, atlasDir, bcdModelDir, WORKFLOW_COMPONENTS):
+    """ Returns (build seconds,flatten seconds,node count) for the subjects of ExperimentDatabase """
+    import WorkupT1T2
+    cacheDir=os.path.join(experimentDir,'CACHE')
+    resultsDir=os.path.join(experimentDir,'Results')
+    ## The build messages go to /dev/null, so only the cost of formatting them is measured.
+    realStdout=sys.stdout
+    sys.stdout=open(os.devnull,'w')
+    try:
+        startTime=time.time()
+        subjectWorkflowList=list()
+        for subjectid in ExperimentDatabase.getAllSubjects():
+            subjectWorkflowList.append(WorkupT1T2.WorkupT1T2(subjectid,'',cacheDir,resultsDir,ExperimentDatabase,
+              atlasDir,bcdModelDir,WORKFLOW_COMPONENTS=WORKFLOW_COMPONENTS,WorkflowName="BAW_20120813_"+str(subjectid)))
+        baw200=WorkupT1T2.MakeMultiSubjectWorkflow(subjectWorkflowList,cacheDir)
+        buildSecs=time.time()-startTime
+        startTime=time.time()
+        flatgraph=baw200._create_flat_graph()
+        flattenSecs=time.time()-startTime
+    finally:
+        sys.stdout.close()
+        sys.stdout=realStdout
+    return buildSecs,flattenSecs,len(flatgraph.nodes())
+
+def TimeGraphBuild(baseDir, numSubjects, sessionsPerSubject, WORKFLOW_COMPONENTS):
+    """ Returns (build seconds,flatten seconds,node count) for one synthetic cohort of numSubjects """
+    import SessionDB
+    experimentDir=os.path.join(baseDir,'{0}_subjects'.format(numSubjects))
+    sessionFile,atlasDir,bcdModelDir=MakeSyntheticExperiment(experimentDir,numSubjects,sessionsPerSubject)
+    ExperimentDatabase=SessionDB.SessionDB(os.path.join(experimentDir,'SessionDB.db'),
+      [ '{0:04d}'.format(subject) for subject in range(numSubjects) ])
+    ExperimentDatabase.MakeNewDB(sessionFile,'')
+    return TimeCohortGraphBuild(experimentDir,ExperimentDatabase,atlasDir,bcdModelDir,WORKFLOW_COMPONENTS)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Times the construction of the AutoWorkup graphs against the number of subjects')
+    parser.add_argument('--subjectCounts', action='store', dest='subjectCounts', default='1,2,4,8,16',
+                        help='Comma separated numbers of subjects to build graphs for')
+    parser.add_argument('--sessionsPerSubject', action='store', dest='sessionsPerSubject', type=int, default=2,
+                        help='The number of sessions of each synthetic subject')
+    parser.add_argument('--components', action='store', dest='components', default="['BASIC','TISSUE_CLASSIFY','SEGMENTATION']",
+                        help='The WORKFLOW_COMPONENTS to build, as in the experiment config file')
+    parser.add_argument('--output', action='store', dest='output', default=None,
+                        help='A csv file to append the measurements to')
+    input_arguments = parser.parse_args()
+
+    WORKFLOW_COMPONENTS=eval(input_arguments.components)
+    baseDir=tempfile.mkdtemp(prefix='BenchmarkGraphBuild_')
+    rows=list()
+    try:
+        print("{0:>9s} {1:>9s} {2:>10s} {3:>12s} {4:>14s}".format('subjects','nodes','build(s)','flatten(s)','build/subj(s)'))
+        for numSubjects in [ int(count) for count in input_arguments.subjectCounts.split(',') ]:
+            buildSecs,flattenSecs,nodeCount=TimeGraphBuild(baseDir,numSubjects,input_arguments.sessionsPerSubject,WORKFLOW_COMPONENTS)
+            print("{0:9d} {1:9d} {2:10.2f} {3:12.2f} {4:14.3f}".format(numSubjects,nodeCount,buildSecs,flattenSecs,buildSecs/numSubjects))
+            rows.append( dict(subjects=numSubjects,sessions_per_subject=input_arguments.sessionsPerSubject,nodes=nodeCount,
+                              build_secs=buildSecs,flatten_secs=flattenSecs) )
+    finally:
+        shutil.rmtree(baseDir,ignore_errors=True)
+    if input_arguments.output is not None:
+        writeHeader=not os.path.exists(input_arguments.output)
+        outputFile=open(input_arguments.output,'a')
+        dWriter=csv.DictWriter(outputFile,['subjects','sessions_per_subject','nodes','build_secs','flatten_secs'],restval='', extrasaction='raise', dialect='excel')
+        if writeHeader:
+            dWriter.writeheader()
+        dWriter.writerows(rows)
+        outputFile.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
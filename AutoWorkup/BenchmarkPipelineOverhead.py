@@ -0,0 +1,266 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Measure the overhead AutoWorkup adds around the BRAINS tools, offline.
+
+For each number of sessions a synthetic experiment of small NIfTI volumes is
+written to a scratch directory, and the time spent in
+
+  * graph_build, graph_flatten: building and flattening the WorkupT1T2 graphs
+  * sessiondb_build, sessiondb_query: SessionDB.MakeNewDB and the per subject queries
+  * hash_cold, hash_warm: FastContentHash digests of the session images
+  * datasink_copy: a CompressingDataSink storing one .nii image per session
+  * scheduler_latency: a graph of one stub BRAINSResample node per session
+
+is measured.  The BRAINS tools are replaced by stub executables, put first
+on the PATH, that sleep for --stubSleep seconds and copy their first input
+file to each --output* argument, so the scheduler measurement needs neither
+the tools nor real data.
+
+    python BenchmarkPipelineOverhead.py --sessionCounts 1,10,100,1000 --output PipelineOverheadHistory.csv
+
+Each measurement is appended to the --output csv file with the date and the
+git revision of the tree, so the numbers can be followed across changes.
+Run it from the AutoWorkup directory with the same PYTHONPATH as baw_exp.
+"""
+import csv
+import glob
+import gzip
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from BenchmarkGraphBuild import MakeSyntheticExperiment, TimeCohortGraphBuild
+
+## The edge length in voxels of the synthetic uint8 volumes.
+SYNTHETIC_VOLUME_SIZE = 32
+NIFTI_HEADER_SIZE = 348
+NIFTI_VOX_OFFSET = 352
+
+HISTORY_FIELDS = ['date','revision','measurement','sessions','seconds','seconds_per_session']
+
+def WriteSyntheticVolume(fileName, size=SYNTHETIC_VOLUME_SIZE, seed=0):
+    """ Write a size**3 uint8 NIfTI-1 volume with 1mm voxels, gzipped when fileName ends with .gz """
+    if not os.path.exists(os.path.dirname(fileName)):
+        os.makedirs(os.path.dirname(fileName))
+    header=bytearray(NIFTI_VOX_OFFSET)
+    struct.pack_into('<i',header,0,NIFTI_HEADER_SIZE)
+    struct.pack_into('<c',header,38,'r')
+    struct.pack_into('<8h',header,40,3,size,size,size,1,1,1,1)
+    struct.pack_into('<hh',header,70,2,8)                     ## datatype DT_UINT8, bitpix
+    struct.pack_into('<8f',header,76,1.0,1.0,1.0,1.0,0,0,0,0)  ## qfac and the voxel spacing
+    struct.pack_into('<fff',header,108,NIFTI_VOX_OFFSET,1.0,0.0)  ## vox_offset, scl_slope, scl_inter
+    struct.pack_into('<c',header,123,'\x02')                  ## xyzt_units, mm
+    struct.pack_into('<80s',header,148,'synthetic AutoWorkup benchmark volume')
+    struct.pack_into('<hh',header,252,1,1)                    ## qform_code, sform_code
+    struct.pack_into('<12f',header,280,1,0,0,0, 0,1,0,0, 0,0,1,0)
+    struct.pack_into('<4s',header,344,'n+1\0')
+    voxels=bytearray(size*size*size)
+    for index in range(len(voxels)):
+        voxels[index]=(index*7+seed*13)%251
+    if fileName.endswith('.gz'):
+        imageFile=gzip.open(fileName,'wb')
+    else:
+        imageFile=open(fileName,'wb')
+    imageFile.write(str(header))
+    imageFile.write(str(voxels))
+    imageFile.close()
+
+STUB_TOOL_TEMPLATE = """#!{python}
+## Benchmark stand in for a BRAINS tool: sleep, then copy the first input to every --output* argument.
+import os
+import shutil
+import sys
+import time
+time.sleep(float(os.environ.get('BENCHMARK_STUB_SLEEP','0')))
+args=sys.argv[1:]
+inputs=[ arg for arg in args if os.path.isfile(arg) ]
+for index in range(len(args)-1):
+    if args[index].startswith('--output') and not args[index+1].startswith('--'):
+        if len(inputs) > 0:
+            shutil.copyfile(inputs[0],args[index+1])
+        else:
+            open(args[index+1],'wb').close()
+"""
+
+def _local_brainsToolNames():
+    """ The executable names of the wrapped BRAINS tools, read from the _cmd of each wrapper """
+    toolNames=set()
+    wrapperDir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'BRAINSTools')
+    for wrapperFile in glob.glob(os.path.join(wrapperDir,'*.py')):
+        for match in re.finditer(r'_cmd\s*=\s*["\']\s*([A-Za-z0-9_.]+)\s*["\']',open(wrapperFile).read()):
+            toolNames.add(match.group(1))
+    return sorted(toolNames)
+
+def InstallStubTools(binDir, sleepSecs):
+    """ Write a stub executable for each BRAINS tool into binDir, and put binDir first on the PATH """
+    if not os.path.exists(binDir):
+        os.makedirs(binDir)
+    stubSource=STUB_TOOL_TEMPLATE.format(python=sys.executable)
+    for toolName in _local_brainsToolNames():
+        stubFile=os.path.join(binDir,toolName)
+        stub=open(stubFile,'w')
+        stub.write(stubSource)
+        stub.close()
+        os.chmod(stubFile,0755)
+    os.environ['BENCHMARK_STUB_SLEEP']=str(sleepSecs)
+    os.environ['PATH']=binDir+os.pathsep+os.environ.get('PATH','')
+
+def _local_sessionImages(experimentDir):
+    return sorted(glob.glob(os.path.join(experimentDir,'images','*','*','*.nii.gz')))
+
+def TimeSessionDB(experimentDir, sessionFile, numSubjects):
+    """ Returns (ExperimentDatabase,build seconds,query seconds) """
+    import SessionDB
+    startTime=time.time()
+    ExperimentDatabase=SessionDB.SessionDB(os.path.join(experimentDir,'SessionDB.db'),
+      [ '{0:04d}'.format(subject) for subject in range(numSubjects) ])
+    ExperimentDatabase.MakeNewDB(sessionFile,'')
+    buildSecs=time.time()-startTime
+    startTime=time.time()
+    for subjectid in ExperimentDatabase.getAllSubjects():
+        ExperimentDatabase.getSubjectSessionsInfo(subjectid)
+    querySecs=time.time()-startTime
+    return ExperimentDatabase,buildSecs,querySecs
+
+def TimeHashing(experimentDir):
+    """ Returns (cold seconds,warm seconds) of digesting the session images twice """
+    from FastContentHash import ContentHashService
+    hashService=ContentHashService(os.path.join(experimentDir,'ContentHash.db'))
+    imageList=_local_sessionImages(experimentDir)
+    startTime=time.time()
+    hashService.Digests(imageList)
+    coldSecs=time.time()-startTime
+    startTime=time.time()
+    hashService.Digests(imageList)
+    warmSecs=time.time()-startTime
+    return coldSecs,warmSecs
+
+def TimeDataSink(experimentDir, numSessions):
+    """ Returns the seconds a CompressingDataSink takes to store numSessions .nii images """
+    from ImageFormatPolicy import CompressingDataSink, IntermediateImageName
+    intermediateDir=os.path.join(experimentDir,'Intermediate')
+    imageList=list()
+    for session in range(numSessions):
+        imageFile=os.path.join(intermediateDir,IntermediateImageName('volume_{0:05d}'.format(session)))
+        WriteSyntheticVolume(imageFile,seed=session)
+        imageList.append(imageFile)
+    sink=CompressingDataSink()
+    sink.inputs.base_directory=os.path.join(experimentDir,'Sink')
+    setattr(sink.inputs,'Benchmark.@volumes',imageList)
+    startTime=time.time()
+    sink.run()
+    return time.time()-startTime
+
+def TimeScheduler(experimentDir, numSessions, plugin, plugin_args):
+    """ Returns the seconds to run a graph of numSessions independent stub BRAINSResample nodes """
+    import nipype.pipeline.engine as pe
+    from BRAINSTools import BRAINSResample
+    imageList=_local_sessionImages(experimentDir)
+    workflow=pe.Workflow(name='SchedulerLatency')
+    workflow.base_dir=os.path.join(experimentDir,'SchedulerCache')
+    for session in range(numSessions):
+        resample=pe.Node(interface=BRAINSResample(),name='Resample_{0:05d}'.format(session))
+        resample.inputs.inputVolume=imageList[session%len(imageList)]
+        resample.inputs.outputVolume='resampled.nii.gz'
+        workflow.add_nodes([resample])
+    startTime=time.time()
+    workflow.run(plugin=plugin,plugin_args=plugin_args)
+    return time.time()-startTime
+
+def _local_gitRevision():
+    try:
+        return subprocess.Popen(['git','rev-parse','HEAD'],stdout=subprocess.PIPE,stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+def BenchmarkSessions(baseDir, numSessions, WORKFLOW_COMPONENTS, plugin, plugin_args):
+    """ Returns [(measurement,seconds),...] for a synthetic experiment of numSessions sessions """
+    experimentDir=os.path.join(baseDir,'{0}_sessions'.format(numSessions))
+    ## One session per subject, so the graph build grows with the number of sessions.
+    sessionFile,atlasDir,bcdModelDir=MakeSyntheticExperiment(experimentDir,numSessions,1,WriteSyntheticVolume)
+    measurements=list()
+    ExperimentDatabase,buildSecs,querySecs=TimeSessionDB(experimentDir,sessionFile,numSessions)
+    measurements.append( ('sessiondb_build',buildSecs) )
+    measurements.append( ('sessiondb_query',querySecs) )
+    coldSecs,warmSecs=TimeHashing(experimentDir)
+    measurements.append( ('hash_cold',coldSecs) )
+    measurements.append( ('hash_warm',warmSecs) )
+    measurements.append( ('datasink_copy',TimeDataSink(experimentDir,numSessions)) )
+    measurements.append( ('scheduler_latency',TimeScheduler(experimentDir,numSessions,plugin,plugin_args)) )
+    if WORKFLOW_COMPONENTS is not None:
+        buildSecs,flattenSecs,nodeCount=TimeCohortGraphBuild(experimentDir,ExperimentDatabase,atlasDir,bcdModelDir,WORKFLOW_COMPONENTS)
+        measurements.append( ('graph_build',buildSecs) )
+        measurements.append( ('graph_flatten',flattenSecs) )
+    return measurements
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Times the overhead of AutoWorkup around the BRAINS tools with synthetic volumes and stub tools')
+    parser.add_argument('--sessionCounts', action='store', dest='sessionCounts', default='1,10,100,1000',
+                        help='Comma separated numbers of sessions to benchmark')
+    parser.add_argument('--components', action='store', dest='components', default="['BASIC','TISSUE_CLASSIFY','SEGMENTATION']",
+                        help='The WORKFLOW_COMPONENTS of the graph build measurement, None to skip it')
+    parser.add_argument('--stubSleep', action='store', dest='stubSleep', type=float, default=0.0,
+                        help='Seconds each stub BRAINS tool sleeps before copying its input')
+    parser.add_argument('--plugin', action='store', dest='plugin', default='Linear',
+                        help='The nipype plugin of the scheduler measurement, Linear, MultiProc or ResourceLimitedMultiProc')
+    parser.add_argument('--procs', action='store', dest='procs', type=int, default=4,
+                        help='The n_procs of the MultiProc plugins')
+    parser.add_argument('--output', action='store', dest='output', default=None,
+                        help='A csv file to append the measurements to')
+    input_arguments = parser.parse_args()
+
+    WORKFLOW_COMPONENTS=eval(input_arguments.components)
+    plugin=input_arguments.plugin
+    plugin_args=dict()
+    if plugin == 'ResourceLimitedMultiProc':
+        from ResourceLimitedMultiProc import ResourceLimitedMultiProcPlugin
+        plugin=ResourceLimitedMultiProcPlugin(plugin_args={'n_procs':input_arguments.procs})
+    elif plugin == 'MultiProc':
+        plugin_args={'n_procs':input_arguments.procs}
+
+    baseDir=tempfile.mkdtemp(prefix='BenchmarkPipelineOverhead_')
+    originalPath=os.environ.get('PATH','')
+    date=time.strftime('%Y-%m-%d %H:%M:%S')
+    revision=_local_gitRevision()
+    rows=list()
+    try:
+        InstallStubTools(os.path.join(baseDir,'bin'),input_arguments.stubSleep)
+        print("{0:>9s} {1:20s} {2:>10s} {3:>14s}".format('sessions','measurement','seconds','per session(s)'))
+        for numSessions in [ int(count) for count in input_arguments.sessionCounts.split(',') ]:
+            for measurement,seconds in BenchmarkSessions(baseDir,numSessions,WORKFLOW_COMPONENTS,plugin,plugin_args):
+                print("{0:9d} {1:20s} {2:10.3f} {3:14.5f}".format(numSessions,measurement,seconds,seconds/numSessions))
+                rows.append( dict(date=date,revision=revision,measurement=measurement,sessions=numSessions,
+                                  seconds=seconds,seconds_per_session=seconds/numSessions) )
+    finally:
+        os.environ['PATH']=originalPath
+        shutil.rmtree(baseDir,ignore_errors=True)
+    if input_arguments.output is not None:
+        writeHeader=not os.path.exists(input_arguments.output)
+        outputFile=open(input_arguments.output,'a')
+        dWriter=csv.DictWriter(outputFile,HISTORY_FIELDS,restval='', extrasaction='raise', dialect='excel')
+        if writeHeader:
+            dWriter.writeheader()
+        dWriter.writerows(rows)
+        outputFile.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Content hashing of node input files that is cheap enough to use on every run.
+
+A digest is computed once per file version and remembered in a sqlite table
+keyed by (device,inode,size,mtime), so unchanged multi hundred megabyte images are
+not read again on later graph traversals.  Digests that are missing are
+computed in a thread pool, one file per thread.
+
+The 'fastcontent' digest is the file size with the crc32 and adler32 of the
+content, which is much cheaper than md5.  It is installed behind nipype's
+own 'content' hash method, which nipype understands everywhere it hashes a
+file, so workflows select it with
+
+    workflow.config['execution']['hash_method']='content'
+    FastContentHash.AttachFastContentHash(workflow,cacheFileName)
+
+AttachFastContentHash() must be called after all nodes were added, because
+it tags each node so that the digest table is also installed in the remote
+python processes that unpickle the node to run it.  Processes without it
+compute md5 digests, which do not match, so their nodes would run again.
+"""
+import hashlib
+import os
+import zlib
+import sqlite3 as lite
+from multiprocessing.pool import ThreadPool
+
+FAST_CONTENT_HASH_METHOD = 'fastcontent'
+READ_BLOCK_BYTES = 4*1024*1024
+
+def FastDigestFile(fileName):
+    """ size, crc32 and adler32 of the content of fileName, a non cryptographic digest """
+    crc=0
+    adler=1
+    size=0
+    fileHandle=open(fileName,'rb')
+    try:
+        block=fileHandle.read(READ_BLOCK_BYTES)
+        while block:
+            crc=zlib.crc32(block,crc)
+            adler=zlib.adler32(block,adler)
+            size+=len(block)
+            block=fileHandle.read(READ_BLOCK_BYTES)
+    finally:
+        fileHandle.close()
+    return '{0:x}-{1:08x}{2:08x}'.format(size,crc & 0xffffffff,adler & 0xffffffff)
+
+def SHA1DigestFile(fileName):
+    """ sha1 of the content of fileName """
+    digest=hashlib.sha1()
+    fileHandle=open(fileName,'rb')
+    try:
+        block=fileHandle.read(READ_BLOCK_BYTES)
+        while block:
+            digest.update(block)
+            block=fileHandle.read(READ_BLOCK_BYTES)
+    finally:
+        fileHandle.close()
+    return digest.hexdigest()
+
+DIGEST_FUNCTIONS = { FAST_CONTENT_HASH_METHOD: FastDigestFile, 'sha1': SHA1DigestFile }
+
+class ContentHashService():
+    """
+    Digests of files, remembered by (device,inode,size,mtime).  Inode numbers are only unique
+    within one file system, so the same inode on two NFS or scratch mounts are different files.
+    The sqlite connection is opened lazily per process, so an instance may be shared with
+    forked workers.
+    """
+    def __init__(self, dbFileName, numThreads=8):
+        ## The ContentDigests table of older versions has no device column, so it is not read.
+        self.TableName = "DeviceContentDigests"
+        self.dbName = dbFileName
+        self.numThreads = max(1,int(numThreads))
+        self.connection = None
+        self.connectionPid = None
+
+    def _local_openDB(self):
+        if self.connection is not None and self.connectionPid == os.getpid():
+            return self.connection
+        self.connection=lite.connect(self.dbName,timeout=60)
+        self.connectionPid=os.getpid()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(device INT, inode INT, size INT, mtime REAL, method TEXT, digest TEXT, "
+          "PRIMARY KEY (device, inode, size, mtime, method));".format(_tablename=self.TableName))
+        self.connection.commit()
+        return self.connection
+
+    def Digest(self, fileName, method=FAST_CONTENT_HASH_METHOD):
+        return self.Digests([fileName],method)[fileName]
+
+    def Digests(self, fileList, method=FAST_CONTENT_HASH_METHOD):
+        """ Returns {fileName: digest}, with None for files that do not exist """
+        digestFunction=DIGEST_FUNCTIONS[method]
+        connection=self._local_openDB()
+        digests=dict()
+        toCompute=list()
+        for fileName in set(fileList):
+            try:
+                st=os.stat(fileName)
+            except OSError:
+                digests[fileName]=None
+                continue
+            identity=(st.st_dev,st.st_ino,st.st_size,st.st_mtime)
+            row=connection.execute("SELECT digest FROM {_tablename} WHERE device=? AND inode=? AND size=? AND mtime=? AND method=?;".format(
+              _tablename=self.TableName),identity+(method,)).fetchone()
+            if row is not None:
+                digests[fileName]=row[0]
+            else:
+                toCompute.append( (fileName,identity) )
+        if len(toCompute) == 1 or self.numThreads == 1:
+            computed=[ digestFunction(fileName) for fileName,identity in toCompute ]
+        elif len(toCompute) > 1:
+            pool=ThreadPool(min(self.numThreads,len(toCompute)))
+            try:
+                computed=pool.map(digestFunction,[ fileName for fileName,identity in toCompute ])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            computed=list()
+        newRows=list()
+        for (fileName,identity),digest in zip(toCompute,computed):
+            digests[fileName]=digest
+            newRows.append( identity+(method,digest) )
+        if len(newRows) > 0:
+            try:
+                with connection:
+                    connection.executemany("INSERT OR REPLACE INTO {_tablename}(device, inode, size, mtime, method, digest) "
+                      "VALUES (?, ?, ?, ?, ?, ?);".format(_tablename=self.TableName),newRows)
+            except lite.OperationalError, err:
+                ## The table is only an accelerator, a busy database must not fail the node.
+                print("WARNING: Could not remember digests in {0}: {1}".format(self.dbName,err))
+        return digests
+
+_CONTENT_HASH_SERVICE = None
+_ORIGINAL_GET_HASHVAL = None
+
+def _local_hashInfile(afile, chunk_len=8192):
+    """ Replaces nipype's hash_infile, the remembered fastcontent digest instead of a fresh md5 """
+    if not os.path.isfile(afile):
+        return None
+    return _CONTENT_HASH_SERVICE.Digest(afile)
+
+def _local_collectFiles(value, fileList):
+    """ The existing files that BaseTraitedSpec._get_sorteddict will hash in value """
+    if isinstance(value,dict):
+        for item in value.values():
+            _local_collectFiles(item,fileList)
+    elif isinstance(value,(list,tuple)):
+        for item in value:
+            _local_collectFiles(item,fileList)
+    elif isinstance(value,str) and os.path.isfile(value):
+        fileList.append(value)
+
+def _local_getHashval(self, hash_method=None):
+    """ Replaces BaseTraitedSpec.get_hashval, and digests every input file at once so that the misses are computed in parallel """
+    from nipype import config
+    from nipype.interfaces.base import isdefined, has_metadata
+    if hash_method is None:
+        hash_method=config.get('execution','hash_method')
+    if hash_method.lower() == 'content':
+        fileList=list()
+        for name,val in self.get().items():
+            if isdefined(val) and not has_metadata(self.trait(name).trait_type,"hash_files",False):
+                _local_collectFiles(val,fileList)
+        _CONTENT_HASH_SERVICE.Digests(fileList)
+    return _ORIGINAL_GET_HASHVAL(self,hash_method)
+
+def InstallFastContentHash(dbFileName):
+    """ Back nipype's 'content' hash method in this process with the digest table in dbFileName """
+    global _CONTENT_HASH_SERVICE,_ORIGINAL_GET_HASHVAL
+    import nipype.interfaces.base as nib
+    import nipype.utils.filemanip as nfm
+    if _CONTENT_HASH_SERVICE is None or _CONTENT_HASH_SERVICE.dbName != dbFileName:
+        _CONTENT_HASH_SERVICE=ContentHashService(dbFileName)
+    if _ORIGINAL_GET_HASHVAL is None:
+        _ORIGINAL_GET_HASHVAL=nib.BaseTraitedSpec.get_hashval
+        nib.BaseTraitedSpec.get_hashval=_local_getHashval
+        ## Node hashes and the copyfile checks both look hash_infile up in these two modules.
+        nib.hash_infile=_local_hashInfile
+        nfm.hash_infile=_local_hashInfile
+
+class FastContentHashInstaller(object):
+    """ Carried by each node, unpickling it installs the fastcontent digests in that process """
+    def __init__(self, dbFileName):
+        self.dbFileName=dbFileName
+        InstallFastContentHash(self.dbFileName)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        InstallFastContentHash(self.dbFileName)
+
+def AttachFastContentHash(workflow, dbFileName):
+    """ Install the fastcontent digests here and in every process that runs a node of workflow """
+    installer=FastContentHashInstaller(dbFileName)
+    for node in workflow._get_all_nodes():
+        node.fast_content_hash_installer=installer
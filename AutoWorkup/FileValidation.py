@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+import os
+import sqlite3 as lite
+from multiprocessing.pool import ThreadPool
+
+## The number of bytes read to prove that a file is readable.
+READ_CHECK_BYTES = 352
+
+def StatImageFile(imagePath):
+    """ Returns (status,mtime,size) for imagePath, status is None when the file is usable """
+    try:
+        st=os.stat(imagePath)
+    except OSError:
+        return 'Missing File',None,None
+    if st.st_size == 0:
+        return 'Empty File',st.st_mtime,st.st_size
+    return None,st.st_mtime,st.st_size
+
+def ReadCheckImageFile(imagePath):
+    """ Returns None when the first bytes of imagePath can be read """
+    try:
+        imageFile=open(imagePath,'rb')
+        imageFile.read(READ_CHECK_BYTES)
+        imageFile.close()
+    except IOError:
+        return 'Unreadable File'
+    return None
+
+def CheckImageFile(imagePath):
+    """ The serial existence, size and read check for one file """
+    status,mtime,size=StatImageFile(imagePath)
+    if status is None:
+        status=ReadCheckImageFile(imagePath)
+    return status
+
+class FileValidator():
+    """
+    Check that many image files exist, are not empty, and are readable.
+
+    The stat and read checks run through a bounded thread pool because
+    each one is a network round trip on cluster file systems.  A persistent
+    (path,mtime,size) table records files that already passed, so only
+    files that are new or changed on disk are opened again on later runs.
+    """
+    def __init__(self, cacheFileName=None, numThreads=8):
+        self.TableName = "FileValidationCache"
+        self.cacheFileName = cacheFileName
+        self.numThreads = max(1,int(numThreads))
+        self.connection = None
+        if self.cacheFileName is not None:
+            self.connection = lite.connect(self.cacheFileName)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(path TEXT PRIMARY KEY, mtime REAL, size INT);".format(
+              _tablename=self.TableName))
+            self.connection.commit()
+
+    def _local_getCached(self):
+        if self.connection is None:
+            return dict()
+        cached=dict()
+        for path,mtime,size in self.connection.execute("SELECT path, mtime, size FROM {_tablename};".format(_tablename=self.TableName)):
+            cached[path]=(mtime,size)
+        return cached
+
+    def _local_map(self, function, argList):
+        if self.numThreads == 1 or len(argList) < 2:
+            return map(function, argList)
+        pool=ThreadPool(min(self.numThreads,len(argList)))
+        try:
+            return pool.map(function, argList)
+        finally:
+            pool.close()
+            pool.join()
+
+    def ValidateFiles(self, pathList):
+        """ Returns a dictionary of path:status, where status is None for usable files """
+        uniquePaths=list(set(pathList))
+        statResults=dict(zip(uniquePaths,self._local_map(StatImageFile,uniquePaths)))
+        cached=self._local_getCached()
+        fileStatus=dict()
+        readCheckPaths=list()
+        for path in uniquePaths:
+            status,mtime,size=statResults[path]
+            fileStatus[path]=status
+            if status is None and cached.get(path) != (mtime,size):
+                readCheckPaths.append(path)
+        readResults=dict(zip(readCheckPaths,self._local_map(ReadCheckImageFile,readCheckPaths)))
+        passedList=list()
+        for path in readCheckPaths:
+            fileStatus[path]=readResults[path]
+            if readResults[path] is None:
+                status,mtime,size=statResults[path]
+                passedList.append( (path,mtime,size) )
+        if self.connection is not None:
+            with self.connection:
+                self.connection.executemany("DELETE FROM {_tablename} WHERE path=?;".format(_tablename=self.TableName),
+                  [ (path,) for path in uniquePaths if fileStatus[path] is not None ])
+                self.connection.executemany("INSERT OR REPLACE INTO {_tablename}(path, mtime, size) VALUES (?, ?, ?);".format(
+                  _tablename=self.TableName), passedList)
+        return fileStatus
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+The one place that decides the file format of the images AutoWorkup writes.
+
+Images that are only read by later nodes of the graph are written with
+INTERMEDIATE_IMAGE_EXTENSION, uncompressed NIfTI by default, because
+single threaded gzip dominates the run time of the short nodes.  Images
+leave the graph through a CompressingDataSink, which stores every .nii
+file it is given as FINAL_IMAGE_EXTENSION, so the results directories keep
+their .nii.gz files.
+
+Node output names are made with
+
+    BFitAtlasToSubject.inputs.outputVolume=ImageFormatPolicy.IntermediateImageName("Trial_Initializer_Output")
+"""
+import gzip
+import os
+import shutil
+import subprocess
+
+import nipype.interfaces.io as nio
+from nipype.interfaces.base import TraitedSpec, traits, isdefined
+from nipype.utils.filemanip import copyfile, filename_to_list
+
+## Set to '.nii.gz' to compress every intermediate image again.
+INTERMEDIATE_IMAGE_EXTENSION = '.nii'
+FINAL_IMAGE_EXTENSION = '.nii.gz'
+
+def IntermediateImageName(baseName):
+    """ The file name of an image that is only consumed inside the graph """
+    return baseName+INTERMEDIATE_IMAGE_EXTENSION
+
+def StripImageExtension(fileName):
+    """ fileName without a trailing .nii.gz or .nii """
+    for extension in ('.nii.gz','.nii'):
+        if fileName.endswith(extension):
+            return fileName[:-len(extension)]
+    return fileName
+
+def _local_findPigz():
+    for pathDir in os.environ.get('PATH','').split(os.pathsep):
+        candidate=os.path.join(pathDir,'pigz')
+        if os.path.isfile(candidate) and os.access(candidate,os.X_OK):
+            return candidate
+    return None
+
+def CompressImageFile(source, destination):
+    """ gzip source to destination, with the parallel pigz when it is installed """
+    if os.path.exists(destination) and os.path.getmtime(destination) >= os.path.getmtime(source):
+        return destination
+    partial=destination+'.partial'
+    pigz=_local_findPigz()
+    outFile=open(partial,'wb')
+    try:
+        if pigz is not None:
+            subprocess.check_call([pigz,'-c','-6',source],stdout=outFile)
+        else:
+            compressor=gzip.GzipFile(fileobj=outFile,mode='wb',compresslevel=6)
+            inFile=open(source,'rb')
+            shutil.copyfileobj(inFile,compressor,4*1024*1024)
+            inFile.close()
+            compressor.close()
+    finally:
+        outFile.close()
+    os.rename(partial,destination)
+    return destination
+
+class CompressingDataSinkInputSpec(nio.DataSinkInputSpec):
+    def __getattr__(self, key):
+        ## Workflow.connect only skips its input name check for the classes of nipype.interfaces.io,
+        #  so the 'folder.@name' fields that a DataSink creates on demand are reported here.
+        if '.' not in key:
+            raise AttributeError(key)
+        return self._outputs.get(key,nio.Undefined)
+
+class CompressingDataSinkOutputSpec(TraitedSpec):
+    out_file = traits.Any(desc='the files the sink stored, with the names they have on disk')
+
+def _local_makeDirectory(path):
+    """ os.makedirs that tolerates another sink creating path at the same time """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+class CompressingDataSink(nio.DataSink):
+    """
+    A DataSink that stores each uncompressed .nii image it sinks as .nii.gz, and reports the
+    stored files in out_file.  Everything else is stored as DataSink stores it.
+    """
+    input_spec = CompressingDataSinkInputSpec
+    output_spec = CompressingDataSinkOutputSpec
+
+    def _list_outputs(self):
+        ## The folder layout and substitutions of DataSink._list_outputs, with the copies made by this sink.
+        outdir=self.inputs.base_directory
+        if not isdefined(outdir):
+            outdir='.'
+        outdir=os.path.abspath(outdir)
+        if isdefined(self.inputs.container):
+            outdir=os.path.join(outdir,self.inputs.container)
+        _local_makeDirectory(outdir)
+        storedFiles=list()
+        for key,files in self.inputs._outputs.items():
+            if not isdefined(files):
+                continue
+            tempoutdir=outdir
+            for folder in key.split('.'):
+                if folder[0] == '@':
+                    continue
+                tempoutdir=os.path.join(tempoutdir,folder)
+            files=filename_to_list(files)
+            if isinstance(files[0],list):
+                files=[ item for sublist in files for item in sublist ]
+            for src in filename_to_list(files):
+                src=os.path.abspath(src)
+                if os.path.isfile(src):
+                    dst=self._substitute(os.path.join(tempoutdir,self._get_dst(src)))
+                    _local_makeDirectory(os.path.dirname(dst))
+                    storedFiles.append(self._local_storeFile(src,dst))
+                elif os.path.isdir(src):
+                    dst=self._substitute(os.path.join(tempoutdir,self._get_dst(os.path.join(src,''))))
+                    _local_makeDirectory(os.path.dirname(dst))
+                    if os.path.exists(dst) and self.inputs.remove_dest_dir:
+                        shutil.rmtree(dst)
+                    storedFiles.extend(self._local_storeTree(src,dst))
+        outputs=self._outputs().get()
+        outputs['out_file']=storedFiles
+        return outputs
+
+    def _local_storeFile(self, src, dst):
+        """ Copies src to dst, or compresses it when both are .nii, and returns the name it got on disk """
+        if src.endswith('.nii') and dst.endswith('.nii'):
+            return CompressImageFile(src,StripImageExtension(dst)+FINAL_IMAGE_EXTENSION)
+        copyfile(src,dst,copy=True,hashmethod='content')
+        return dst
+
+    def _local_storeTree(self, src, dst):
+        """ Stores every file below the directory src under dst, returns the stored names """
+        _local_makeDirectory(dst)
+        storedFiles=list()
+        for name in sorted(os.listdir(src)):
+            srcname=os.path.join(src,name)
+            dstname=os.path.join(dst,name)
+            if os.path.isdir(srcname):
+                storedFiles.extend(self._local_storeTree(srcname,dstname))
+            else:
+                storedFiles.append(self._local_storeFile(srcname,dstname))
+        return storedFiles
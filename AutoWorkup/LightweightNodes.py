@@ -0,0 +1,165 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Execution of the small SimpleITK helper Function nodes in warm processes.
+
+Nodes like ClipT1ImageWithBrainMask only multiply a few volumes, and for
+them a queue round trip, the python start up and the SimpleITK import of a
+fresh worker cost more than the work itself.  None of the lightweight nodes
+is run in a scheduler loop:
+
+  * the ResourceLimitedMultiProcPlugin and the LightweightSGEPlugin run it in
+    a separate pool of long lived worker processes that imported SimpleITK
+    and numpy when they started.  For the LightweightSGEPlugin that pool is
+    on the submit host, so the node never waits in the queue.
+  * the LightweightSGEGraphPlugin fuses it into the job of the node that
+    produced its last input, so it runs right after that node in the same
+    process and needs no job of its own.
+  * the plain nipype plugins submit it as an ordinary single threaded job
+    with LIGHTWEIGHT_MEMORY_MB.
+
+The node still runs through node.run(), so its result is cached and reused
+exactly like the result of any other node.
+
+    ClipNode=pe.Node(interface=Function(function=ClipT1ImageWithBrainMask,...),name='Clip')
+    LightweightNodes.MarkLightweightNode(ClipNode)
+    baw200.run(plugin=LightweightNodes.LightweightSGEPlugin(plugin_args=dict(template=JOB_SCRIPT)))
+"""
+import os
+from multiprocessing import Pool
+
+import networkx as nx
+from nipype.pipeline.plugins.base import create_pyscript
+from nipype.pipeline.plugins.multiproc import run_node
+from nipype.pipeline.plugins.sge import SGEPlugin
+from nipype.pipeline.plugins.sgegraph import SGEGraphPlugin
+
+## The key of node.plugin_args that marks a lightweight node.
+LIGHTWEIGHT_PLUGIN_ARG = 'lightweight'
+## The memory a lightweight node is expected to use, a few float volumes.
+LIGHTWEIGHT_MEMORY_MB = 2000
+## The number of warm worker processes the LightweightSGEPlugin keeps on the submit host.
+LIGHTWEIGHT_PROCS = 2
+
+## Runs the node scripts of one LightweightSGEGraphPlugin job one after the other in the same python.
+FUSED_PYSCRIPT = """## The node script of a job followed by the lightweight nodes fused into it, see LightweightNodes.
+for pyscript in {pyscripts!r}:
+    execfile(pyscript,{{'__name__':'__main__'}})
+"""
+
+def MarkLightweightNode(node, memory_mb=LIGHTWEIGHT_MEMORY_MB):
+    """ Run node in a warm worker process, see the module documentation """
+    plugin_args=dict(getattr(node,'plugin_args',None) or dict())
+    plugin_args.update( { LIGHTWEIGHT_PLUGIN_ARG:True, 'min_threads':1, 'max_threads':1, 'memory_mb':memory_mb } )
+    node.plugin_args=plugin_args
+    return node
+
+def IsLightweightNode(node):
+    return bool((getattr(node,'plugin_args',None) or dict()).get(LIGHTWEIGHT_PLUGIN_ARG,False))
+
+def WarmLightweightWorker():
+    """ Pool initializer, pays the imports of the helper functions once per worker """
+    for moduleName in ('numpy','SimpleITK'):
+        try:
+            __import__(moduleName)
+        except ImportError:
+            pass ## The node reports the missing module when it runs.
+
+class LightweightSGEPlugin(SGEPlugin):
+    """
+    The nipype SGE plugin, except that lightweight nodes run in warm worker processes on the submit host
+    instead of being submitted with qsub.  The plugin_args are those of the SGE plugin, and
+      lightweight_procs : worker processes for lightweight nodes (default: LIGHTWEIGHT_PROCS)
+    """
+    def __init__(self, **kwargs):
+        super(LightweightSGEPlugin, self).__init__(**kwargs)
+        plugin_args=kwargs.get('plugin_args',None) or dict()
+        self.lightweight_procs=int(plugin_args.get('lightweight_procs',LIGHTWEIGHT_PROCS))
+        self._lightweightPool=None
+        ## Negative task ids, which qsub never hands out, of the nodes running in the pool.
+        self._lightweightResults=dict()
+        self._lightweightTaskId=0
+
+    def __getstate__(self):
+        ## Workflow.run hands every MapNode its plugin, so the plugin is pickled with the MapNode
+        #  jobs.  The worker pool only belongs to the scheduler.
+        state=self.__dict__.copy()
+        state['_lightweightPool']=None
+        state['_lightweightResults']=dict()
+        return state
+
+    def run(self, graph, config, updatehash=False):
+        self._lightweightPool=Pool(processes=self.lightweight_procs,initializer=WarmLightweightWorker)
+        try:
+            super(LightweightSGEPlugin, self).run(graph, config, updatehash=updatehash)
+        finally:
+            self._lightweightPool.close()
+            self._lightweightPool.join()
+            self._lightweightPool=None
+
+    def _submit_job(self, node, updatehash=False):
+        if not IsLightweightNode(node):
+            return super(LightweightSGEPlugin, self)._submit_job(node, updatehash=updatehash)
+        self._lightweightTaskId-=1
+        self._lightweightResults[self._lightweightTaskId]=self._lightweightPool.apply_async(run_node,(node,updatehash))
+        return self._lightweightTaskId
+
+    def _get_result(self, taskid):
+        if taskid not in self._lightweightResults:
+            return super(LightweightSGEPlugin, self)._get_result(taskid)
+        if not self._lightweightResults[taskid].ready():
+            return None
+        return self._lightweightResults[taskid].get()
+
+    def _clear_task(self, taskid):
+        if taskid in self._lightweightResults:
+            del self._lightweightResults[taskid]
+        else:
+            super(LightweightSGEPlugin, self)._clear_task(taskid)
+
+class LightweightSGEGraphPlugin(SGEGraphPlugin):
+    """
+    The nipype SGEGraph plugin, except that a lightweight node runs at the end of the job of its
+    predecessor that was submitted last instead of in a job of its own.  That job also waits for the
+    other predecessors of the lightweight node.  A lightweight node without predecessors keeps its job.
+    """
+    def run(self, graph, config, updatehash=False):
+        self._config=config
+        nodes=nx.topological_sort(graph)
+        ## The node scripts and the dependencies of each job.  A job only depends on jobs created before it.
+        jobScripts=list()
+        jobDependencies=list()
+        jobOfNode=dict()
+        for node in nodes:
+            pyscript=create_pyscript(node,updatehash=updatehash,store_exception=False)
+            predecessorJobs=set([ jobOfNode[predecessor] for predecessor in graph.predecessors(node) ])
+            if IsLightweightNode(node) and len(predecessorJobs) > 0:
+                hostJob=max(predecessorJobs)
+                jobScripts[hostJob].append(pyscript)
+                jobDependencies[hostJob].update(predecessorJobs-set([hostJob]))
+                jobOfNode[node]=hostJob
+            else:
+                jobOfNode[node]=len(jobScripts)
+                jobScripts.append([pyscript])
+                jobDependencies.append(predecessorJobs)
+        pyfiles=[ _local_fusePyscripts(pyscripts) for pyscripts in jobScripts ]
+        self._submit_graph(pyfiles,dict([ (job,sorted(dependencies)) for job,dependencies in enumerate(jobDependencies) ]))
+
+def _local_fusePyscripts(pyscripts):
+    """ Returns the script of a job that runs all of pyscripts, the first one is the node the others waited for """
+    if len(pyscripts) == 1:
+        return pyscripts[0]
+    batch_dir,name=os.path.split(pyscripts[0])
+    fusedPyscript=os.path.join(batch_dir,name.replace('pyscript_','pyscript_fused_',1))
+    open(fusedPyscript,'w').write(FUSED_PYSCRIPT.format(pyscripts=pyscripts))
+    return fusedPyscript
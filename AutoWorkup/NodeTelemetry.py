@@ -0,0 +1,229 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Per node execution measurements for AutoWorkup experiments.
+
+Every node execution records its wall time, cpu time, peak resident memory,
+granted threads, bytes read and written, and whether nipype found its result
+already cached.  The node dependency edges of each run are stored as well so
+that the critical path of each subject can be recovered afterwards.
+
+The measurements are taken by the ResourceLimitedMultiProcPlugin when it is
+given a 'telemetry_db' plugin argument, and reported with
+
+    baw_exp.py ... --telemetryReport 20
+"""
+import os
+import re
+import resource
+import sys
+import time
+import sqlite3 as lite
+
+def GetIOBytes():
+    """ (read_bytes,write_bytes) of this process and its reaped children """
+    try:
+        counters=dict()
+        for line in open('/proc/self/io'):
+            key,value=line.split(':')
+            counters[key.strip()]=int(value)
+        return counters['read_bytes'],counters['write_bytes']
+    except (IOError,KeyError,ValueError):
+        ## No /proc on OSX, fall back to the block counts.
+        self_usage=resource.getrusage(resource.RUSAGE_SELF)
+        child_usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (self_usage.ru_inblock+child_usage.ru_inblock)*512,(self_usage.ru_oublock+child_usage.ru_oublock)*512
+
+def GetCPUSeconds():
+    """ user+system time of this process and its reaped children """
+    self_usage=resource.getrusage(resource.RUSAGE_SELF)
+    child_usage=resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime+self_usage.ru_stime+child_usage.ru_utime+child_usage.ru_stime
+
+def IsCachedResult(node):
+    """ True when nipype will reuse an existing result for node, None if that can not be determined """
+    try:
+        return bool(node.hash_exists()[0])
+    except:
+        return None
+
+def GetSubnodeMapNode(fullname):
+    """ The fullname of the MapNode whose subnode was recorded as fullname, or None for other nodes.
+    The plugin records a subnode as the MapNode fullname followed by '._<MapNode name><index>'. """
+    if '.' not in fullname:
+        return None
+    mapNodeName,subnodeName=fullname.rsplit('.',1)
+    if re.match('^_'+re.escape(mapNodeName.rsplit('.',1)[-1])+r'\d+$',subnodeName) is None:
+        return None
+    return mapNodeName
+
+class NodeCounters():
+    """ Take a snapshot before a node runs, and call Finish() after it ran """
+    def __init__(self):
+        self.start_time=time.time()
+        self.cpu_start=GetCPUSeconds()
+        self.read_start,self.write_start=GetIOBytes()
+
+    def Finish(self):
+        read_end,write_end=GetIOBytes()
+        end_time=time.time()
+        return dict(start_time=self.start_time,end_time=end_time,
+                    wall_secs=end_time-self.start_time,
+                    cpu_secs=GetCPUSeconds()-self.cpu_start,
+                    read_bytes=read_end-self.read_start,
+                    write_bytes=write_end-self.write_start)
+
+class NodeTelemetryDB():
+    def __init__(self, dbFileName):
+        self.TableName = "NodeTelemetry"
+        self.EdgeTableName = "NodeEdges"
+        self.dbName = dbFileName
+        self.connection = lite.connect(self.dbName)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(run_id INT, subject TEXT, node_name TEXT, fullname TEXT, "
+          "start_time REAL, end_time REAL, wall_secs REAL, cpu_secs REAL, peak_mb REAL, threads INT, "
+          "read_bytes INT, write_bytes INT, cache_hit INT, status TEXT);".format(_tablename=self.TableName))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(run_id INT, parent TEXT, child TEXT);".format(
+          _tablename=self.EdgeTableName))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {_tablename}_run ON {_tablename}(run_id, subject);".format(
+          _tablename=self.TableName))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {_tablename}_run ON {_tablename}(run_id);".format(
+          _tablename=self.EdgeTableName))
+        self.connection.commit()
+
+    def NewRun(self, edgeList):
+        """ Returns a new run_id, and stores the (parent,child) fullname edges of its graph """
+        run_id=(self.connection.execute("SELECT MAX(run_id) FROM {_tablename};".format(_tablename=self.TableName)).fetchone()[0] or 0)
+        run_id=max(run_id,self.connection.execute("SELECT MAX(run_id) FROM {_tablename};".format(_tablename=self.EdgeTableName)).fetchone()[0] or 0)+1
+        with self.connection:
+            self.connection.executemany("INSERT INTO {_tablename}(run_id, parent, child) VALUES (?, ?, ?);".format(
+              _tablename=self.EdgeTableName), [ (run_id,parent,child) for parent,child in edgeList ])
+        return run_id
+
+    def RecordNode(self, run_id, subject, node_name, fullname, measurements, peak_mb, threads, cache_hit, status):
+        with self.connection:
+            self.connection.execute("INSERT INTO {_tablename}(run_id, subject, node_name, fullname, start_time, end_time, "
+              "wall_secs, cpu_secs, peak_mb, threads, read_bytes, write_bytes, cache_hit, status) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);".format(_tablename=self.TableName),
+              (run_id,subject,node_name,fullname,measurements['start_time'],measurements['end_time'],
+               measurements['wall_secs'],measurements['cpu_secs'],peak_mb,threads,
+               measurements['read_bytes'],measurements['write_bytes'],cache_hit,status))
+
+    def getHotNodes(self, topN=20):
+        """ The node names with the largest total wall time across all subjects and runs """
+        return self.connection.execute("SELECT node_name, COUNT(*), SUM(wall_secs), AVG(wall_secs), SUM(cpu_secs), MAX(peak_mb), "
+          "SUM(read_bytes), SUM(write_bytes), SUM(cache_hit) FROM {_tablename} "
+          "GROUP BY node_name ORDER BY SUM(wall_secs) DESC LIMIT ?;".format(_tablename=self.TableName),(topN,)).fetchall()
+
+    def getCriticalPath(self, run_id, subject):
+        """ Returns (total_wall_secs,[(fullname,wall_secs),...]) of the longest wall time chain of subject in run_id.
+        The subnodes of an expanded MapNode have no edges, so they count towards their MapNode, which takes
+        from the start of its first subnode to the end of its collation. """
+        wallTime=dict()
+        mapNodeSpan=dict()
+        for fullname,start_time,end_time,wall_secs in self.connection.execute("SELECT fullname, start_time, end_time, wall_secs "
+          "FROM {_tablename} WHERE run_id=? AND subject=?;".format(_tablename=self.TableName),(run_id,subject)):
+            mapNodeName=GetSubnodeMapNode(fullname)
+            if mapNodeName is None:
+                wallTime[fullname]=wallTime.get(fullname,0.0)+wall_secs
+                continue
+            ## The MapNode record is its collation, the subnodes ran before it.
+            firstStart,lastEnd=mapNodeSpan.get(mapNodeName,(start_time,end_time))
+            mapNodeSpan[mapNodeName]=(min(firstStart,start_time),max(lastEnd,end_time))
+        for fullname,(firstStart,lastEnd) in mapNodeSpan.items():
+            collationEnd=self.connection.execute("SELECT MAX(end_time) FROM {_tablename} WHERE run_id=? AND fullname=?;".format(
+              _tablename=self.TableName),(run_id,fullname)).fetchone()[0]
+            wallTime[fullname]=max(lastEnd,collationEnd or lastEnd)-firstStart
+        parents=dict([ (fullname,list()) for fullname in wallTime.keys() ])
+        for parent,child in self.connection.execute("SELECT parent, child FROM {_tablename} WHERE run_id=?;".format(
+          _tablename=self.EdgeTableName),(run_id,)):
+            if parent in wallTime and child in wallTime:
+                parents[child].append(parent)
+        ## Longest path through the DAG, memoized from the sinks back to the sources.
+        longest=dict()
+        def LongestEndingAt(fullname):
+            if fullname not in longest:
+                best=(0.0,None)
+                for parent in parents[fullname]:
+                    candidate=LongestEndingAt(parent)[0]
+                    if candidate > best[0] or best[1] is None:
+                        best=(candidate,parent)
+                longest[fullname]=(best[0]+wallTime[fullname],best[1])
+            return longest[fullname]
+        sys.setrecursionlimit(max(sys.getrecursionlimit(),len(wallTime)+100))
+        if len(wallTime) == 0:
+            return 0.0,list()
+        end=max(wallTime.keys(),key=lambda fullname: LongestEndingAt(fullname)[0])
+        total=longest[end][0]
+        path=list()
+        while end is not None:
+            path.append( (end,wallTime[end]) )
+            end=longest[end][1]
+        path.reverse()
+        return total,path
+
+    def getNodeHistory(self):
+        """ {node_name: (runs,mean wall_secs,mean threads,max peak_mb,mean write_bytes)} of the executions that were not cached """
+        history=dict()
+        for row in self.connection.execute("SELECT node_name, COUNT(*), AVG(wall_secs), AVG(threads), MAX(peak_mb), AVG(write_bytes) "
+          "FROM {_tablename} WHERE status='ok' AND (cache_hit IS NULL OR cache_hit=0) GROUP BY node_name;".format(
+          _tablename=self.TableName)):
+            history[row[0]]=row[1:]
+        return history
+
+    def getMapNodeHistory(self):
+        """ {MapNode name: (runs,mean items,mean wall_secs,mean threads,max peak_mb,mean write_bytes)} of the
+        subnodes that were not cached, the wall time, threads and bytes are per item """
+        items=dict()
+        history=dict()
+        for run_id,fullname,wall_secs,threads,peak_mb,write_bytes in self.connection.execute("SELECT run_id, fullname, wall_secs, "
+          "threads, peak_mb, write_bytes FROM {_tablename} WHERE status='ok' AND (cache_hit IS NULL OR cache_hit=0);".format(
+          _tablename=self.TableName)):
+            mapNodeFullname=GetSubnodeMapNode(fullname)
+            if mapNodeFullname is None:
+                continue
+            mapNodeName=mapNodeFullname.rsplit('.',1)[-1]
+            items.setdefault(mapNodeName,dict())
+            items[mapNodeName][(run_id,mapNodeFullname)]=items[mapNodeName].get((run_id,mapNodeFullname),0)+1
+            history.setdefault(mapNodeName,list()).append( (wall_secs or 0.0,threads or 0,peak_mb,write_bytes or 0) )
+        mapNodeHistory=dict()
+        for mapNodeName,samples in history.items():
+            peaks=[ peak_mb for wall_secs,threads,peak_mb,write_bytes in samples if peak_mb is not None ]
+            mapNodeHistory[mapNodeName]=(len(items[mapNodeName]),
+              sum(items[mapNodeName].values())/float(len(items[mapNodeName])),
+              sum([ sample[0] for sample in samples ])/len(samples),
+              sum([ sample[1] for sample in samples ])/float(len(samples)),
+              max(peaks or [None]),
+              sum([ sample[3] for sample in samples ])/float(len(samples)))
+        return mapNodeHistory
+
+    def getLatestRunSubjects(self):
+        """ (run_id,subject) of the most recent run of each subject """
+        return self.connection.execute("SELECT MAX(run_id), subject FROM {_tablename} GROUP BY subject ORDER BY subject;".format(
+          _tablename=self.TableName)).fetchall()
+
+def PrintTelemetryReport(dbFileName, topN=20):
+    if not os.path.exists(dbFileName):
+        print("No node telemetry recorded yet in {0}".format(dbFileName))
+        return
+    telemetry=NodeTelemetryDB(dbFileName)
+    print("Top {0} nodes by total wall time across subjects".format(topN))
+    print("{0:40s} {1:>6s} {2:>10s} {3:>10s} {4:>10s} {5:>9s} {6:>9s} {7:>9s} {8:>6s}".format(
+      'node','runs','wall(s)','mean(s)','cpu(s)','peak(MB)','read(MB)','write(MB)','cached'))
+    for node_name,count,wall,mean,cpu,peak,read,write,cached in telemetry.getHotNodes(topN):
+        print("{0:40s} {1:6d} {2:10.1f} {3:10.1f} {4:10.1f} {5:9.0f} {6:9.1f} {7:9.1f} {8:6d}".format(
+          node_name,count,wall,mean,cpu,peak or 0,(read or 0)/1048576.0,(write or 0)/1048576.0,cached or 0))
+    for run_id,subject in telemetry.getLatestRunSubjects():
+        total,path=telemetry.getCriticalPath(run_id,subject)
+        print("\nCritical path of subject {0} (run {1}): {2:.1f}s".format(subject,run_id,total))
+        for fullname,wall_secs in path:
+            print("    {0:10.1f}s  {1}".format(wall_secs,fullname))
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Checks and cost estimates of a fully built workflow graph, without running it.
+
+    baw_exp.py ... --dry-run
+
+builds the graphs of the selected subjects and reports
+
+  * connections from IdentityInterface fields that are neither set nor fed,
+    and mandatory inputs that are neither set nor connected.
+  * DataGrabber keys, such as the atlas files of MakeAtlasNode, that match
+    no file on disk.
+  * the core hours, peak concurrent memory, scratch disk use and critical
+    path length predicted from the node telemetry of earlier runs.  Nodes
+    that were never measured count with their declared memory and no time.
+
+The predictions assume that no result is cached, so they are an upper bound
+for experiments that were already partly run.
+"""
+import glob
+import os
+
+import networkx as nx
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.utility import IdentityInterface
+import nipype.interfaces.io as nio
+from nipype.pipeline.engine import MapNode
+from nipype.utils.filemanip import filename_to_list
+
+from ResourceLimitedMultiProc import GetNodeResources
+from NodeTelemetry import NodeTelemetryDB
+
+def _local_sourceField(source):
+    """ The output name of a connection source, which may be a (name,function,args) tuple """
+    if isinstance(source,tuple):
+        return source[0]
+    return source
+
+def _local_nodeName(node):
+    return getattr(node,'fullname',None) or node.name
+
+def _local_connectedInputs(flatgraph):
+    """ {node: set of input names fed by a connection} """
+    connected=dict([ (node,set()) for node in flatgraph.nodes() ])
+    for parent,child,data in flatgraph.edges(data=True):
+        for source,destination in data.get('connect',[]):
+            connected[child].add(destination)
+    return connected
+
+def _local_isSetOrIterated(node, fieldName):
+    if isdefined(getattr(node.inputs,fieldName,None)):
+        return True
+    iterables=getattr(node,'iterables',None) or list()
+    if isinstance(iterables,tuple):
+        iterables=[iterables]
+    return fieldName in [ iterable[0] for iterable in iterables ]
+
+def CheckConnections(flatgraph):
+    """ Returns a list of error messages for inputs that will never be given a value """
+    errors=list()
+    connected=_local_connectedInputs(flatgraph)
+    for parent,child,data in flatgraph.edges(data=True):
+        if not isinstance(parent._interface,IdentityInterface):
+            continue
+        for source,destination in data.get('connect',[]):
+            fieldName=_local_sourceField(source)
+            if fieldName not in connected[parent] and not _local_isSetOrIterated(parent,fieldName):
+                errors.append("{0}.{1} is never set, but feeds {2}.{3}".format(
+                  _local_nodeName(parent),fieldName,_local_nodeName(child),destination))
+    for node in flatgraph.nodes():
+        for inputName in sorted(node.inputs.traits(mandatory=True).keys()):
+            if inputName not in connected[node] and not isdefined(getattr(node.inputs,inputName)):
+                errors.append("{0}.{1} is mandatory, but is neither set nor connected".format(_local_nodeName(node),inputName))
+    return errors
+
+def CheckDataGrabbers(flatgraph):
+    """ Returns a list of error messages for DataGrabber keys that match no file """
+    errors=list()
+    connected=_local_connectedInputs(flatgraph)
+    for node in flatgraph.nodes():
+        if not isinstance(node._interface,nio.DataGrabber):
+            continue
+        inputs=node.inputs
+        if len(connected[node]) > 0:
+            ## The templates are completed at run time by the connected inputs.
+            continue
+        field_template=dict()
+        if isdefined(inputs.field_template):
+            field_template=inputs.field_template
+        template_args=dict()
+        if isdefined(inputs.template_args):
+            template_args=inputs.template_args
+        base_directory=''
+        if isdefined(inputs.base_directory):
+            base_directory=inputs.base_directory
+        for key in sorted(template_args.keys()):
+            template=field_template.get(key,inputs.template)
+            for argList in template_args[key] or [[]]:
+                pattern=template
+                if len(argList) > 0:
+                    pattern=template % tuple(argList)
+                if len(glob.glob(os.path.join(base_directory,pattern))) == 0:
+                    errors.append("{0}: key '{1}' matches no file {2}".format(
+                      _local_nodeName(node),key,os.path.join(base_directory,pattern)))
+    return errors
+
+def _local_mapNodeItems(node, meanItems):
+    """ The number of subnodes of a MapNode, from its iterfield when it is set, otherwise as in earlier runs """
+    iterValues=getattr(node.inputs,node.iterfield[0],None)
+    if isdefined(iterValues):
+        return len(filename_to_list(iterValues))
+    return meanItems
+
+def EstimateCost(flatgraph, nodeHistory, mapNodeHistory=None):
+    """
+    Returns a dictionary with the predicted core_hours, peak_memory_mb,
+    scratch_gb and critical_path_hours of flatgraph, and the names of the
+    nodes that had no measured history.  The subnodes of a MapNode are
+    recorded under their own names, so mapNodeHistory, per item, is scaled
+    by the number of items and added to the collation of the MapNode.
+    """
+    if mapNodeHistory is None:
+        mapNodeHistory=dict()
+    ## node : (wall_secs,core_secs,memory_mb,written_bytes)
+    estimates=dict()
+    unmeasured=list()
+    for node in flatgraph.nodes():
+        min_threads,max_threads,memory_mb=GetNodeResources(node)
+        history=nodeHistory.get(node.name)
+        itemHistory=None
+        if isinstance(node,MapNode):
+            itemHistory=mapNodeHistory.get(node.name)
+        if history is None and itemHistory is None:
+            unmeasured.append(_local_nodeName(node))
+            estimates[node]=(0.0,0.0,memory_mb,0.0)
+            continue
+        wall_secs,core_secs,peak_mb,written=(0.0,0.0,0.0,0.0)
+        if history is not None:
+            runs,wall_secs,threads,peak_mb,write_bytes=history
+            wall_secs=wall_secs or 0.0
+            core_secs=wall_secs*(threads or min_threads)
+            peak_mb=peak_mb or memory_mb
+            written=write_bytes or 0.0
+        if itemHistory is not None:
+            runs,meanItems,itemWall,itemThreads,itemPeak,itemWrite=itemHistory
+            items=_local_mapNodeItems(node,meanItems)
+            ## The items run side by side, as every other node, on unlimited cores.
+            wall_secs+=itemWall
+            core_secs+=items*itemWall*(itemThreads or min_threads)
+            peak_mb=max(peak_mb,items*(itemPeak or memory_mb))
+            written+=items*itemWrite
+        estimates[node]=(wall_secs,core_secs,peak_mb,written)
+    ## Every node starts as soon as its parents finished, so the memory peak is for unlimited cores.
+    finishTime=dict()
+    startTime=dict()
+    for node in nx.topological_sort(flatgraph):
+        start=max([0.0]+[ finishTime[parent] for parent in flatgraph.predecessors(node) ])
+        startTime[node]=start
+        finishTime[node]=start+estimates[node][0]
+    events=list()
+    for node in flatgraph.nodes():
+        if estimates[node][0] > 0:
+            events.append( (startTime[node],1,estimates[node][2]) )
+            events.append( (finishTime[node],0,-estimates[node][2]) )
+    events.sort()
+    peakMemory=0.0
+    currentMemory=0.0
+    for eventTime,isStart,memoryChange in events:
+        currentMemory+=memoryChange
+        peakMemory=max(peakMemory,currentMemory)
+    return dict(core_hours=sum([ core_secs for wall,core_secs,memory,written in estimates.values() ])/3600.0,
+                peak_memory_mb=peakMemory,
+                scratch_gb=sum([ written for wall,core_secs,memory,written in estimates.values() ])/(1024.0**3),
+                critical_path_hours=max([0.0]+finishTime.values())/3600.0,
+                node_count=len(estimates),
+                unmeasured=unmeasured)
+
+def DryRunWorkflow(workflow, telemetryFile):
+    """ Validate workflow and print its cost estimate, returns (errors,estimate) """
+    flatgraph=workflow._create_flat_graph()
+    errors=CheckConnections(flatgraph)+CheckDataGrabbers(flatgraph)
+    nodeHistory=dict()
+    mapNodeHistory=dict()
+    if os.path.exists(telemetryFile):
+        telemetry=NodeTelemetryDB(telemetryFile)
+        nodeHistory=telemetry.getNodeHistory()
+        mapNodeHistory=telemetry.getMapNodeHistory()
+    estimate=EstimateCost(flatgraph,nodeHistory,mapNodeHistory)
+    print("Dry run of {0}: {1} nodes, {2} problems".format(workflow.name,estimate['node_count'],len(errors)))
+    for error in errors:
+        print("    ERROR: {0}".format(error))
+    PrintCostEstimate(estimate)
+    return errors,estimate
+
+def PrintCostEstimate(estimate):
+    print("    core hours:            {0:10.1f}".format(estimate['core_hours']))
+    print("    peak memory (GB):      {0:10.1f}".format(estimate['peak_memory_mb']/1024.0))
+    print("    scratch disk (GB):     {0:10.1f}".format(estimate['scratch_gb']))
+    print("    critical path (hours): {0:10.1f}".format(estimate['critical_path_hours']))
+    if len(estimate['unmeasured']) > 0:
+        print("    {0} nodes have no recorded timings and are counted as 0 hours".format(len(estimate['unmeasured'])))
+
+def CombineEstimates(estimateList):
+    """ The cost of running the graphs of estimateList one after another, as baw_exp does """
+    unmeasured=list()
+    for estimate in estimateList:
+        unmeasured.extend(estimate['unmeasured'])
+    return dict(core_hours=sum([ estimate['core_hours'] for estimate in estimateList ]),
+                peak_memory_mb=max([0.0]+[ estimate['peak_memory_mb'] for estimate in estimateList ]),
+                scratch_gb=sum([ estimate['scratch_gb'] for estimate in estimateList ]),
+                critical_path_hours=sum([ estimate['critical_path_hours'] for estimate in estimateList ]),
+                node_count=sum([ estimate['node_count'] for estimate in estimateList ]),
+                unmeasured=unmeasured)
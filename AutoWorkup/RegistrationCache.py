@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+A cache of registration results for the antsRegistration, ANTS and BRAINSFit
+interfaces, shared between experiments.
+
+The same atlas to subject, landmark initialized and template registrations
+are requested again whenever an experiment is rerun or a session is added.
+Each result is keyed by the content digests of the fixed image, moving
+image, masks and initial transform, and by the canonicalized remaining
+parameters.  Thread counts and the environment are not part of the key, so
+a registration that was run with another number of slots is still found.
+On a hit the stored transforms and warped images are hard linked into the
+node directory and the interface outputs are aggregated from them.
+
+The cache is opt-in, from the processing environment section of the
+experiment configuration:
+
+    REGISTRATION_CACHE=/scratch/BRAINSAutoWorkUpRegistrationCache
+    REGISTRATION_CACHE_SIZE_GB=200
+
+Entries are evicted least recently used first when the cache grows past its
+size cap.  The index can be queried from Python, for example to list every
+registration of one subject image:
+
+    cache=RegistrationCache('/scratch/BRAINSAutoWorkUpRegistrationCache')
+    for entry in cache.FindRegistrations(movingImage='/paulsen/.../T1.nii.gz'):
+        print entry['interface'], entry['fixed_digest'], entry['hits']
+"""
+import hashlib
+import os
+import shutil
+import socket
+import time
+import sqlite3 as lite
+from copy import deepcopy
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces.base import InterfaceResult, Bunch
+
+from FastContentHash import ContentHashService, SHA1DigestFile
+from SharedResultCache import FindExecutable, _local_describeValue, _local_linkTree
+
+## interface class name : {role : input names}, the roles are recorded in the queryable index.
+REGISTRATION_INPUT_ROLES = {
+    'antsRegistration' : {'fixed': ('fixed_image',), 'moving': ('moving_image',),
+                          'fixed_mask': ('fixed_image_mask',), 'moving_mask': ('moving_image_mask',),
+                          'initial_transform': ('initial_moving_transform',)},
+    'ANTS'             : {'fixed': ('fixed_image',), 'moving': ('moving_image',),
+                          'fixed_mask': (), 'moving_mask': (),
+                          'initial_transform': ('initial_affine',)},
+    'BRAINSFit'        : {'fixed': ('fixedVolume',), 'moving': ('movingVolume',),
+                          'fixed_mask': ('fixedBinaryVolume',), 'moving_mask': ('movingBinaryVolume',),
+                          'initial_transform': ('initialTransform',)},
+}
+REGISTRATION_ROLES = ('fixed','moving','fixed_mask','moving_mask','initial_transform')
+
+## Inputs that do not change the registration result, and are left out of the key.
+PARAMETERS_NOT_IN_KEY = ('environ','ignore_exception','terminal_output','numberOfThreads','num_threads')
+
+## Bump to invalidate every existing entry when the key computation changes.
+REGISTRATION_CACHE_KEY_VERSION = 2
+
+def _local_roleDigest(inputs, inputNames, digestFunction):
+    """ The digest of the files given to the inputNames of one role, or None when none is set """
+    values=[ inputs[name] for name in inputNames if name in inputs ]
+    ## The images of antsRegistration and ANTS are InputMultiPath lists, a single image is indexed by its own digest.
+    values=[ value[0] if isinstance(value,(list,tuple)) and len(value) == 1 else value for value in values ]
+    descriptions=[ _local_describeValue(value,digestFunction) for value in values ]
+    if len(descriptions) == 0:
+        return None
+    if len(descriptions) == 1 and descriptions[0].startswith('file:'):
+        return descriptions[0][len('file:'):]
+    return hashlib.sha1(','.join(descriptions)).hexdigest()
+
+def ComputeRegistrationCacheKey(node, digestFunction=SHA1DigestFile):
+    """
+    Returns (cachekey,role digests,canonical parameters) of a registration node,
+    or (None,None,None) when its interface is not a cached registration.
+    """
+    interface=node._interface
+    interfaceName=interface.__class__.__name__
+    if interfaceName not in REGISTRATION_INPUT_ROLES:
+        return None,None,None
+    toolPath=FindExecutable(interface.cmd.split()[0])
+    if toolPath is None:
+        return None,None,None
+    inputs=node.inputs.get_traitsfree()
+    roleInputs=REGISTRATION_INPUT_ROLES[interfaceName]
+    roleDigests=dict()
+    roleInputNames=list()
+    for role in REGISTRATION_ROLES:
+        roleDigests[role]=_local_roleDigest(inputs,roleInputs[role],digestFunction)
+        roleInputNames.extend(roleInputs[role])
+    parameterParts=list()
+    for name in sorted(inputs.keys()):
+        if name in PARAMETERS_NOT_IN_KEY or name in roleInputNames:
+            continue
+        parameterParts.append('{0}={1}'.format(name,_local_describeValue(inputs[name],digestFunction)))
+    parameters='\n'.join(parameterParts)
+    keyParts=[ 'version={0}'.format(REGISTRATION_CACHE_KEY_VERSION),
+               'interface={0}.{1}'.format(interface.__class__.__module__,interfaceName),
+               'tool={0}'.format(digestFunction(toolPath)) ]
+    keyParts.extend([ '{0}={1}'.format(role,roleDigests[role]) for role in REGISTRATION_ROLES ])
+    keyParts.append(parameters)
+    return hashlib.sha1('\n'.join(keyParts)).hexdigest(),roleDigests,parameters
+
+class RegistrationCache():
+    def __init__(self, cacheDir, maxSizeGB=100.0):
+        self.cacheDir = cacheDir
+        self.maxSizeBytes = int(float(maxSizeGB)*1024*1024*1024)
+        self.TableName = "RegistrationResults"
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        self.dbName = os.path.join(self.cacheDir,'RegistrationCacheIndex.db')
+        self.connection = lite.connect(self.dbName,timeout=600)
+        self.connection.row_factory = lite.Row
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(cachekey TEXT PRIMARY KEY, interface TEXT, "
+          "fixed_digest TEXT, moving_digest TEXT, fixed_mask_digest TEXT, moving_mask_digest TEXT, "
+          "initial_transform_digest TEXT, parameters TEXT, node_name TEXT, size_bytes INT, "
+          "created REAL, last_used REAL, hits INT);".format(_tablename=self.TableName))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {_tablename}_last_used ON {_tablename}(last_used);".format(
+          _tablename=self.TableName))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {_tablename}_images ON {_tablename}(fixed_digest,moving_digest);".format(
+          _tablename=self.TableName))
+        self.connection.commit()
+        self.digestService = ContentHashService(os.path.join(self.cacheDir,'ContentDigests.db'))
+
+    def _local_entryDir(self, cachekey):
+        return os.path.join(self.cacheDir,cachekey[:2],cachekey)
+
+    def Digest(self, fileName):
+        """ The content digest of fileName, as it is used in the index """
+        return self.digestService.Digest(fileName,'sha1')
+
+    def Contains(self, cachekey):
+        row=self.connection.execute("SELECT cachekey FROM {_tablename} WHERE cachekey=?;".format(_tablename=self.TableName),
+          (cachekey,)).fetchone()
+        return row is not None and os.path.isdir(self._local_entryDir(cachekey))
+
+    def Restore(self, cachekey, nodeDir):
+        """ Link the stored transforms and warped images into nodeDir, returns False on a miss """
+        entryDir=self._local_entryDir(cachekey)
+        row=self.connection.execute("SELECT cachekey FROM {_tablename} WHERE cachekey=?;".format(_tablename=self.TableName),
+          (cachekey,)).fetchone()
+        if row is None or not os.path.isdir(entryDir):
+            return False
+        _local_linkTree(entryDir,nodeDir)
+        with self.connection:
+            updated=self.connection.execute("UPDATE {_tablename} SET last_used=?, hits=hits+1 WHERE cachekey=?;".format(
+              _tablename=self.TableName),(time.time(),cachekey)).rowcount
+        ## Evict deletes the row before it removes the files, so while the row is still there every file was linked.
+        return updated == 1
+
+    def Store(self, cachekey, roleDigests, parameters, interfaceName, nodeName, nodeDir):
+        """ Add the registration outputs in nodeDir to the cache, then evict down to the size cap """
+        entryDir=self._local_entryDir(cachekey)
+        if os.path.isdir(entryDir):
+            return
+        ## Build the entry beside its final location and rename it, so readers never see a partial entry.
+        stagingDir='{0}.{1}.{2}.partial'.format(entryDir,socket.gethostname(),os.getpid())
+        if os.path.exists(stagingDir):
+            shutil.rmtree(stagingDir)
+        os.makedirs(stagingDir)
+        sizeBytes=_local_linkTree(nodeDir,stagingDir)
+        try:
+            os.rename(stagingDir,entryDir)
+        except OSError:
+            ## Another job stored the same result first.
+            shutil.rmtree(stagingDir,ignore_errors=True)
+            return
+        now=time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO {_tablename}(cachekey, interface, fixed_digest, moving_digest, "
+              "fixed_mask_digest, moving_mask_digest, initial_transform_digest, parameters, node_name, size_bytes, "
+              "created, last_used, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0);".format(_tablename=self.TableName),
+              (cachekey,interfaceName,roleDigests['fixed'],roleDigests['moving'],roleDigests['fixed_mask'],
+               roleDigests['moving_mask'],roleDigests['initial_transform'],parameters,nodeName,sizeBytes,now,now))
+        self.Evict()
+
+    def getEntries(self):
+        """ Every indexed registration as a list of dictionaries, most recently used first """
+        rows=self.connection.execute("SELECT * FROM {_tablename} ORDER BY last_used DESC;".format(
+          _tablename=self.TableName)).fetchall()
+        return [ dict(zip(row.keys(),row)) for row in rows ]
+
+    def FindRegistrations(self, fixedImage=None, movingImage=None, interfaceName=None):
+        """ The indexed registrations of the given image files and interface, as a list of dictionaries """
+        conditions=list()
+        values=list()
+        if fixedImage is not None:
+            conditions.append('fixed_digest=?')
+            values.append(self.Digest(fixedImage))
+        if movingImage is not None:
+            conditions.append('moving_digest=?')
+            values.append(self.Digest(movingImage))
+        if interfaceName is not None:
+            conditions.append('interface=?')
+            values.append(interfaceName)
+        whereClause=''
+        if len(conditions) > 0:
+            whereClause='WHERE '+' AND '.join(conditions)
+        rows=self.connection.execute("SELECT * FROM {_tablename} {_where} ORDER BY last_used DESC;".format(
+          _tablename=self.TableName,_where=whereClause),values).fetchall()
+        return [ dict(zip(row.keys(),row)) for row in rows ]
+
+    def getEntryFiles(self, cachekey):
+        """ The stored transforms and warped images of cachekey """
+        entryDir=self._local_entryDir(cachekey)
+        entryFiles=list()
+        for dirPath,dirNames,fileNames in os.walk(entryDir):
+            entryFiles.extend([ os.path.join(dirPath,fileName) for fileName in sorted(fileNames) ])
+        return entryFiles
+
+    def getTotalSize(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size_bytes),0) FROM {_tablename};".format(
+          _tablename=self.TableName)).fetchone()[0]
+
+    def Evict(self):
+        """ Remove least recently used entries until the cache is under its size cap """
+        totalBytes=self.getTotalSize()
+        if totalBytes <= self.maxSizeBytes:
+            return
+        evicted=list()
+        for cachekey,sizeBytes in self.connection.execute("SELECT cachekey, size_bytes FROM {_tablename} ORDER BY last_used;".format(
+          _tablename=self.TableName)).fetchall():
+            if totalBytes <= self.maxSizeBytes:
+                break
+            evicted.append( (cachekey,) )
+            totalBytes-=sizeBytes
+        ## The rows go first, so a Restore that is linking one of these entries sees the miss, see Restore.
+        with self.connection:
+            self.connection.executemany("DELETE FROM {_tablename} WHERE cachekey=?;".format(_tablename=self.TableName),evicted)
+        for cachekey, in evicted:
+            entryDir=self._local_entryDir(cachekey)
+            removedDir='{0}.{1}.{2}.evicted'.format(entryDir,socket.gethostname(),os.getpid())
+            try:
+                os.rename(entryDir,removedDir)
+            except OSError:
+                continue
+            shutil.rmtree(removedDir,ignore_errors=True)
+
+class RegistrationCacheNode(pe.Node):
+    """
+    A pe.Node that looks up its registration in a RegistrationCache before running.
+    Nodes are converted with EnableRegistrationCache instead of being created directly.
+    """
+    def _run_command(self, execute, copyfiles=True):
+        if not execute:
+            return super(RegistrationCacheNode,self)._run_command(execute,copyfiles)
+        cache=RegistrationCache(self.registration_cache_dir,self.registration_cache_size_gb)
+        nodeDir=os.getcwd()
+        try:
+            cachekey,roleDigests,parameters=ComputeRegistrationCacheKey(self,cache.Digest)
+        except (IOError,OSError):
+            cachekey=None
+        cacheHit=False
+        if cachekey is not None and cache.Contains(cachekey):
+            originputs=deepcopy(self._interface.inputs)
+            if copyfiles:
+                ## As in SharedResultCacheNode, copyfile inputs are copied before the result is linked over them.
+                self._originputs=originputs
+                self._copyfiles_to_wd(nodeDir,execute)
+            cacheHit=cache.Restore(cachekey,nodeDir)
+            if not cacheHit:
+                self._interface.inputs=originputs
+        if cacheHit:
+            print("Registration cache hit for {0}: {1}".format(self.name,cachekey))
+            runtime=Bunch(returncode=0,cwd=nodeDir,hostname=socket.gethostname(),duration=0,
+                          environ=dict(os.environ),registration_cache_key=cachekey)
+            result=InterfaceResult(interface=self._interface.__class__,runtime=runtime,
+                                   inputs=self._interface.inputs.get_traitsfree(),
+                                   outputs=self._interface.aggregate_outputs())
+            self._result=result
+            self._save_results(result,nodeDir)
+            return result
+        result=super(RegistrationCacheNode,self)._run_command(execute,copyfiles)
+        if cachekey is not None and getattr(result.runtime,'returncode',1) == 0:
+            cache.Store(cachekey,roleDigests,parameters,self._interface.__class__.__name__,self.name,nodeDir)
+        return result
+
+class RegistrationCacheMapNode(pe.MapNode):
+    """
+    A pe.MapNode whose generated subnodes are RegistrationCacheNodes, so that each
+    registration of a template iteration is looked up on its own.
+    """
+    def _make_nodes(self, *args, **kwargs):
+        for index,node in super(RegistrationCacheMapNode,self)._make_nodes(*args,**kwargs):
+            node.__class__=RegistrationCacheNode
+            node.registration_cache_dir=self.registration_cache_dir
+            node.registration_cache_size_gb=self.registration_cache_size_gb
+            yield index,node
+
+## MapNode class : the class that node is converted to, modules with their own MapNode classes add them here.
+REGISTRATION_CACHE_MAPNODE_CLASSES = { pe.MapNode : RegistrationCacheMapNode }
+
+def EnableRegistrationCache(workflow, cacheDir, maxSizeGB):
+    """
+    Convert every antsRegistration, ANTS and BRAINSFit node below workflow to use
+    the RegistrationCache.  Call this before EnableSharedResultCache, which then
+    leaves the converted nodes alone.
+    """
+    enabledCount=0
+    for node in workflow._get_all_nodes():
+        if node._interface.__class__.__name__ not in REGISTRATION_INPUT_ROLES:
+            continue
+        if type(node) is pe.Node:
+            node.__class__=RegistrationCacheNode
+        elif type(node) in REGISTRATION_CACHE_MAPNODE_CLASSES:
+            node.__class__=REGISTRATION_CACHE_MAPNODE_CLASSES[type(node)]
+        else:
+            continue
+        node.registration_cache_dir=cacheDir
+        node.registration_cache_size_gb=maxSizeGB
+        enabledCount+=1
+    print("Registration cache {0} enabled for {1} nodes".format(cacheDir,enabledCount))
+    return enabledCount
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+A local nipype execution plugin that schedules nodes within a machine wide
+CPU and memory budget.
+
+The per node needs are read from node.plugin_args, either from the structured
+keys 'min_threads', 'max_threads' and 'memory_mb', or parsed from the SGE
+'qsub_args' string that the workflows already carry, for example
+'-pe smp1 4-12 -l mem_free=8000M'.  Each job is granted between its minimum
+and maximum number of threads, and ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS and
+NSLOTS are set to the granted count for the job.
+
+A MapNode with more than one item is expanded into one job per subnode, as
+the distributed nipype plugins do, and the MapNode itself only collates the
+finished subnode results.  Ready jobs are started largest first.  A job that
+has waited longer than 'reservation_secs' is started before all others, and
+while it does not fit no other job is started, so the running jobs drain
+until it does.
+
+When the 'calibration_db' plugin argument is given, the peak resident memory
+of every node that declares a 'resource_profile' is recorded there for
+ResourceProfiles.CalibrateResourceProfiles().  Only nodes that really ran are
+recorded, not cache hits, and for command line nodes only the tool is measured.  When a 'telemetry_db' is given,
+every node execution is measured and recorded there, see NodeTelemetry.
+Lightweight nodes are run in a separate pool of long lived worker processes
+that already imported SimpleITK, see LightweightNodes.
+
+    from ResourceLimitedMultiProc import ResourceLimitedMultiProcPlugin
+    baw200.run(plugin=ResourceLimitedMultiProcPlugin(plugin_args={'n_procs':64,'memory_mb':256000}))
+"""
+import os
+import re
+import resource
+import sys
+import time
+from multiprocessing import Pool
+from traceback import format_exception
+
+from nipype.interfaces.base import CommandLine
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins.base import PluginBase, report_crash, report_nodes_not_run
+from nipype.utils.misc import str2bool
+
+from NodeTelemetry import NodeCounters, NodeTelemetryDB, IsCachedResult
+from LightweightNodes import IsLightweightNode, WarmLightweightWorker
+
+## Used for nodes that do not declare a memory need.
+DEFAULT_MEMORY_MB = 1000
+## The collation of finished MapNode subnodes only reads their result files.
+MAPNODE_COLLATE_RESOURCES = (1, 1, 500)
+
+def ParseQsubArgs(qsub_args):
+    """ Returns (min_threads,max_threads,memory_mb) from an SGE qsub_args string,
+    None is returned for any value that is not present. """
+    min_threads=None
+    max_threads=None
+    memory_mb=None
+    peMatch=re.search(r'-pe\s+\S+\s+(\d+)(?:-(\d+))?',qsub_args)
+    if peMatch is not None:
+        min_threads=int(peMatch.group(1))
+        max_threads=min_threads
+        if peMatch.group(2) is not None:
+            max_threads=int(peMatch.group(2))
+    memMatch=re.search(r'mem_free=(\d+(?:\.\d+)?)([KMGkmg]?)',qsub_args)
+    if memMatch is not None:
+        scale={'':1.0/(1024*1024),'K':1.0/1024,'M':1.0,'G':1024.0}[memMatch.group(2).upper()]
+        memory_mb=int(float(memMatch.group(1))*scale)
+    return min_threads,max_threads,memory_mb
+
+def GetNodeResources(node,defaultMemoryMB=DEFAULT_MEMORY_MB):
+    """ Returns (min_threads,max_threads,memory_mb) requested by a node """
+    plugin_args=getattr(node,'plugin_args',None) or dict()
+    min_threads,max_threads,memory_mb=ParseQsubArgs(plugin_args.get('qsub_args',''))
+    min_threads=int(plugin_args.get('min_threads',min_threads or 1))
+    max_threads=int(plugin_args.get('max_threads',max_threads or min_threads))
+    memory_mb=int(plugin_args.get('memory_mb',memory_mb or defaultMemoryMB))
+    return min_threads,max(min_threads,max_threads),memory_mb
+
+def GetTotalMemoryMB():
+    """ The physical memory of this machine """
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/(1024*1024))
+    except (ValueError,OSError,AttributeError):
+        return None
+
+def GetPeakMemoryMB(node):
+    """ The peak resident memory of the program a command line node ran, or of this process for the other nodes """
+    if isinstance(node._interface,CommandLine):
+        ## The worker itself only waited for the tool, its own python is not part of the tool's need.
+        peak=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    else:
+        peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/(1024.0*1024.0) ## bytes on OSX
+    return peak/1024.0 ## kilobytes on linux
+
+def IsCacheRestoredResult(nodeResult):
+    """ True when a SharedResultCache or RegistrationCache hit produced nodeResult instead of the tool """
+    runtime=getattr(nodeResult,'runtime',None)
+    return hasattr(runtime,'shared_result_cache_key') or hasattr(runtime,'registration_cache_key')
+
+def run_node_with_threads(node,updatehash,numThreads):
+    """ Runs in a worker process, so the environment change only affects this job """
+    result=dict(result=None,traceback=None,peak_mb=None)
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']=str(numThreads)
+    os.environ['NSLOTS']=str(numThreads)
+    result['cache_hit']=IsCachedResult(node)
+    counters=NodeCounters()
+    try:
+        result['result']=node.run(updatehash=updatehash)
+    except:
+        etype,eval,etr=sys.exc_info()
+        result['traceback']=format_exception(etype,eval,etr)
+        result['result']=node.result
+    result['measurements']=counters.Finish()
+    if result['cache_hit'] is False and result['traceback'] is None and not IsCacheRestoredResult(result['result']):
+        ## A reused result only measures the worker, which would shrink the calibrated reservation.
+        result['peak_mb']=GetPeakMemoryMB(node)
+    return result
+
+def _fullname(node):
+    return getattr(node,'fullname',None) or node.name
+
+class ResourceLimitedMultiProcPlugin(PluginBase):
+    """
+    Execute a workflow with a pool of local processes, starting a node only
+    when its minimum thread count and its memory fit in the remaining budget.
+
+    plugin_args:
+      n_procs   : total CPU slots to hand out (default: all cpus)
+      memory_mb : total memory to hand out (default: physical memory)
+      calibration_db : sqlite file to record measured peak memory in (default: None)
+      telemetry_db   : sqlite file to record per node measurements in (default: None)
+      telemetry_subjects : dictionary of workflow name to subject id, used to
+                       label the nodes below that workflow (default: None)
+      lightweight_procs : worker processes for lightweight nodes (default: 2)
+      reservation_secs : a ready job that waited this long is started before
+                       all others, and holds back the rest until it fits (default: 300)
+    """
+    def __init__(self,plugin_args=None):
+        super(ResourceLimitedMultiProcPlugin,self).__init__(plugin_args=plugin_args)
+        import multiprocessing
+        if plugin_args is None:
+            plugin_args=dict()
+        self.total_cpus=int(plugin_args.get('n_procs',multiprocessing.cpu_count()))
+        self.total_memory_mb=int(plugin_args.get('memory_mb',GetTotalMemoryMB() or self.total_cpus*DEFAULT_MEMORY_MB))
+        self.poll_sleep_secs=float(plugin_args.get('poll_sleep_secs',2))
+        self.calibration_db=plugin_args.get('calibration_db',None)
+        self.telemetry_db=plugin_args.get('telemetry_db',None)
+        self.telemetry_subjects=plugin_args.get('telemetry_subjects',None) or dict()
+        self.lightweight_procs=int(plugin_args.get('lightweight_procs',2))
+        self.reservation_secs=float(plugin_args.get('reservation_secs',300))
+        ## subnode : MapNode, for the subnodes of expanded MapNodes
+        self.mapNodeOf=dict()
+
+    def __getstate__(self):
+        ## Workflow.run hands every MapNode its plugin, so the plugin is pickled with the MapNode
+        #  jobs.  The telemetry connection and the subnode table only belong to the scheduler.
+        state=self.__dict__.copy()
+        state['telemetry']=None
+        state['mapNodeOf']=dict()
+        return state
+
+    def _clip_resources(self,node):
+        """ A node may not ask for more than the whole machine, otherwise it could never start """
+        min_threads,max_threads,memory_mb=GetNodeResources(node)
+        min_threads=min(min_threads,self.total_cpus)
+        max_threads=min(max_threads,self.total_cpus)
+        memory_mb=min(memory_mb,self.total_memory_mb)
+        return min_threads,max_threads,memory_mb
+
+    def _crash(self,graph,node,traceback,notStarted,pendingSubnodes):
+        """ Report a crashed node and drop everything that depends on it, returns the report_nodes_not_run entry """
+        crashfile=report_crash(node,traceback=traceback)
+        if node in self.mapNodeOf:
+            ## A crashed subnode fails its MapNode, and with it the other subnodes.
+            node=self.mapNodeOf[node]
+            for subnode in pendingSubnodes.pop(node,set()):
+                if subnode in notStarted:
+                    notStarted.remove(subnode)
+        return self._remove_descendants(graph,node,notStarted,crashfile)
+
+    def _expand_mapnode(self,node,notStarted,waitingFor,nodeResources,pendingSubnodes):
+        """ Replace a ready MapNode by its subnodes, the MapNode is started again to collate them """
+        subnodes=node.get_subnodes()
+        notStarted.remove(node)
+        pendingSubnodes[node]=set(subnodes)
+        for subnode in subnodes:
+            ## The subnodes need what their MapNode declared, and record their peaks under its profile.
+            subnode.plugin_args=getattr(node,'plugin_args',None)
+            self.mapNodeOf[subnode]=node
+            waitingFor[subnode]=set()
+            nodeResources[subnode]=self._clip_resources(subnode)
+            notStarted.append(subnode)
+        nodeResources[node]=MAPNODE_COLLATE_RESOURCES
+
+    def run(self,graph,config,updatehash=False):
+        nodes=graph.nodes()
+        nodeResources=dict([ (node,self._clip_resources(node)) for node in nodes ])
+        waitingFor=dict([ (node,set(graph.predecessors(node))) for node in nodes ])
+        notStarted=list(nodes)
+        running=dict()
+        notrun=list()
+        readySince=dict()
+        expandedMapNodes=set()
+        ## MapNode : its subnodes that have not finished yet
+        pendingSubnodes=dict()
+        self.mapNodeOf=dict()
+        free_cpus=self.total_cpus
+        free_memory_mb=self.total_memory_mb
+        stop_on_first_crash=str2bool(config['execution']['stop_on_first_crash'])
+        self._start_telemetry(graph)
+        ## One node per worker process, so that the measured peak memory belongs to that node alone.
+        pool=Pool(processes=self.total_cpus,maxtasksperchild=1)
+        ## Lightweight nodes reuse their workers, so the SimpleITK import is paid once per worker.
+        lightweightPool=Pool(processes=self.lightweight_procs,initializer=WarmLightweightWorker)
+        try:
+            while len(notStarted) > 0 or len(running) > 0:
+                ## Collect finished jobs and return their resources.
+                finishedNodes=list()
+                for node,(asyncResult,grantedThreads,memory_mb) in running.items():
+                    if not asyncResult.ready():
+                        continue
+                    del running[node]
+                    free_cpus+=grantedThreads
+                    free_memory_mb+=memory_mb
+                    result=asyncResult.get()
+                    if IsLightweightNode(node):
+                        ## The peak of a reused worker belongs to all the nodes it ran.
+                        result['peak_mb']=None
+                    self._record_telemetry(node,result,grantedThreads)
+                    if result['traceback'] is not None:
+                        notrun.append(self._crash(graph,node,result['traceback'],notStarted,pendingSubnodes))
+                        if stop_on_first_crash:
+                            notStarted=list()
+                        continue
+                    self._record_peak_memory(node,result['peak_mb'])
+                    finishedNodes.append(node)
+                ## Start every ready job that fits in what is left of the budget.
+                readyNodes=list()
+                for node in list(notStarted):
+                    if len(waitingFor[node]) > 0:
+                        continue
+                    if isinstance(node,MapNode) and node not in expandedMapNodes:
+                        expandedMapNodes.add(node)
+                        try:
+                            if node.num_subnodes() > 1:
+                                self._expand_mapnode(node,notStarted,waitingFor,nodeResources,pendingSubnodes)
+                                readyNodes.extend(pendingSubnodes[node])
+                                continue
+                        except:
+                            etype,eval,etr=sys.exc_info()
+                            notrun.append(self._crash(graph,node,format_exception(etype,eval,etr),notStarted,pendingSubnodes))
+                            if stop_on_first_crash:
+                                notStarted=list()
+                            continue
+                    readyNodes.append(node)
+                now=time.time()
+                for node in readyNodes:
+                    readySince.setdefault(node,now)
+                def WaitedTooLong(node):
+                    return now-readySince[node] >= self.reservation_secs
+                ## Largest jobs first, and jobs that waited too long before all others.
+                readyNodes.sort(key=lambda node: (WaitedTooLong(node),nodeResources[node][0],nodeResources[node][2]),reverse=True)
+                ## Otherwise a stream of small jobs could keep taking the capacity that a large job waits for.
+                reservedNode=None
+                for node in readyNodes:
+                    min_threads,max_threads,memory_mb=nodeResources[node]
+                    if WaitedTooLong(node) and not node.run_without_submitting \
+                      and (min_threads > free_cpus or memory_mb > free_memory_mb):
+                        reservedNode=node
+                        break
+                for node in readyNodes:
+                    min_threads,max_threads,memory_mb=nodeResources[node]
+                    if node.run_without_submitting:
+                        notStarted.remove(node)
+                        del readySince[node]
+                        inlineResult=dict(traceback=None,peak_mb=None,cache_hit=IsCachedResult(node))
+                        counters=NodeCounters()
+                        try:
+                            node.run(updatehash=updatehash)
+                        except:
+                            etype,eval,etr=sys.exc_info()
+                            inlineResult['traceback']=format_exception(etype,eval,etr)
+                        inlineResult['measurements']=counters.Finish()
+                        self._record_telemetry(node,inlineResult,1)
+                        if inlineResult['traceback'] is not None:
+                            notrun.append(self._crash(graph,node,inlineResult['traceback'],notStarted,pendingSubnodes))
+                            if stop_on_first_crash:
+                                notStarted=list()
+                            continue
+                        finishedNodes.append(node)
+                        continue
+                    if reservedNode is not None:
+                        continue
+                    if min_threads > free_cpus or memory_mb > free_memory_mb:
+                        continue
+                    grantedThreads=min(max_threads,free_cpus)
+                    free_cpus-=grantedThreads
+                    free_memory_mb-=memory_mb
+                    notStarted.remove(node)
+                    del readySince[node]
+                    targetPool=pool
+                    if IsLightweightNode(node):
+                        targetPool=lightweightPool
+                    running[node]=(targetPool.apply_async(run_node_with_threads,(node,updatehash,grantedThreads)),grantedThreads,memory_mb)
+                ## Release the successors of the finished nodes, and collate MapNodes whose subnodes all finished.
+                for node in finishedNodes:
+                    if node in self.mapNodeOf:
+                        mapNode=self.mapNodeOf[node]
+                        if mapNode in pendingSubnodes:
+                            pendingSubnodes[mapNode].discard(node)
+                            if len(pendingSubnodes[mapNode]) == 0:
+                                del pendingSubnodes[mapNode]
+                                notStarted.append(mapNode)
+                        continue
+                    for successor in graph.successors(node):
+                        waitingFor[successor].discard(node)
+                if len(running) > 0:
+                    time.sleep(self.poll_sleep_secs)
+        finally:
+            pool.close()
+            pool.join()
+            lightweightPool.close()
+            lightweightPool.join()
+        report_nodes_not_run(notrun)
+
+    def _start_telemetry(self,graph):
+        self.telemetry=None
+        if self.telemetry_db is None:
+            return
+        self.telemetry=NodeTelemetryDB(self.telemetry_db)
+        self.telemetry_run_id=self.telemetry.NewRun([ (_fullname(parent),_fullname(child)) for parent,child in graph.edges() ])
+
+    def _telemetry_subject(self,node):
+        """ The subject of the first enclosing workflow named in telemetry_subjects """
+        for workflowName in (getattr(node,'_hierarchy',None) or '').split('.'):
+            if workflowName in self.telemetry_subjects:
+                return self.telemetry_subjects[workflowName]
+        return None
+
+    def _record_telemetry(self,node,result,grantedThreads):
+        if self.telemetry is None:
+            return
+        status='ok'
+        if result['traceback'] is not None:
+            status='crashed'
+        fullname=_fullname(node)
+        labelNode=node
+        if node in self.mapNodeOf:
+            ## Subnodes are not part of the workflow hierarchy, they are named below their MapNode.
+            labelNode=self.mapNodeOf[node]
+            fullname=_fullname(labelNode)+'.'+node.name
+        self.telemetry.RecordNode(self.telemetry_run_id,self._telemetry_subject(labelNode),node.name,fullname,
+          result['measurements'],result['peak_mb'],grantedThreads,result['cache_hit'],status)
+
+    def _record_peak_memory(self,node,peak_mb):
+        nodeType=(getattr(node,'plugin_args',None) or dict()).get('resource_profile',None)
+        if self.calibration_db is None or nodeType is None or peak_mb is None:
+            return
+        from ResourceProfiles import RecordPeakMemory
+        RecordPeakMemory(self.calibration_db,nodeType,node.name,peak_mb)
+
+    def _remove_descendants(self,graph,node,notStarted,crashfile):
+        """ Drop every node that depends on a crashed node, and describe them for report_nodes_not_run """
+        import networkx as nx
+        dependents=[ descendant for descendant in nx.dfs_preorder_nodes(graph,node) if descendant != node ]
+        for descendant in dependents:
+            if descendant in notStarted:
+                notStarted.remove(descendant)
+        return dict(node=node,dependents=dependents,crashfile=crashfile)
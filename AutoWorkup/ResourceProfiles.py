@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+The one place where the thread range and peak memory of each kind of node is
+declared.  Workflows ask for the plugin_args of a node type instead of writing
+their own qsub_args strings:
+
+    BABCext.plugin_args=ResourceProfiles.GetPluginArgs('BRAINSABC',CLUSTER_QUEUE)
+
+The returned dictionary carries both the SGE 'qsub_args' string and the
+structured 'min_threads', 'max_threads' and 'memory_mb' keys that the
+ResourceLimitedMultiProcPlugin schedules with, so every plugin is rendered
+from the same numbers.
+
+Measured peak memory from earlier runs is kept in a small sqlite file, and
+CalibrateResourceProfiles() replaces the declared memory of a node type with
+the largest measured peak plus some headroom.  A reservation is only lowered
+below its declared value once CALIBRATION_MIN_SAMPLES runs were measured.
+"""
+import os
+import sqlite3 as lite
+
+## node type : (min_threads, max_threads, memory_mb)
+RESOURCE_PROFILES = {
+    'DEFAULT'          : (2, 12, 4000),
+    'BRAINSFit'        : (1,  8, 4000),
+    'antsRegistration' : (4, 12, 7000),
+    'ANTS_SyN'         : (8, 12, 6000),
+    'BRAINSABC'        : (4, 12, 8000),
+    'BRAINSCut'        : (4, 12, 8000),
+    'GAD_SGI'          : (1,  4, 3000),
+    'TemplateUpdate'   : (1,  1, 4000),
+    'MakeNewAtlasTemplate' : (1,  3, 3000),
+    'MS_LDA'           : (1,  1,  300),
+    'ReconAll'         : (1,  1, 3100),
+}
+
+## Measured peaks are multiplied by this before they are used as a reservation.
+CALIBRATION_HEADROOM = 1.25
+## A calibrated reservation is never smaller than this.
+CALIBRATION_FLOOR_MB = 256
+## Measured runs of a node type needed before its reservation may drop below the declared memory.
+CALIBRATION_MIN_SAMPLES = 3
+## The PeakMemory table of older versions also holds cache hits that only measured the worker, so it is not read.
+CALIBRATION_TABLE = 'MeasuredPeakMemory'
+
+def GetResourceProfile(nodeType):
+    """ Returns (min_threads,max_threads,memory_mb) for nodeType """
+    if nodeType not in RESOURCE_PROFILES:
+        print "WARNING: No resource profile for {0}, using DEFAULT".format(nodeType)
+        nodeType='DEFAULT'
+    return RESOURCE_PROFILES[nodeType]
+
+def MakeQsubArgs(nodeType,CLUSTER_QUEUE):
+    """ Render the SGE qsub_args string for nodeType """
+    min_threads,max_threads,memory_mb=GetResourceProfile(nodeType)
+    if min_threads == max_threads:
+        slots="{0}".format(min_threads)
+    else:
+        slots="{0}-{1}".format(min_threads,max_threads)
+    return "-S /bin/bash -pe smp1 {0} -l mem_free={1}M -o /dev/null -e /dev/null {2}".format(slots,memory_mb,CLUSTER_QUEUE)
+
+def GetPluginArgs(nodeType,CLUSTER_QUEUE):
+    """ The node.plugin_args for nodeType, usable by the SGE, SGEGraph and ResourceLimitedMultiProc plugins """
+    min_threads,max_threads,memory_mb=GetResourceProfile(nodeType)
+    return {'qsub_args': MakeQsubArgs(nodeType,CLUSTER_QUEUE), 'overwrite': True,
+            'resource_profile': nodeType,
+            'min_threads': min_threads, 'max_threads': max_threads, 'memory_mb': memory_mb}
+
+def _local_openCalibrationDB(calibrationDBFile):
+    connection=lite.connect(calibrationDBFile)
+    connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(node_type TEXT, node_name TEXT, peak_mb REAL, recorded REAL);".format(
+      _tablename=CALIBRATION_TABLE))
+    connection.execute("CREATE INDEX IF NOT EXISTS {_tablename}_node_type ON {_tablename}(node_type);".format(
+      _tablename=CALIBRATION_TABLE))
+    return connection
+
+def RecordPeakMemory(calibrationDBFile,nodeType,nodeName,peak_mb):
+    """ Store one measured peak resident memory of a finished node """
+    import time
+    connection=_local_openCalibrationDB(calibrationDBFile)
+    with connection:
+        connection.execute("INSERT INTO {_tablename}(node_type, node_name, peak_mb, recorded) VALUES (?, ?, ?, ?);".format(
+          _tablename=CALIBRATION_TABLE),(nodeType,nodeName,float(peak_mb),time.time()))
+    connection.close()
+
+def CalibrateResourceProfiles(calibrationDBFile,headroom=CALIBRATION_HEADROOM):
+    """ Replace the declared memory of each measured node type with its largest measured peak times headroom.
+    This must be called before the workflows are built, because GetPluginArgs renders the values at build time. """
+    if not os.path.exists(calibrationDBFile):
+        return dict()
+    connection=_local_openCalibrationDB(calibrationDBFile)
+    measured=connection.execute("SELECT node_type, MAX(peak_mb), COUNT(*) FROM {_tablename} WHERE peak_mb > 0 GROUP BY node_type;".format(
+      _tablename=CALIBRATION_TABLE)).fetchall()
+    connection.close()
+    calibrated=dict()
+    for nodeType,peak_mb,sampleCount in measured:
+        if nodeType not in RESOURCE_PROFILES or peak_mb is None:
+            continue
+        min_threads,max_threads,declared_mb=RESOURCE_PROFILES[nodeType]
+        memory_mb=max(CALIBRATION_FLOOR_MB,int(peak_mb*headroom))
+        if memory_mb < declared_mb and sampleCount < CALIBRATION_MIN_SAMPLES:
+            ## Too few runs to trust a smaller reservation, a larger one is always taken.
+            continue
+        RESOURCE_PROFILES[nodeType]=(min_threads,max_threads,memory_mb)
+        calibrated[nodeType]=(declared_mb,memory_mb)
+        print "Calibrated {0} memory reservation from {1}M to {2}M".format(nodeType,declared_mb,memory_mb)
+    return calibrated
@@ -1,46 +1,85 @@
 import os
+import sys
 import sqlite3 as lite
 import csv
 
 class SessionDB():
 
-    def __init__(self, defaultDBName='TempFileForDB.db',subject_list=[]):
+    def __init__(self, defaultDBName='TempFileForDB.db',subject_list=[],fileValidator=None):
         self.MasterTableName = "MasterDB"
+        self.SubjectFilterTableName = "SubjectFilter"
+        self.RowHashTableName = "CSVRowHashes"
         self.dbName = defaultDBName
+        self.subject_list = list(subject_list)
+        ## When None, image files are checked one at a time during ingest.
+        self.fileValidator = fileValidator
+        self.missingFileReport = os.path.splitext(self.dbName)[0]+'_MissingFiles.csv'
         self._local_openDB()
-        subject_filter="( "
-        for curr_subject in subject_list:
-            subject_filter+=  "'"+curr_subject+"',"
-        subject_filter=subject_filter.rstrip(',') # Remove last ,
-        subject_filter+=" )"
-        self.MasterQueryFilter = "SELECT * FROM {_tablename} WHERE subj IN {_subjid}".format(
+        ## Only rows from subjects listed in the temp filter table are visible to the getters.
+        self.MasterQueryFilter = "SELECT project, subj, session, type, Qpos, filename FROM {_tablename} WHERE subj IN (SELECT subj FROM {_filtertable})".format(
           _tablename=self.MasterTableName,
-          _subjid=subject_filter)
+          _filtertable=self.SubjectFilterTableName)
 
     def _local_openDB(self):
         self.connection = lite.connect(self.dbName)
         self.cursor = self.connection.cursor()
+        self._local_makeSubjectFilter()
+        ## Databases cached by older versions of this file have no indexes yet.
+        if self._local_hasTable(self.MasterTableName):
+            self._local_makeIndexes()
 
-    def _local_fillDB(self, sqlCommandList):
-        print "Filling SQLite database SessionDB.py"
-        for sqlCommand in sqlCommandList:
-            self.cursor.execute(sqlCommand)
-        self.connection.commit()
-        print "Finished filling SQLite database SessionDB.py"
+    def _local_hasTable(self, tableName):
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (tableName,))
+        return len(self.cursor.fetchall()) > 0
 
-    def MakeNewDB(self, subject_data_file, mountPrefix):
-        ## First close so that we can delete.
-        self.cursor.close()
-        self.connection.close()
-        if os.path.exists(self.dbName):
-            os.remove(self.dbName)
-        self._local_openDB()
+    def _local_makeSubjectFilter(self):
+        ## TEMP tables live only as long as the connection, so this is rebuilt on every open.
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {_filtertable}(subj TEXT PRIMARY KEY);".format(
+          _filtertable=self.SubjectFilterTableName))
+        self.cursor.execute("DELETE FROM {_filtertable};".format(_filtertable=self.SubjectFilterTableName))
+        self.cursor.executemany("INSERT OR IGNORE INTO {_filtertable}(subj) VALUES (?);".format(
+          _filtertable=self.SubjectFilterTableName),
+          [ (curr_subject,) for curr_subject in self.subject_list ])
+        self.connection.commit()
 
-        dbColTypes =  "project TEXT, subj TEXT, session TEXT, type TEXT, Qpos INT, filename TEXT"
+    def _local_makeSchema(self):
+        dbColTypes =  "project TEXT, subj TEXT, session TEXT, type TEXT, Qpos INT, filename TEXT, rowkey TEXT"
         self.cursor.execute("CREATE TABLE {tablename}({coltypes});".format(tablename=self.MasterTableName,coltypes=dbColTypes))
+        ## One entry per CSV row that has been ingested, valid=0 rows are re-checked on every sync.
+        self.cursor.execute("CREATE TABLE {tablename}(rowkey TEXT PRIMARY KEY, valid INT);".format(tablename=self.RowHashTableName))
+        self._local_makeIndexes()
+
+    def _local_makeIndexes(self):
+        ## Indexes cover every lookup pattern used by the getters below.
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS {tablename}_subj_session ON {tablename}(subj, session);".format(tablename=self.MasterTableName))
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS {tablename}_session_type_Qpos ON {tablename}(session, type, Qpos);".format(tablename=self.MasterTableName))
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS {tablename}_project ON {tablename}(project);".format(tablename=self.MasterTableName))
+        if self._local_hasTable(self.RowHashTableName):
+            self.cursor.execute("CREATE INDEX IF NOT EXISTS {tablename}_rowkey ON {tablename}(rowkey);".format(tablename=self.MasterTableName))
         self.connection.commit()
-        sqlCommandList = list()
-        print "Building Subject returnList: " + subject_data_file
+
+    def _local_fillDB(self, rowList, rowKeyList=[], removeKeyList=[]):
+        print "Filling SQLite database SessionDB.py"
+        sqlCommand = "INSERT INTO {_tablename} (project, subj, session, type, Qpos, filename, rowkey) VALUES (?, ?, ?, ?, ?, ?, ?);".format(
+          _tablename=self.MasterTableName)
+        ## A single transaction for the whole bulk load; sqlite3 commits once at the end.
+        with self.connection:
+            self.cursor.executemany("DELETE FROM {_tablename} WHERE rowkey=?;".format(_tablename=self.MasterTableName),
+                                    [ (rowkey,) for rowkey in removeKeyList ])
+            self.cursor.executemany("DELETE FROM {_tablename} WHERE rowkey=?;".format(_tablename=self.RowHashTableName),
+                                    [ (rowkey,) for rowkey in removeKeyList ])
+            self.cursor.executemany(sqlCommand, rowList)
+            self.cursor.executemany("INSERT INTO {_tablename} (rowkey, valid) VALUES (?, ?);".format(_tablename=self.RowHashTableName),
+                                    rowKeyList)
+        print "Finished filling SQLite database SessionDB.py"
+
+    def _local_readCSVRows(self, subject_data_file, mountPrefix):
+        """ Return the (rowkey,row) pairs of subject_data_file in file order.
+        The rowkey is a digest of the row contents and the mountPrefix, with an
+        occurrence count appended so that duplicated rows stay distinct."""
+        import hashlib
+        csvRows = list()
+        seenCount = dict()
         subjData=csv.reader(open(subject_data_file,'rb'), delimiter=',', quotechar='"')
         for row in subjData:
             if len(row) < 1:
@@ -52,93 +91,196 @@ class SessionDB():
             if row[0] == 'project':
                 # continue if header line
                 continue
-            currDict=dict()
-            validEntry=True
-            if len(row) == 4:
-                currDict = {'project': row[0],
-                            'subj': row[1],
-                            'session': row[2]}
-                rawDict=eval(row[3])
-                for imageType in rawDict.keys():
-                    currDict['type'] = imageType
-                    fullPaths=[ mountPrefix+i for i in rawDict[imageType] ]
-                    if len(fullPaths) < 1:
-                        print("Invalid Entry!  {0}".format(currDict))
+            rowhash = hashlib.sha1(repr( (mountPrefix, row) )).hexdigest()
+            seenCount[rowhash] = seenCount.get(rowhash,0) + 1
+            csvRows.append( ("{0}:{1}".format(rowhash,seenCount[rowhash]), row) )
+        return csvRows
+
+    def _local_getImagePaths(self, row, mountPrefix):
+        if len(row) != 4:
+            return []
+        rawDict=eval(row[3])
+        return [ mountPrefix+i for imageType in rawDict.keys() for i in rawDict[imageType] ]
+
+    def _local_parseCSVRow(self, row, rowkey, mountPrefix, fileStatus, missingList):
+        """ Convert one csv row to the list of database rows for its images.
+        Returns the database rows and whether every listed image was found.
+        fileStatus holds pre-computed checks, other files are checked serially here."""
+        from FileValidation import CheckImageFile
+        sqlRowList = list()
+        currDict=dict()
+        validEntry=True
+        if len(row) == 4:
+            currDict = {'project': row[0],
+                        'subj': row[1],
+                        'session': row[2],
+                        'rowkey': rowkey}
+            rawDict=eval(row[3])
+            for imageType in rawDict.keys():
+                currDict['type'] = imageType
+                fullPaths=[ mountPrefix+i for i in rawDict[imageType] ]
+                if len(fullPaths) < 1:
+                    print("Invalid Entry!  {0}".format(currDict))
+                    validEntry=False
+                for i in range(len(fullPaths)):
+                    imagePath = fullPaths[i]
+                    if imagePath in fileStatus:
+                        status = fileStatus[imagePath]
+                    else:
+                        status = CheckImageFile(imagePath)
+                    if status is not None:
+                        print("{0}: {1}".format(status,imagePath))
+                        missingList.append( {'project': row[0], 'subj': row[1], 'session': row[2],
+                                             'type': imageType, 'filename': imagePath, 'status': status} )
                         validEntry=False
-                    for i in range(len(fullPaths)):
-                        imagePath = fullPaths[i]
-                        if not os.path.exists(imagePath):
-                            print("Missing File: {0}".format(imagePath))
-                            validEntry=False
-                        if validEntry == True:
-                            currDict['Qpos'] = str(i)
-                            currDict['filename'] = imagePath
-                            sqlCommand = self.makeSQLiteCommand(currDict)
-                            sqlCommandList.append(sqlCommand)
-            else:
-                print "ERROR:  Invalid number of elements in row"
-                print row
-        sqlCommandList
-        self._local_fillDB(sqlCommandList)
+                    if validEntry == True:
+                        currDict['Qpos'] = i
+                        currDict['filename'] = imagePath
+                        sqlRowList.append(self.makeSQLiteRow(currDict))
+        else:
+            print "ERROR:  Invalid number of elements in row"
+            print row
+            validEntry=False
+        return sqlRowList,validEntry
+
+    def _local_syncRows(self, subject_data_file, mountPrefix):
+        """ Apply only the csv rows that were inserted, changed or deleted since the last sync.
+        Files are only checked for existence for rows that are new, changed, or were invalid before."""
+        print "Building Subject returnList: " + subject_data_file
+        storedKeys = dict(self.getInfoFromDB("SELECT rowkey, valid FROM {_tablename};".format(_tablename=self.RowHashTableName)))
+        csvRows = self._local_readCSVRows(subject_data_file, mountPrefix)
+        keepKeys = set([ rowkey for rowkey,row in csvRows if storedKeys.get(rowkey,0) == 1 ])
+        removeKeyList = [ rowkey for rowkey in storedKeys.keys() if rowkey not in keepKeys ]
+        changedRows = [ (rowkey,row) for rowkey,row in csvRows if rowkey not in keepKeys ]
+        fileStatus = dict()
+        if self.fileValidator is not None:
+            checkPaths = list()
+            for rowkey,row in changedRows:
+                checkPaths.extend(self._local_getImagePaths(row, mountPrefix))
+            fileStatus = self.fileValidator.ValidateFiles(checkPaths)
+        sqlRowList = list()
+        rowKeyList = list()
+        missingList = list()
+        for rowkey,row in changedRows:
+            imageRows,validEntry = self._local_parseCSVRow(row, rowkey, mountPrefix, fileStatus, missingList)
+            sqlRowList.extend(imageRows)
+            rowKeyList.append( (rowkey, int(validEntry)) )
+        print("Session database sync: {0} rows unchanged, {1} rows removed, {2} rows added".format(
+          len(keepKeys), len(removeKeyList), len(rowKeyList)))
+        self._local_fillDB(sqlRowList, rowKeyList, removeKeyList)
+        self._local_writeMissingFileReport(missingList)
+        ## A sync that changed no rows does not write the file, so record that it is up to date.
+        os.utime(self.dbName, None)
+
+    def _local_writeMissingFileReport(self, missingList):
+        """ Every file that failed its check, one csv line each.  Rows with missing
+        files are re-checked on every sync, so this always lists all known problems."""
+        reportFile=open(self.missingFileReport,'w')
+        dWriter=csv.DictWriter(reportFile,['project','subj','session','type','filename','status'],restval='', extrasaction='raise', dialect='excel')
+        dWriter.writeheader()
+        for missing in missingList:
+            dWriter.writerow(missing)
+        reportFile.close()
+        if len(missingList) > 0:
+            print("{0} missing files listed in {1}".format(len(missingList),self.missingFileReport))
+
+    def MakeNewDB(self, subject_data_file, mountPrefix):
+        ## First close so that we can delete.
+        self.cursor.close()
+        self.connection.close()
+        if os.path.exists(self.dbName):
+            os.remove(self.dbName)
+        self._local_openDB()
+        self._local_makeSchema()
+        self._local_syncRows(subject_data_file, mountPrefix)
+
+    def SyncDB(self, subject_data_file, mountPrefix):
+        """ Incrementally bring the database up to date with subject_data_file.
+        The result matches MakeNewDB, but only changed rows are re-read from disk.
+        Databases written before row hashes were stored are fully rebuilt."""
+        if not self._local_hasTable(self.RowHashTableName):
+            self.MakeNewDB(subject_data_file, mountPrefix)
+            return
+        self._local_syncRows(subject_data_file, mountPrefix)
+
+    def NeedsSync(self, subject_data_file):
+        """ True when the database has no rows yet or is older than subject_data_file.
+        SessionDB() creates the database file, so its existence says nothing about its content."""
+        if not self._local_hasTable(self.RowHashTableName):
+            return True
+        rowCount = self.getInfoFromDB("SELECT COUNT(*) FROM {_tablename};".format(_tablename=self.RowHashTableName))[0][0]
+        if rowCount == 0:
+            return True
+        return os.path.getmtime(self.dbName) < os.path.getmtime(subject_data_file)
 
     def getSubjectFilter(self):
         return self.MasterQueryFilter
 
-    def makeSQLiteCommand(self, imageDict):
-        keys = imageDict.keys()
-        vals = imageDict.values()
-        col_names = ",".join(keys)
-        values = ', '.join(map(lambda x: "'" + x + "'", vals))
-        sqlCommand = "INSERT INTO {_tablename} ({_col_names}) VALUES ({_values});".format(
-          _tablename=self.MasterTableName,
-          _col_names=col_names, _values=values)
-        return sqlCommand
+    def makeSQLiteRow(self, imageDict):
+        """ Order the values of imageDict to match the parameters of the bulk INSERT in _local_fillDB """
+        return ( imageDict['project'], imageDict['subj'], imageDict['session'],
+                 imageDict['type'], imageDict['Qpos'], imageDict['filename'], imageDict['rowkey'] )
 
-    def getInfoFromDB(self, sqlCommand):
-        #print("getInfoFromDB({0})".format(sqlCommand))
-        self.cursor.execute(sqlCommand)
+    def getInfoFromDB(self, sqlCommand, sqlParams=()):
+        #print("getInfoFromDB({0},{1})".format(sqlCommand,sqlParams))
+        self.cursor.execute(sqlCommand, sqlParams)
         dbInfo = self.cursor.fetchall()
         return dbInfo
 
     def getFirstScan(self, sessionid, scantype):
-        sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session='{_sessionid}' AND type='{_scantype}' AND Qpos='0';".format(
-            _master_query=self.MasterQueryFilter,
-            _sessionid=sessionid, _scantype=scantype)
-        val = self.getInfoFromDB(sqlCommand)
+        sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session=? AND type=? AND Qpos=0;".format(
+            _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (sessionid, scantype))
         filename = str(val[0][0])
         return filename
 
     def getFirstT1(self, sessionid):
         scantype='T1-30'
-        sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session='{_sessionid}' AND type='{_scantype}' AND Qpos='0';".format(
-          _master_query=self.MasterQueryFilter,
-          _sessionid=sessionid, _scantype=scantype)
-        val = self.getInfoFromDB(sqlCommand)
-        #print "HACK: ",sqlCommand
-        #print "HACK: ", val
+        sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session=? AND type=? AND Qpos=0;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (sessionid, scantype))
         filename = str(val[0][0])
         return filename
 
     def getFilenamesByScantype(self, sessionid, scantypelist):
         returnList = list()
         for currScanType in scantypelist:
-            sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session='{_sessionid}' AND type='{_scantype}' ORDER BY Qpos ASC;".format(
-                _master_query=self.MasterQueryFilter,
-                _sessionid=sessionid, _scantype=currScanType)
-            val = self.getInfoFromDB(sqlCommand)
+            sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session=? AND type=? ORDER BY Qpos ASC;".format(
+                _master_query=self.MasterQueryFilter)
+            val = self.getInfoFromDB(sqlCommand, (sessionid, currScanType))
             for i in val:
                 returnList.append(str(i[0]))
         return returnList
 
+    def getSubjectSessionsInfo(self, subj):
+        """ Everything needed to build the workflows for one subject in a single query.
+        Returns (allSessions, sessionsInfo) where allSessions is the sorted list of sessions
+        and sessionsInfo[sessionid] is a dictionary with the 'project' of the session and
+        'scans', a dictionary of scan type to the list of filenames ordered by Qpos."""
+        sqlCommand = "SELECT session, project, type, filename FROM ({_master_query}) WHERE subj=? ORDER BY session ASC, type ASC, Qpos ASC;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (subj,))
+        allSessions = list()
+        sessionsInfo = dict()
+        for session,project,scantype,filename in val:
+            session = str(session)
+            if session not in sessionsInfo:
+                allSessions.append(session)
+                sessionsInfo[session] = {'project': str(project), 'scans': dict()}
+            elif sessionsInfo[session]['project'] != str(project):
+                print("ERROR: More than one project found")
+                sys.exit(-1)
+            sessionsInfo[session]['scans'].setdefault(str(scantype),list()).append(str(filename))
+        return allSessions,sessionsInfo
+
     def findScanTypeLength(self, sessionid, scantypelist):
         countList=self.getFilenamesByScantype(sessionid,scantypelist)
-        return len(countlist)
+        return len(countList)
 
     def getT1sT2s(self, sessionid):
-        sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session='{_sessionid}' ORDER BY type ASC, Qpos ASC;".format(
-          _master_query=self.MasterQueryFilter,
-          _sessionid=sessionid)
-        val = self.getInfoFromDB(sqlCommand)
+        sqlCommand = "SELECT filename FROM ({_master_query}) WHERE session=? ORDER BY type ASC, Qpos ASC;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (sessionid,))
         returnList = list()
         for i in val:
             returnList.append(str(i[0]))
@@ -161,7 +303,6 @@ class SessionDB():
         return returnList
 
     def getAllSessions(self):
-        #print("HACK:  This is a temporary until complete re-write")
         sqlCommand = "SELECT DISTINCT session FROM ({_master_query});".format(_master_query=self.MasterQueryFilter)
         val = self.getInfoFromDB(sqlCommand)
         returnList = list()
@@ -170,10 +311,9 @@ class SessionDB():
         return returnList
 
     def getSessionsFromSubject(self,subj):
-        sqlCommand = "SELECT DISTINCT session FROM ({_master_query}) WHERE subj='{_subjid}';".format(
-          _master_query=self.MasterQueryFilter,
-          _subjid=subj)
-        val = self.getInfoFromDB(sqlCommand)
+        sqlCommand = "SELECT DISTINCT session FROM ({_master_query}) WHERE subj=?;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (subj,))
         returnList = list()
         for i in val:
             returnList.append(str(i[0]))
@@ -188,10 +328,9 @@ class SessionDB():
         return returnList
 
     def getSubjectsFromProject(self,project):
-        sqlCommand = "SELECT DISTINCT subj FROM ({_master_query}) WHERE project='{_projectid}';".format(
-          _master_query=self.MasterQueryFilter,
-          _projectid=project)
-        val = self.getInfoFromDB(sqlCommand)
+        sqlCommand = "SELECT DISTINCT subj FROM ({_master_query}) WHERE project=?;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (project,))
         returnList = list()
         for i in val:
             returnList.append(str(i[0]))
@@ -199,10 +338,9 @@ class SessionDB():
 
 
     def getSubjFromSession(self,session):
-        sqlCommand = "SELECT DISTINCT subj FROM ({_master_query}) WHERE session='{_sessionid}';".format(
-          _master_query=self.MasterQueryFilter,
-          _sessionid=session)
-        val = self.getInfoFromDB(sqlCommand)
+        sqlCommand = "SELECT DISTINCT subj FROM ({_master_query}) WHERE session=?;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (session,))
         returnList = list()
         for i in val:
             returnList.append(str(i[0]))
@@ -212,10 +350,9 @@ class SessionDB():
         return returnList[0]
 
     def getProjFromSession(self,session):
-        sqlCommand = "SELECT DISTINCT project FROM ({_master_query}) WHERE session='{_sessionid}';".format(
-          _master_query=self.MasterQueryFilter,
-          _sessionid=session)
-        val = self.getInfoFromDB(sqlCommand)
+        sqlCommand = "SELECT DISTINCT project FROM ({_master_query}) WHERE session=?;".format(
+          _master_query=self.MasterQueryFilter)
+        val = self.getInfoFromDB(sqlCommand, (session,))
         returnList = list()
         for i in val:
             returnList.append(str(i[0]))
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+A result cache for command line nodes that is shared between experiments.
+
+Each cached result is keyed by the interface class, a digest of the tool
+binary, and the inputs of the node with every existing input file replaced
+by a digest of its content.  Moving the raw data, or renaming the experiment,
+therefore still finds the earlier result.  On a hit the cached output files
+are hard linked (copied when the cache is on another file system) into the
+node directory and the interface outputs are aggregated from them, so the
+tool is not run again.
+
+The cache is opt-in, from the processing environment section of the
+experiment configuration:
+
+    SHARED_RESULT_CACHE=/scratch/BRAINSAutoWorkUpSharedCache
+    SHARED_RESULT_CACHE_SIZE_GB=500
+
+Entries are evicted least recently used first when the cache grows past
+its size cap.  Cached files are shared by hard link, so nodes must not
+modify their inputs in place.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import socket
+import time
+import sqlite3 as lite
+from copy import deepcopy
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces.base import CommandLine, InterfaceResult, Bunch
+
+from FastContentHash import ContentHashService, SHA1DigestFile
+
+## nipype bookkeeping files that describe one node directory, and are never shared.
+NODE_BOOKKEEPING_PREFIXES = ('_0x', '_inputs.pklz', '_node.pklz', 'result_', '_report', 'command.txt')
+
+## Bump to invalidate every existing entry when the key computation changes.
+CACHE_KEY_VERSION = 1
+
+def FindExecutable(commandName):
+    """ The full path of commandName from the PATH, or None """
+    if os.path.isabs(commandName):
+        return commandName
+    for pathDir in os.environ.get('PATH','').split(os.pathsep):
+        candidate=os.path.join(pathDir,commandName)
+        if os.path.isfile(candidate) and os.access(candidate,os.X_OK):
+            return candidate
+    return None
+
+def _local_describeValue(value, digestFunction):
+    """ A stable description of an input value, with existing files replaced by their content digest """
+    if isinstance(value,(list,tuple)):
+        return '[' + ','.join([ _local_describeValue(item,digestFunction) for item in value ]) + ']'
+    if isinstance(value,dict):
+        return '{' + ','.join([ repr(key)+':'+_local_describeValue(value[key],digestFunction) for key in sorted(value.keys()) ]) + '}'
+    if isinstance(value,basestring) and os.path.isfile(value):
+        return 'file:'+digestFunction(value)
+    if isinstance(value,basestring) and os.path.isdir(value):
+        ## Directory content is not hashed, so directories keep their path in the key.
+        return 'dir:'+os.path.realpath(value)
+    return repr(value)
+
+def ComputeNodeCacheKey(node, digestFunction=SHA1DigestFile):
+    """ The content addressed key of a CommandLine node, or None when it can not be cached """
+    interface=node._interface
+    if not isinstance(interface,CommandLine):
+        return None
+    toolPath=FindExecutable(interface.cmd.split()[0])
+    if toolPath is None:
+        return None
+    keyParts=[ 'version={0}'.format(CACHE_KEY_VERSION),
+               'interface={0}.{1}'.format(interface.__class__.__module__,interface.__class__.__name__),
+               'tool={0}'.format(digestFunction(toolPath)) ]
+    inputs=node.inputs.get_traitsfree()
+    for name in sorted(inputs.keys()):
+        keyParts.append('{0}={1}'.format(name,_local_describeValue(inputs[name],digestFunction)))
+    return hashlib.sha1('\n'.join(keyParts)).hexdigest()
+
+def _local_linkOrCopy(source, destination):
+    try:
+        os.link(source,destination)
+    except OSError, err:
+        if err.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK):
+            raise
+        shutil.copy2(source,destination)
+
+def _local_isBookkeeping(relativePath):
+    return relativePath.split(os.sep)[0].startswith(NODE_BOOKKEEPING_PREFIXES)
+
+def _local_linkTree(sourceDir, destinationDir):
+    """ Link every non bookkeeping file below sourceDir into destinationDir, returns the bytes linked """
+    totalBytes=0
+    for dirPath,dirNames,fileNames in os.walk(sourceDir):
+        relativeDir=os.path.relpath(dirPath,sourceDir)
+        if relativeDir != '.' and _local_isBookkeeping(relativeDir):
+            continue
+        for fileName in fileNames:
+            relativePath=os.path.normpath(os.path.join(relativeDir,fileName))
+            if _local_isBookkeeping(relativePath):
+                continue
+            destination=os.path.join(destinationDir,relativePath)
+            if not os.path.exists(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            if os.path.lexists(destination):
+                os.remove(destination)
+            source=os.path.join(dirPath,fileName)
+            _local_linkOrCopy(source,destination)
+            totalBytes+=os.path.getsize(source)
+    return totalBytes
+
+class SharedResultCache():
+    def __init__(self, cacheDir, maxSizeGB=100.0):
+        self.cacheDir = cacheDir
+        self.maxSizeBytes = int(float(maxSizeGB)*1024*1024*1024)
+        self.TableName = "CachedResults"
+        if not os.path.exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        self.dbName = os.path.join(self.cacheDir,'SharedResultCacheIndex.db')
+        self.connection = lite.connect(self.dbName,timeout=600)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {_tablename}(cachekey TEXT PRIMARY KEY, size_bytes INT, "
+          "created REAL, last_used REAL, hits INT);".format(_tablename=self.TableName))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {_tablename}_last_used ON {_tablename}(last_used);".format(
+          _tablename=self.TableName))
+        self.connection.commit()
+
+    def _local_entryDir(self, cachekey):
+        return os.path.join(self.cacheDir,cachekey[:2],cachekey)
+
+    def Contains(self, cachekey):
+        row=self.connection.execute("SELECT cachekey FROM {_tablename} WHERE cachekey=?;".format(_tablename=self.TableName),
+          (cachekey,)).fetchone()
+        return row is not None and os.path.isdir(self._local_entryDir(cachekey))
+
+    def Restore(self, cachekey, nodeDir):
+        """ Link a cached result into nodeDir, returns False on a miss """
+        entryDir=self._local_entryDir(cachekey)
+        row=self.connection.execute("SELECT cachekey FROM {_tablename} WHERE cachekey=?;".format(_tablename=self.TableName),
+          (cachekey,)).fetchone()
+        if row is None or not os.path.isdir(entryDir):
+            return False
+        _local_linkTree(entryDir,nodeDir)
+        with self.connection:
+            updated=self.connection.execute("UPDATE {_tablename} SET last_used=?, hits=hits+1 WHERE cachekey=?;".format(
+              _tablename=self.TableName),(time.time(),cachekey)).rowcount
+        ## Evict deletes the row before it removes the files, so while the row is still there every file was linked.
+        return updated == 1
+
+    def Store(self, cachekey, nodeDir):
+        """ Add the outputs in nodeDir to the cache, then evict down to the size cap """
+        entryDir=self._local_entryDir(cachekey)
+        if os.path.isdir(entryDir):
+            return
+        ## Build the entry beside its final location and rename it, so readers never see a partial entry.
+        stagingDir='{0}.{1}.{2}.partial'.format(entryDir,socket.gethostname(),os.getpid())
+        if os.path.exists(stagingDir):
+            shutil.rmtree(stagingDir)
+        os.makedirs(stagingDir)
+        sizeBytes=_local_linkTree(nodeDir,stagingDir)
+        try:
+            os.rename(stagingDir,entryDir)
+        except OSError:
+            ## Another job stored the same result first.
+            shutil.rmtree(stagingDir,ignore_errors=True)
+            return
+        now=time.time()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO {_tablename}(cachekey, size_bytes, created, last_used, hits) "
+              "VALUES (?, ?, ?, ?, 0);".format(_tablename=self.TableName),(cachekey,sizeBytes,now,now))
+        self.Evict()
+
+    def getTotalSize(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size_bytes),0) FROM {_tablename};".format(
+          _tablename=self.TableName)).fetchone()[0]
+
+    def Evict(self):
+        """ Remove least recently used entries until the cache is under its size cap """
+        totalBytes=self.getTotalSize()
+        if totalBytes <= self.maxSizeBytes:
+            return
+        evicted=list()
+        for cachekey,sizeBytes in self.connection.execute("SELECT cachekey, size_bytes FROM {_tablename} ORDER BY last_used;".format(
+          _tablename=self.TableName)).fetchall():
+            if totalBytes <= self.maxSizeBytes:
+                break
+            evicted.append( (cachekey,) )
+            totalBytes-=sizeBytes
+        ## The rows go first, so a Restore that is linking one of these entries sees the miss, see Restore.
+        with self.connection:
+            self.connection.executemany("DELETE FROM {_tablename} WHERE cachekey=?;".format(_tablename=self.TableName),evicted)
+        for cachekey, in evicted:
+            entryDir=self._local_entryDir(cachekey)
+            removedDir='{0}.{1}.{2}.evicted'.format(entryDir,socket.gethostname(),os.getpid())
+            try:
+                os.rename(entryDir,removedDir)
+            except OSError:
+                continue
+            shutil.rmtree(removedDir,ignore_errors=True)
+
+class SharedResultCacheNode(pe.Node):
+    """
+    A pe.Node that looks up its result in a SharedResultCache before running.
+    Nodes are converted with EnableSharedResultCache instead of being created directly.
+    """
+    def _run_command(self, execute, copyfiles=True):
+        if not execute:
+            return super(SharedResultCacheNode,self)._run_command(execute,copyfiles)
+        cache=SharedResultCache(self.shared_result_cache_dir,self.shared_result_cache_size_gb)
+        ## Input and tool digests are remembered by (inode,size,mtime), so unchanged files are read only once.
+        digestService=ContentHashService(os.path.join(self.shared_result_cache_dir,'ContentDigests.db'))
+        nodeDir=os.getcwd()
+        try:
+            cachekey=ComputeNodeCacheKey(self,lambda fileName: digestService.Digest(fileName,'sha1'))
+        except (IOError,OSError):
+            cachekey=None
+        cacheHit=False
+        if cachekey is not None and cache.Contains(cachekey):
+            originputs=deepcopy(self._interface.inputs)
+            if copyfiles:
+                ## As in Node._run_command, copyfile inputs are pointed at their copies in nodeDir.  The restored
+                #  result then replaces those copies, so outputs that are modified inputs are aggregated correctly.
+                self._originputs=originputs
+                self._copyfiles_to_wd(nodeDir,execute)
+            cacheHit=cache.Restore(cachekey,nodeDir)
+            if not cacheHit:
+                ## Evicted in the meantime, the normal run copies the inputs again.
+                self._interface.inputs=originputs
+        if cacheHit:
+            print("Shared result cache hit for {0}: {1}".format(self.name,cachekey))
+            runtime=Bunch(returncode=0,cwd=nodeDir,hostname=socket.gethostname(),duration=0,
+                          environ=dict(os.environ),shared_result_cache_key=cachekey)
+            result=InterfaceResult(interface=self._interface.__class__,runtime=runtime,
+                                   inputs=self._interface.inputs.get_traitsfree(),
+                                   outputs=self._interface.aggregate_outputs())
+            self._result=result
+            self._save_results(result,nodeDir)
+            return result
+        result=super(SharedResultCacheNode,self)._run_command(execute,copyfiles)
+        if cachekey is not None and getattr(result.runtime,'returncode',1) == 0:
+            cache.Store(cachekey,nodeDir)
+        return result
+
+def EnableSharedResultCache(workflow, cacheDir, maxSizeGB):
+    """ Convert every submitted CommandLine node below workflow to a SharedResultCacheNode """
+    enabledCount=0
+    for node in workflow._get_all_nodes():
+        ## MapNode subnodes are generated at run time, and in-process helper nodes are cheaper to rerun than to cache.
+        if type(node) is not pe.Node or node.run_without_submitting or not isinstance(node._interface,CommandLine):
+            continue
+        node.__class__=SharedResultCacheNode
+        node.shared_result_cache_dir=cacheDir
+        node.shared_result_cache_size_gb=maxSizeGB
+        enabledCount+=1
+    print("Shared result cache {0} enabled for {1} nodes".format(cacheDir,enabledCount))
+    return enabledCount
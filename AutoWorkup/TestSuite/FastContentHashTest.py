@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+The fastcontent digests must be what nipype hashes a node with when the
+workflow uses hash_method='content'.
+
+    python FastContentHashTest.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, File, traits
+
+import FastContentHash
+
+class FileInputSpec(BaseInterfaceInputSpec):
+    inputVolume = File(exists=True, mandatory=True)
+    inputVolumes = traits.List(File(exists=True))
+
+class FileInput(BaseInterface):
+    input_spec = FileInputSpec
+    output_spec = TraitedSpec
+
+    def _run_interface(self, runtime):
+        return runtime
+
+    def _list_outputs(self):
+        return dict()
+
+class FastContentHashTest(unittest.TestCase):
+    def setUp(self):
+        self.testDir=tempfile.mkdtemp(prefix='FastContentHashTest')
+        self.files=list()
+        for index in range(3):
+            fileName=os.path.join(self.testDir,'image{0}.nii'.format(index))
+            open(fileName,'wb').write('voxels{0}'.format(index)*1000)
+            self.files.append(fileName)
+        self.workflow=pe.Workflow(name='FastContentHashTest')
+        self.workflow.base_dir=self.testDir
+        self.workflow.config['execution']['hash_method']='content'
+        self.node=pe.Node(interface=FileInput(),name='FileInput')
+        self.node.inputs.inputVolume=self.files[0]
+        self.node.inputs.inputVolumes=self.files[1:]
+        self.workflow.add_nodes([self.node])
+        self.dbFileName=os.path.join(self.testDir,'InternalContentHashCache.db')
+        FastContentHash.AttachFastContentHash(self.workflow,self.dbFileName)
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def test_NodeHashUsesFastContentDigests(self):
+        hashedInputs,hashValue=self.node.inputs.get_hashval('content')
+        hashedFiles=dict(hashedInputs)
+        self.assertEqual(hashedFiles['inputVolume'],
+                         (self.files[0],FastContentHash.FastDigestFile(self.files[0])))
+        self.assertEqual(hashedFiles['inputVolumes'],
+                         [ (fileName,FastContentHash.FastDigestFile(fileName)) for fileName in self.files[1:] ])
+
+    def test_DigestsAreRemembered(self):
+        firstHash=self.node.inputs.get_hashval('content')[1]
+        service=FastContentHash.ContentHashService(self.dbFileName)
+        self.assertEqual(len(service._local_openDB().execute('SELECT * FROM {0};'.format(service.TableName)).fetchall()),3)
+        self.assertEqual(self.node.inputs.get_hashval('content')[1],firstHash)
+
+    def test_ContentChangeChangesHash(self):
+        firstHash=self.node.inputs.get_hashval('content')[1]
+        open(self.files[1],'wb').write('changed voxels')
+        self.assertNotEqual(self.node.inputs.get_hashval('content')[1],firstHash)
+
+    def test_SameInodeOnAnotherDeviceIsAnotherFile(self):
+        service=FastContentHash.ContentHashService(self.dbFileName)
+        firstDigest=service.Digest(self.files[0])
+        ## Another mount holds a file with the same inode, size and mtime but other content.
+        otherFile=os.path.join(self.testDir,'other_mount.nii')
+        open(otherFile,'wb').write('VOXELS0'*1000)
+        firstStat=os.stat(self.files[0])
+        originalStat=FastContentHash.os.stat
+        class OtherDeviceStat(object):
+            st_dev=firstStat.st_dev+1
+            st_ino=firstStat.st_ino
+            st_size=firstStat.st_size
+            st_mtime=firstStat.st_mtime
+        def StatOnOtherDevice(fileName):
+            if fileName == otherFile:
+                return OtherDeviceStat()
+            return originalStat(fileName)
+        FastContentHash.os.stat=StatOnOtherDevice
+        try:
+            otherDigest=service.Digest(otherFile)
+        finally:
+            FastContentHash.os.stat=originalStat
+        self.assertEqual(otherDigest,FastContentHash.FastDigestFile(otherFile))
+        self.assertNotEqual(otherDigest,firstDigest)
+
+    def test_TimestampMethodIsUnchanged(self):
+        hashedInputs=dict(self.node.inputs.get_hashval('timestamp')[0])
+        self.assertEqual(len(hashedInputs['inputVolume'][1]),32)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+FusedTemplateUpdate must produce the template and passive templates of the
+AverageImages, AverageAffineTransform, MultiplyImages and
+WarpImageMultiTransform chain of buildtemplateparallel.sh.  Both are run on small synthetic volumes, the test
+is skipped when the ANTS programs are not on the PATH.  A converged template
+iteration must run none of those programs, and pass its previous template through.
+
+    python FusedTemplateUpdateTest.py
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SharedResultCache import FindExecutable
+from RegistrationCache import EnableRegistrationCache
+from BRAINSTools.BTants.buildtemplateparallel import FusedTemplateUpdate, ANTSTemplateBuildSingleIterationWF
+
+ANTS_PROGRAMS = ('AverageImages','AverageAffineTransform','MultiplyImages','WarpImageMultiTransform')
+GRADIENT_STEP = 0.25
+PASSIVE_TYPES = ['T2','POSTERIOR_WM']
+
+def HaveAntsPrograms():
+    return all([ FindExecutable(program) is not None for program in ANTS_PROGRAMS ])
+
+class FusedTemplateUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.testDir=tempfile.mkdtemp(prefix='FusedTemplateUpdateTest')
+        self.startDir=os.getcwd()
+        inputDir=os.path.join(self.testDir,'inputs')
+        os.mkdir(inputDir)
+        randomState=np.random.RandomState(12345)
+        shape=(16,20,24)
+        grid=np.indices(shape).astype(np.float64)
+        def WriteImage(values,fileName,isVector=False):
+            image=sitk.GetImageFromArray(values.astype(np.float32),isVector)
+            image.SetSpacing((1.5,1.25,2.0))
+            image.SetOrigin((-10.0,4.0,2.5))
+            fileName=os.path.join(inputDir,fileName)
+            sitk.WriteImage(image,fileName)
+            return fileName
+        self.deformedImages=list()
+        self.warpTransforms=list()
+        self.affineTransforms=list()
+        self.deformedPassiveImages=list()
+        self.passiveImageNametypes=list()
+        for subject in range(3):
+            center=np.array(shape)/2.0+randomState.uniform(-1.5,1.5,3)
+            distance=np.sqrt(sum([ (grid[axis]-center[axis])**2 for axis in range(3) ]))
+            blob=100.0*(subject+1)*np.exp(-(distance/5.0)**2)+randomState.uniform(0,5,shape)
+            self.deformedImages.append(WriteImage(blob,'deformed{0}.nii.gz'.format(subject)))
+            displacement=np.stack([ randomState.uniform(-0.5,0.5)*np.sin(grid[axis]/4.0) for axis in range(3) ],axis=-1)
+            self.warpTransforms.append(WriteImage(displacement,'subject{0}Warp.nii.gz'.format(subject),True))
+            affineTransform=os.path.join(inputDir,'subject{0}Affine.txt'.format(subject))
+            affineFile=open(affineTransform,'w')
+            affineFile.write("#Insight Transform File V1.0\n#Transform 0\n"
+                             "Transform: MatrixOffsetTransformBase_double_3_3\n"
+                             "Parameters: {0} 0.02 0 -0.02 {1} 0 0 0 1 {2} -0.3 0.2\n"
+                             "FixedParameters: 0 5 8\n".format(0.98+0.01*subject,1.02-0.01*subject,0.2*subject))
+            affineFile.close()
+            self.affineTransforms.append(affineTransform)
+            for imageType in PASSIVE_TYPES:
+                self.deformedPassiveImages.append(WriteImage(blob*randomState.uniform(0.5,2.0),'{0}{1}.nii.gz'.format(imageType,subject)))
+                self.passiveImageNametypes.append(imageType)
+
+    def tearDown(self):
+        os.chdir(self.startDir)
+        shutil.rmtree(self.testDir)
+
+    def RunChain(self, chainDir):
+        """ The template update of buildtemplateparallel.sh, returns {output name: file} """
+        os.mkdir(chainDir)
+        os.chdir(chainDir)
+        subprocess.check_call(['AverageImages','3','Iteration01.nii.gz','1']+self.deformedImages)
+        averageAffineTransform=os.path.abspath('Iteration01Affine.mat')
+        subprocess.check_call(['AverageAffineTransform','3',averageAffineTransform]+self.affineTransforms)
+        subprocess.check_call(['AverageImages','3','Iteration01warp.nii.gz','0']+self.warpTransforms)
+        subprocess.check_call(['MultiplyImages','3','Iteration01warp.nii.gz',str(-1.0*GRADIENT_STEP),'Iteration01warp.nii.gz'])
+        subprocess.check_call(['WarpImageMultiTransform','3','Iteration01warp.nii.gz','Iteration01warp_wimt.nii.gz',
+                               '-R','Iteration01.nii.gz','-i',averageAffineTransform])
+        shapeUpdateTransforms=['-i',averageAffineTransform]+['Iteration01warp_wimt.nii.gz']*4
+        subprocess.check_call(['WarpImageMultiTransform','3','Iteration01.nii.gz','Iteration01_Reshaped.nii.gz',
+                               '-R','Iteration01.nii.gz']+shapeUpdateTransforms)
+        outputs={ 'Iteration01_Reshaped.nii.gz': os.path.abspath('Iteration01_Reshaped.nii.gz') }
+        for imageType in PASSIVE_TYPES:
+            passiveImages=[ fileName for fileName,nameType in zip(self.deformedPassiveImages,self.passiveImageNametypes) if nameType == imageType ]
+            averageName='AVG_'+imageType+'.nii.gz'
+            reshapedName='AVG_'+imageType+'WARP_AVG_'+imageType+'.nii.gz'
+            subprocess.check_call(['AverageImages','3',averageName,'0']+passiveImages)
+            subprocess.check_call(['WarpImageMultiTransform','3',averageName,reshapedName,'-R',averageName]+shapeUpdateTransforms)
+            outputs[reshapedName]=os.path.abspath(reshapedName)
+        return outputs
+
+    def assertImagesClose(self, fileName, referenceFileName):
+        image=sitk.ReadImage(fileName)
+        referenceImage=sitk.ReadImage(referenceFileName)
+        self.assertEqual(image.GetSize(),referenceImage.GetSize())
+        self.assertTrue(np.allclose(image.GetSpacing(),referenceImage.GetSpacing()))
+        values=sitk.GetArrayFromImage(image).astype(np.float64)
+        referenceValues=sitk.GetArrayFromImage(referenceImage).astype(np.float64)
+        tolerance=1e-4*np.abs(referenceValues).max()
+        self.assertTrue(np.abs(values-referenceValues).max() <= tolerance,
+                        "{0} differs from {1} by {2}".format(fileName,referenceFileName,np.abs(values-referenceValues).max()))
+
+    @unittest.skipUnless(HaveAntsPrograms(),'needs '+', '.join(ANTS_PROGRAMS))
+    def test_MatchesAntsChain(self):
+        chainOutputs=self.RunChain(os.path.join(self.testDir,'chain'))
+        fusedDir=os.path.join(self.testDir,'fused')
+        os.mkdir(fusedDir)
+        os.chdir(fusedDir)
+        template,passive_deformed_templates=FusedTemplateUpdate('Iteration01',GRADIENT_STEP,self.deformedImages,self.warpTransforms,
+            self.affineTransforms,self.deformedPassiveImages,self.passiveImageNametypes)
+        self.assertImagesClose(template,chainOutputs['Iteration01_Reshaped.nii.gz'])
+        self.assertEqual([ os.path.basename(fileName) for fileName in passive_deformed_templates ],
+                         [ 'AVG_'+imageType+'WARP_AVG_'+imageType+'.nii.gz' for imageType in sorted(PASSIVE_TYPES) ])
+        for passiveTemplate in passive_deformed_templates:
+            self.assertImagesClose(passiveTemplate,chainOutputs[os.path.basename(passiveTemplate)])
+
+    def test_ConvergedIterationReturnsAtOnce(self):
+        ## A converged iteration registered no images, so nipype leaves every list input undefined.
+        os.chdir(self.testDir)
+        self.assertEqual(FusedTemplateUpdate('Iteration02',GRADIENT_STEP,passiveImageNametypes=[]),(None,None))
+
+    def test_ConvergedIterationRunsNoRegistrations(self):
+        ## Runs without the ANTS programs, because a converged iteration must not call any of them.
+        iterationWF=ANTSTemplateBuildSingleIterationWF('Iteration02','all.q',adaptive=True,warmStart=True)
+        iterationWF.base_dir=os.path.join(self.testDir,'workflow')
+        iterationWF.config['execution']={'crashdump_dir':self.testDir}
+        ## The gated BeginANTS keeps its registration cache.
+        self.assertEqual(EnableRegistrationCache(iterationWF,os.path.join(self.testDir,'registrations'),1.0),1)
+        inputSpec=iterationWF.get_node('InputSpec')
+        inputSpec.inputs.images=self.deformedImages
+        inputSpec.inputs.fixed_image=self.deformedImages[0]
+        inputSpec.inputs.ListOfPassiveImagesDictionararies=[ {'T2':fileName} for fileName in self.deformedImages ]
+        inputSpec.inputs.converged=True
+        inputSpec.inputs.previous_passive_deformed_templates=self.deformedPassiveImages[:1]
+        inputSpec.inputs.initial_affine_transforms=self.affineTransforms
+        executedGraph=iterationWF.run(plugin='Linear')
+        results=dict([ (node.name,node.result) for node in executedGraph.nodes() ])
+        self.assertEqual(results['BeginANTS'].runtime,[])
+        self.assertEqual(results['wimtdeformed'].runtime,[])
+        self.assertEqual(results['wimtPassivedeformed'].runtime,[])
+        self.assertEqual(results['IterationResult'].outputs.template,self.deformedImages[0])
+        self.assertEqual(results['IterationResult'].outputs.passive_deformed_templates,self.deformedPassiveImages[:1])
+
+if __name__ == '__main__':
+    unittest.main()
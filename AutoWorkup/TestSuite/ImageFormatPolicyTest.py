@@ -0,0 +1,73 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+The CompressingDataSink stores .nii images as .nii.gz, reports the names the
+files have on disk, and leaves the copyfile of nipype.interfaces.io alone, so
+other sinks of the same process are not affected.
+
+    python ImageFormatPolicyTest.py
+"""
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nipype.interfaces.io as nio
+
+from ImageFormatPolicy import CompressingDataSink
+
+class ImageFormatPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.testDir=tempfile.mkdtemp(prefix='ImageFormatPolicyTest')
+        self.inputDir=os.path.join(self.testDir,'inputs')
+        os.makedirs(os.path.join(self.inputDir,'surfaces'))
+        self.image=self.WriteInput('T1.nii','an uncompressed image')
+        self.table=self.WriteInput('volumes.csv','a table')
+        self.WriteInput(os.path.join('surfaces','lh.nii'),'an image in a directory')
+        self.resultsDir=os.path.join(self.testDir,'results')
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def WriteInput(self, fileName, content):
+        fileName=os.path.join(self.inputDir,fileName)
+        open(fileName,'w').write(content)
+        return fileName
+
+    def test_StoresCompressedImagesUnderTheirRealNames(self):
+        originalCopyfile=nio.copyfile
+        sink=CompressingDataSink()
+        sink.inputs.base_directory=self.resultsDir
+        sink.inputs.parameterization=False
+        sink.inputs.regexp_substitutions=[ ('T1','T1_RESULT') ]
+        setattr(sink.inputs,'Session.@image',self.image)
+        setattr(sink.inputs,'Session.@table',self.table)
+        setattr(sink.inputs,'Session.@surfaces',os.path.join(self.inputDir,'surfaces'))
+        result=sink.run()
+        self.assertTrue(nio.copyfile is originalCopyfile)
+        storedFiles=sorted(result.outputs.out_file)
+        sessionDir=os.path.join(self.resultsDir,'Session')
+        self.assertEqual(storedFiles,sorted([ os.path.join(sessionDir,'T1_RESULT.nii.gz'),
+                                              os.path.join(sessionDir,'volumes.csv'),
+                                              os.path.join(sessionDir,'surfaces','lh.nii.gz') ]))
+        for storedFile in storedFiles:
+            self.assertTrue(os.path.isfile(storedFile))
+        self.assertEqual(gzip.open(os.path.join(sessionDir,'T1_RESULT.nii.gz')).read(),'an uncompressed image')
+        self.assertFalse(os.path.exists(os.path.join(sessionDir,'T1_RESULT.nii')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Lightweight nodes under the SGE plugins never get a queue job of their own.
+
+The queue is a small qsub script written into a temporary directory on the
+PATH.  It runs each batch script as soon as it is submitted and records its
+name, which is all the plugins can observe of SGE.
+
+    python LightweightNodesTest.py
+"""
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+from nipype.utils.filemanip import loadpkl
+
+from LightweightNodes import MarkLightweightNode, LightweightSGEPlugin, LightweightSGEGraphPlugin
+
+## Runs the batch script at once and answers like SGE.
+QSUB_SCRIPT = """#!/bin/sh
+for last; do true; done
+echo "$last" >> {jobsFile}
+/bin/sh "$last" > /dev/null 2>&1
+echo "Your job $(wc -l < {jobsFile}) (\\"$last\\") has been submitted"
+"""
+## No job is ever pending, they all ran during qsub.
+QSTAT_SCRIPT = """#!/bin/sh
+exit 1
+"""
+
+def AddOne(value):
+    return value+1
+
+def AddValues(first,second):
+    return first+second
+
+class LightweightNodesTest(unittest.TestCase):
+    def setUp(self):
+        self.testDir=tempfile.mkdtemp(prefix='LightweightNodesTest')
+        self.binDir=os.path.join(self.testDir,'bin')
+        os.mkdir(self.binDir)
+        self.jobsFile=os.path.join(self.testDir,'jobs.txt')
+        for programName,script in (('qsub',QSUB_SCRIPT),('qstat',QSTAT_SCRIPT)):
+            programFile=os.path.join(self.binDir,programName)
+            open(programFile,'w').write(script.format(jobsFile=self.jobsFile))
+            os.chmod(programFile,os.stat(programFile).st_mode|stat.S_IXUSR)
+        self.originalPath=os.environ['PATH']
+        os.environ['PATH']=self.binDir+os.pathsep+self.originalPath
+        os.environ.setdefault('LOGNAME','tester')
+
+    def tearDown(self):
+        os.environ['PATH']=self.originalPath
+        shutil.rmtree(self.testDir)
+
+    def MakeWorkflow(self):
+        """ First and Second feed the lightweight Sum, whose result feeds Last """
+        workflow=pe.Workflow(name='LightweightWF')
+        workflow.base_dir=os.path.join(self.testDir,'workflow')
+        workflow.config['execution']={'crashdump_dir':self.testDir,'job_finished_timeout':'1'}
+        nodes=dict()
+        for name,value in (('First',1),('Second',10)):
+            nodes[name]=pe.Node(interface=util.Function(function=AddOne,input_names=['value'],output_names=['value']),name=name)
+            nodes[name].inputs.value=value
+        nodes['Sum']=MarkLightweightNode(pe.Node(interface=util.Function(function=AddValues,
+                                         input_names=['first','second'],output_names=['value']),name='Sum'))
+        nodes['Last']=pe.Node(interface=util.Function(function=AddOne,input_names=['value'],output_names=['value']),name='Last')
+        workflow.connect(nodes['First'],'value',nodes['Sum'],'first')
+        workflow.connect(nodes['Second'],'value',nodes['Sum'],'second')
+        workflow.connect(nodes['Sum'],'value',nodes['Last'],'value')
+        return workflow
+
+    def SubmittedJobs(self):
+        if not os.path.exists(self.jobsFile):
+            return []
+        return [ os.path.basename(line.strip()) for line in open(self.jobsFile) ]
+
+    def LastValue(self, workflow):
+        """ The output of the Last node, read from its result file """
+        lastResult=[ os.path.join(dirPath,fileName) for dirPath,dirNames,fileNames in os.walk(workflow.base_dir)
+                     for fileName in fileNames if fileName == 'result_Last.pklz' ]
+        self.assertEqual(len(lastResult),1)
+        return loadpkl(lastResult[0]).outputs.value
+
+    def test_SGERunsLightweightNodeOnSubmitHost(self):
+        workflow=self.MakeWorkflow()
+        workflow.run(plugin=LightweightSGEPlugin(plugin_args={'template':'#!/bin/sh'}))
+        self.assertEqual(self.LastValue(workflow),2+11+1)
+        jobs=self.SubmittedJobs()
+        self.assertEqual(len(jobs),3)
+        self.assertFalse([ job for job in jobs if 'Sum' in job ])
+
+    def test_SGEGraphFusesLightweightNode(self):
+        workflow=self.MakeWorkflow()
+        submitted=dict()
+        def RecordGraph(pyfiles, dependencies):
+            submitted['pyfiles']=pyfiles
+            submitted['dependencies']=dependencies
+        plugin=LightweightSGEGraphPlugin(plugin_args={'template':'#!/bin/sh'})
+        plugin._submit_graph=RecordGraph
+        workflow.run(plugin=plugin)
+        pyfiles=submitted['pyfiles']
+        self.assertEqual(len(pyfiles),3)
+        fused=[ index for index,pyfile in enumerate(pyfiles) if 'pyscript_fused_' in pyfile ]
+        self.assertEqual(len(fused),1)
+        fusedJob=fused[0]
+        ## The job that runs Sum waits for both inputs, and Last waits for it.
+        lastJob=[ index for index,pyfile in enumerate(pyfiles) if pyfile.endswith('_Last.py') ][0]
+        self.assertEqual(submitted['dependencies'][lastJob],[fusedJob])
+        self.assertEqual(len(submitted['dependencies'][fusedJob]),1)
+        ## Running the jobs in their order gives the result of the whole workflow.
+        for pyfile in pyfiles:
+            subprocess.check_call([sys.executable,pyfile])
+        self.assertEqual(self.LastValue(workflow),2+11+1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+The node telemetry of a workflow with an expanded MapNode must put the wall
+time of the MapNode subnodes on the critical path of the subject, and the
+dry run cost estimate must count every subnode of the MapNode.
+
+    python NodeTelemetryTest.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+
+from NodeTelemetry import NodeTelemetryDB, GetSubnodeMapNode
+from ResourceLimitedMultiProc import ResourceLimitedMultiProcPlugin
+from PreflightCheck import EstimateCost
+
+## Each subnode sleeps this long, far longer than the other nodes take.
+SUBNODE_SLEEP_SECS = 2.0
+
+def PassThrough(value):
+    return value
+
+def SleepFor(seconds):
+    import time
+    time.sleep(seconds)
+    return seconds
+
+class NodeTelemetryTest(unittest.TestCase):
+    def setUp(self):
+        self.testDir=tempfile.mkdtemp(prefix='NodeTelemetryTest')
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+
+    def test_SubnodeNames(self):
+        self.assertEqual(GetSubnodeMapNode('wf.BeginANTS._BeginANTS12'),'wf.BeginANTS')
+        self.assertEqual(GetSubnodeMapNode('wf.BeginANTS'),None)
+        self.assertEqual(GetSubnodeMapNode('wf.wimtdeformed._BeginANTS0'),None)
+
+    def RunMapNodeWorkflow(self):
+        """ Runs Source -> Sleepers MapNode -> Sink with telemetry, returns (workflow,telemetry file) """
+        workflow=pe.Workflow(name='TelemetryWF')
+        workflow.base_dir=os.path.join(self.testDir,'workflow')
+        workflow.config['execution']={'crashdump_dir':self.testDir}
+        source=pe.Node(interface=util.Function(function=PassThrough,input_names=['value'],output_names=['value']),
+                       name='Source')
+        source.inputs.value=[SUBNODE_SLEEP_SECS,SUBNODE_SLEEP_SECS]
+        sleepers=pe.MapNode(interface=util.Function(function=SleepFor,input_names=['seconds'],output_names=['seconds']),
+                            iterfield=['seconds'],name='Sleepers')
+        sink=pe.Node(interface=util.Function(function=PassThrough,input_names=['value'],output_names=['value']),
+                     name='Sink')
+        workflow.connect(source,'value',sleepers,'seconds')
+        workflow.connect(sleepers,'seconds',sink,'value')
+        telemetryFile=os.path.join(self.testDir,'telemetry.db')
+        workflow.run(plugin=ResourceLimitedMultiProcPlugin(plugin_args={'n_procs':2,'memory_mb':4000,'poll_sleep_secs':0.1,
+          'telemetry_db':telemetryFile,'telemetry_subjects':{'TelemetryWF':'SUBJ'}}))
+        return workflow,telemetryFile
+
+    def test_MapNodeOnCriticalPath(self):
+        workflow,telemetryFile=self.RunMapNodeWorkflow()
+        telemetry=NodeTelemetryDB(telemetryFile)
+        (run_id,subject),=telemetry.getLatestRunSubjects()
+        total,path=telemetry.getCriticalPath(run_id,subject)
+        pathWallTime=dict(path)
+        self.assertEqual([ fullname for fullname,wall_secs in path ],
+                         ['TelemetryWF.Source','TelemetryWF.Sleepers','TelemetryWF.Sink'])
+        ## Both subnodes ran at the same time, so the MapNode took one sleep, not two and not none.
+        self.assertTrue(SUBNODE_SLEEP_SECS <= pathWallTime['TelemetryWF.Sleepers'] < 2*SUBNODE_SLEEP_SECS,
+                        "MapNode wall time {0}".format(pathWallTime['TelemetryWF.Sleepers']))
+        self.assertTrue(total >= SUBNODE_SLEEP_SECS)
+
+    def test_EstimateCountsMapNodeItems(self):
+        workflow,telemetryFile=self.RunMapNodeWorkflow()
+        telemetry=NodeTelemetryDB(telemetryFile)
+        mapNodeHistory=telemetry.getMapNodeHistory()
+        runs,meanItems,itemWall,itemThreads,itemPeak,itemWrite=mapNodeHistory['Sleepers']
+        self.assertEqual((runs,meanItems),(1,2.0))
+        self.assertTrue(itemWall >= SUBNODE_SLEEP_SECS)
+        estimate=EstimateCost(workflow._create_flat_graph(),telemetry.getNodeHistory(),mapNodeHistory)
+        ## Both items count towards the core hours, and one of them towards the critical path.
+        self.assertTrue(estimate['core_hours']*3600.0 >= 2*SUBNODE_SLEEP_SECS)
+        self.assertTrue(SUBNODE_SLEEP_SECS <= estimate['critical_path_hours']*3600.0 < 2*SUBNODE_SLEEP_SECS)
+
+if __name__ == '__main__':
+    unittest.main()
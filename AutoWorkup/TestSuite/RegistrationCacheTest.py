@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+The cache key, restore, eviction and index of the RegistrationCache.
+
+The registrations are run by small ANTS and BRAINSFit scripts written into
+a temporary directory on the PATH.  They only write the files the
+interfaces expect and count how often they ran, which is all the cache
+can observe of the real programs.
+
+    python RegistrationCacheTest.py
+"""
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nipype.pipeline.engine as pe
+
+import RegistrationCache
+from RegistrationCache import RegistrationCache as RegistrationCacheIndex, ComputeRegistrationCacheKey, EnableRegistrationCache
+from BRAINSTools.BRAINSFit import BRAINSFit
+from BRAINSTools.BTants.ants import ANTS
+
+## Writes the three transforms of 'ANTS ... --output-naming <prefix>', and counts its runs.
+ANTS_SCRIPT = """#!{python}
+import sys
+prefix=sys.argv[sys.argv.index('--output-naming')+1]
+for postfix in ('Affine.txt','Warp.nii.gz','InverseWarp.nii.gz'):
+    open(prefix+postfix,'w').write(postfix*100)
+open({callsFile!r},'a').write('ANTS\\n')
+"""
+## Only needed to exist, the BRAINSFit nodes of these tests are never run.
+BRAINSFIT_SCRIPT = """#!{python}
+import sys
+sys.exit(1)
+"""
+
+class RegistrationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.testDir=tempfile.mkdtemp(prefix='RegistrationCacheTest')
+        self.startDir=os.getcwd()
+        self.binDir=os.path.join(self.testDir,'bin')
+        os.mkdir(self.binDir)
+        self.callsFile=os.path.join(self.testDir,'calls.txt')
+        for programName,script in (('ANTS',ANTS_SCRIPT),('BRAINSFit',BRAINSFIT_SCRIPT)):
+            programFile=os.path.join(self.binDir,programName)
+            open(programFile,'w').write(script.format(python=sys.executable,callsFile=self.callsFile))
+            os.chmod(programFile,os.stat(programFile).st_mode|stat.S_IXUSR)
+        self.originalPath=os.environ['PATH']
+        os.environ['PATH']=self.binDir+os.pathsep+self.originalPath
+        self.inputDir=os.path.join(self.testDir,'inputs')
+        os.mkdir(self.inputDir)
+        self.fixedImage=self.WriteInput('fixed.nii.gz','fixed image')
+        self.movingImage=self.WriteInput('moving.nii.gz','moving image')
+        self.otherImage=self.WriteInput('other.nii.gz','another moving image')
+        self.mask=self.WriteInput('mask.nii.gz','fixed mask')
+        self.cacheDir=os.path.join(self.testDir,'cache')
+
+    def tearDown(self):
+        os.environ['PATH']=self.originalPath
+        os.chdir(self.startDir)
+        shutil.rmtree(self.testDir)
+
+    def WriteInput(self, fileName, content):
+        fileName=os.path.join(self.inputDir,fileName)
+        open(fileName,'w').write(content)
+        return fileName
+
+    def MakeBRAINSFit(self, **inputs):
+        node=pe.Node(interface=BRAINSFit(),name='BFit')
+        node.inputs.fixedVolume=self.fixedImage
+        node.inputs.movingVolume=self.movingImage
+        node.inputs.outputTransform='outputTransform.mat'
+        node.inputs.numberOfSamples=100000
+        node.inputs.set(**inputs)
+        return node
+
+    def RunANTS(self, runName, movingImage):
+        """ Runs one cached ANTS registration in its own workflow directory, returns the node result """
+        workflow=pe.Workflow(name='RegistrationCacheWF')
+        workflow.base_dir=os.path.join(self.testDir,runName)
+        workflow.config['execution']={'crashdump_dir':self.testDir}
+        registration=pe.Node(interface=ANTS(),name='ANTSRegistration')
+        registration.inputs.dimension=3
+        registration.inputs.fixed_image=self.fixedImage
+        registration.inputs.moving_image=movingImage
+        registration.inputs.metric=['CC']
+        registration.inputs.metric_weight=[1.0]
+        registration.inputs.radius=[5]
+        registration.inputs.output_transform_prefix='subject_tfm'
+        registration.inputs.transformation_model='SyN'
+        workflow.add_nodes([registration])
+        EnableRegistrationCache(workflow,self.cacheDir,1.0)
+        executedGraph=workflow.run(plugin='Linear')
+        return executedGraph.nodes()[0].result
+
+    def CountRuns(self):
+        if not os.path.exists(self.callsFile):
+            return 0
+        return len(open(self.callsFile).readlines())
+
+    def StoreEntry(self, cache, name, sizeBytes):
+        """ Stores a fake registration of sizeBytes under the key name """
+        nodeDir=os.path.join(self.testDir,'stored_'+name)
+        os.mkdir(nodeDir)
+        open(os.path.join(nodeDir,'transform.txt'),'w').write('x'*sizeBytes)
+        roleDigests=dict([ (role,None) for role in RegistrationCache.REGISTRATION_ROLES ])
+        cache.Store(name,roleDigests,'',"ANTS",name,nodeDir)
+
+    def test_ThreadCountNotInKey(self):
+        singleThread=ComputeRegistrationCacheKey(self.MakeBRAINSFit(numberOfThreads=1))[0]
+        self.assertNotEqual(singleThread,None)
+        self.assertEqual(ComputeRegistrationCacheKey(self.MakeBRAINSFit(numberOfThreads=12))[0],singleThread)
+        self.assertEqual(ComputeRegistrationCacheKey(self.MakeBRAINSFit(numberOfThreads=1,
+          environ={'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS':'12'}))[0],singleThread)
+
+    def test_ParametersAndMasksChangeKey(self):
+        key=ComputeRegistrationCacheKey(self.MakeBRAINSFit())[0]
+        self.assertNotEqual(ComputeRegistrationCacheKey(self.MakeBRAINSFit(numberOfSamples=200000))[0],key)
+        maskedKey=ComputeRegistrationCacheKey(self.MakeBRAINSFit(fixedBinaryVolume=self.mask))[0]
+        self.assertNotEqual(maskedKey,key)
+        ## The same mask file with other content is another registration.
+        self.WriteInput('mask.nii.gz','another fixed mask')
+        self.assertNotEqual(ComputeRegistrationCacheKey(self.MakeBRAINSFit(fixedBinaryVolume=self.mask))[0],maskedKey)
+
+    def test_HitRestoresOutputs(self):
+        firstResult=self.RunANTS('first',self.movingImage)
+        self.assertEqual(self.CountRuns(),1)
+        secondResult=self.RunANTS('second',self.movingImage)
+        self.assertEqual(self.CountRuns(),1)
+        self.assertTrue(hasattr(secondResult.runtime,'registration_cache_key'))
+        for outputName in ('affine_transform','warp_transform','inverse_warp_transform'):
+            restoredFile=getattr(secondResult.outputs,outputName)
+            self.assertTrue(restoredFile.startswith(os.path.join(self.testDir,'second')))
+            self.assertEqual(open(restoredFile).read(),open(getattr(firstResult.outputs,outputName)).read())
+        self.RunANTS('third',self.otherImage)
+        self.assertEqual(self.CountRuns(),2)
+
+    def test_EvictionHonorsSizeCap(self):
+        cache=RegistrationCacheIndex(self.cacheDir,2500/(1024.0**3))
+        self.StoreEntry(cache,'aa01',1000)
+        self.StoreEntry(cache,'aa02',1000)
+        ## Using the older entry makes the other one the least recently used.
+        self.assertTrue(cache.Restore('aa01',os.path.join(self.testDir,'restored')))
+        self.StoreEntry(cache,'aa03',1000)
+        self.assertTrue(cache.getTotalSize() <= 2500)
+        self.assertEqual(sorted([ entry['cachekey'] for entry in cache.getEntries() ]),['aa01','aa03'])
+        self.assertFalse(os.path.exists(os.path.join(self.cacheDir,'aa','aa02')))
+
+    def test_RestoreMissesEntryEvictedWhileLinking(self):
+        cache=RegistrationCacheIndex(self.cacheDir,1.0)
+        self.StoreEntry(cache,'bb01',1000)
+        originalLinkTree=RegistrationCache._local_linkTree
+        def EvictWhileLinking(sourceDir, destinationDir):
+            ## Another job evicts the entry before any file is linked.
+            cache.maxSizeBytes=0
+            cache.Evict()
+            return originalLinkTree(sourceDir,destinationDir)
+        RegistrationCache._local_linkTree=EvictWhileLinking
+        try:
+            self.assertFalse(cache.Restore('bb01',os.path.join(self.testDir,'restored')))
+        finally:
+            RegistrationCache._local_linkTree=originalLinkTree
+
+    def test_FindRegistrationsOfImagePair(self):
+        self.RunANTS('first',self.movingImage)
+        self.RunANTS('other',self.otherImage)
+        cache=RegistrationCacheIndex(self.cacheDir,1.0)
+        entries=cache.FindRegistrations(fixedImage=self.fixedImage,movingImage=self.movingImage)
+        self.assertEqual(len(entries),1)
+        self.assertEqual(entries[0]['interface'],'ANTS')
+        self.assertEqual(entries[0]['moving_digest'],cache.Digest(self.movingImage))
+        self.assertEqual(len(cache.FindRegistrations(fixedImage=self.fixedImage)),2)
+        self.assertEqual(cache.FindRegistrations(fixedImage=self.movingImage),[])
+
+if __name__ == '__main__':
+    unittest.main()
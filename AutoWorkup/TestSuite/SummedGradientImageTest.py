@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#################################################################################
+## Program:   BRAINS (Brain Research: Analysis of Images, Networks, and Systems)
+## Language:  Python
+##
+## Author:  Hans J. Johnson
+##
+##      This software is distributed WITHOUT ANY WARRANTY; without even
+##      the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+##      PURPOSE.  See the above copyright notices for more information.
+##
+#################################################################################
+"""
+Compare the SGI node of WorkupT1T2BRAINSCut with the programs it replaced,
+GradientAnisotropicDiffusionImageFilter on the T1 and T2 volumes followed by
+GenerateSummedGradientImage, on the same two volumes.  The node must write
+the same voxels as the programs.
+
+    python SummedGradientImageTest.py --T1Volume T1.nii.gz --T2Volume T2.nii.gz \\
+        --GradientAnisotropicDiffusionImageFilter GradientAnisotropicDiffusionImageFilter \\
+        --GenerateSummedGradientImage GenerateSummedGradientImage --outputDirectory /tmp/SGI
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WorkupT1T2BRAINSCut import ComputeSummedGradientImage
+
+## The same parameters as the SGI node in CreateBRAINSCutWorkflow
+TIME_STEP = 0.025
+CONDUCTANCE = 1
+NUMBER_OF_ITERATIONS = 5
+
+def RunPrograms(args):
+    diffused=list()
+    for volumeName,volume in (('GADT1',args.T1Volume),('GADT2',args.T2Volume)):
+        outputVolume=os.path.join(args.outputDirectory,volumeName+'.nii.gz')
+        subprocess.check_call([args.GradientAnisotropicDiffusionImageFilter,
+            '--inputVolume',volume,'--outputVolume',outputVolume,'--timeStep',str(TIME_STEP),
+            '--conductance',str(CONDUCTANCE),'--numberOfIterations',str(NUMBER_OF_ITERATIONS)])
+        diffused.append(outputVolume)
+    outputFileName=os.path.join(args.outputDirectory,'SummedGradImageCLI.nii.gz')
+    subprocess.check_call([args.GenerateSummedGradientImage,'--inputVolume1',diffused[0],
+        '--inputVolume2',diffused[1],'--outputFileName',outputFileName])
+    return outputFileName
+
+def main(argv):
+    argParser=argparse.ArgumentParser(description='Compare ComputeSummedGradientImage with the BRAINS programs')
+    argParser.add_argument('--T1Volume',required=True)
+    argParser.add_argument('--T2Volume',required=True)
+    argParser.add_argument('--GradientAnisotropicDiffusionImageFilter',required=True)
+    argParser.add_argument('--GenerateSummedGradientImage',required=True)
+    argParser.add_argument('--outputDirectory',required=True)
+    args=argParser.parse_args(argv)
+    if not os.path.exists(args.outputDirectory):
+        os.makedirs(args.outputDirectory)
+
+    programImage=sitk.ReadImage(RunPrograms(args))
+    nodeImage=sitk.ReadImage(ComputeSummedGradientImage(args.T1Volume,args.T2Volume,TIME_STEP,CONDUCTANCE,
+        NUMBER_OF_ITERATIONS,os.path.join(args.outputDirectory,'SummedGradImageNode.nii.gz')))
+
+    if nodeImage.GetPixelIDValue() != programImage.GetPixelIDValue():
+        print("FAILED: pixel type {0} instead of {1}".format(nodeImage.GetPixelIDTypeAsString(),programImage.GetPixelIDTypeAsString()))
+        return 1
+    if nodeImage.GetSize() != programImage.GetSize() or not np.allclose(nodeImage.GetSpacing(),programImage.GetSpacing()):
+        print("FAILED: image grid differs")
+        return 1
+    difference=np.abs(sitk.GetArrayFromImage(nodeImage).astype(np.int16)-sitk.GetArrayFromImage(programImage).astype(np.int16))
+    print("Maximum difference {0}, differing voxels {1}".format(difference.max(),np.count_nonzero(difference)))
+    if difference.max() != 0:
+        print("FAILED: ComputeSummedGradientImage does not reproduce the programs")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -42,10 +42,21 @@ from BRAINSTools import *
 from BRAINSTools.BTants.normalize import WarpImageMultiTransform
 
 from WorkupT1T2AtlasNode import MakeAtlasNode
+import FastContentHash
+import ImageFormatPolicy
+import ResourceProfiles
+from LightweightNodes import MarkLightweightNode
 
 def getListIndex( imageList, index):
     return imageList[index]
 
+def getFilenamesByScantype( scanDictionary, scantypelist):
+    """ The local equivalent of SessionDB.getFilenamesByScantype for the 'scans' of SessionDB.getSubjectSessionsInfo """
+    returnList = list()
+    for currScanType in scantypelist:
+        returnList.extend( scanDictionary.get(currScanType,[]) )
+    return returnList
+
 #HACK:  [('buildTemplateIteration2', 'SUBJECT_TEMPLATES/0249/buildTemplateIteration2')]
 def GenerateSubjectOutputPattern(subjectid):
     """ This function generates output path substitutions for workflows and nodes that conform to a common standard.
@@ -68,19 +79,21 @@ pe.sub(subs,test)
 """
     patternList=[]
 
-    find_pat=os.path.join('ANTSTemplate','Iteration02_Reshaped.nii.gz')
+    ## The number of template iterations depends on when the template converged.
+    find_pat=os.path.join('ANTSTemplate',r'Iteration[0-9]*_Reshaped.nii.gz')
     replace_pat=os.path.join('SUBJECT_TEMPLATES',subjectid,r'AVG_T1.nii.gz')
     patternList.append( (find_pat,replace_pat) )
 
-    find_pat=os.path.join('ANTSTemplate',r'_ReshapeAveragePassiveImageWithShapeUpdate[0-9]*/AVG_[A-Z0-9]*WARP_(?P<structure>AVG_[A-Z0-9]*.nii.gz)')
+    ## The passive templates of FusedTemplateUpdate are not in MapNode sub directories.
+    find_pat=os.path.join('ANTSTemplate',r'(_ReshapeAveragePassiveImageWithShapeUpdate[0-9]*/)?AVG_[A-Z0-9]*WARP_(?P<structure>AVG_[A-Z0-9]*.nii.gz)')
     replace_pat=os.path.join('SUBJECT_TEMPLATES',subjectid,r'\g<structure>')
     patternList.append( (find_pat,replace_pat) )
 
-    find_pat=os.path.join('ANTSTemplate',r'CLIPPED_AVG_[A-Z]*WARP_(?P<structure>AVG_[A-Z]*.nii.gz)')
+    ## MakeNewAtlasTemplate writes the CLIPPED_ images with its clippedExtension, .nii or .nii.gz
+    find_pat=os.path.join('ANTSTemplate',r'CLIPPED_AVG_[A-Z]*WARP_(?P<structure>AVG_[A-Z]*\.nii(\.gz)?)')
     replace_pat=os.path.join('SUBJECT_TEMPLATES',subjectid,r'\g<structure>')
     patternList.append( (find_pat,replace_pat) )
 
-    print "HACK: ", patternList
     return patternList
 
 def GenerateOutputPattern(projectid, subjectid, sessionid,DefaultNodeName):
@@ -90,7 +103,6 @@ def GenerateOutputPattern(projectid, subjectid, sessionid,DefaultNodeName):
     find_pat=os.path.join(DefaultNodeName)
     replace_pat=os.path.join(projectid,subjectid,sessionid,DefaultNodeName)
     patternList.append( (find_pat,replace_pat) )
-    print "HACK: ", patternList
     return patternList
 
 def GenerateAccumulatorImagesOutputPattern(projectid, subjectid, sessionid):
@@ -100,7 +112,6 @@ def GenerateAccumulatorImagesOutputPattern(projectid, subjectid, sessionid):
     find_pat="POSTERIOR_"
     replace_pat=os.path.join(projectid,subjectid,sessionid)+"/POSTERIOR_"
     patternList.append( (find_pat,replace_pat) )
-    print "HACK: ", patternList
     return patternList
 
 ## This takes several lists and merges them, but it also removes all empty values from the lists
@@ -117,32 +128,43 @@ def MergeByExtendListElements(t2_averageList,pd_averageList,fl_averageList,outpu
     return ListOfPosteriorImagesDictionary
 
 def MakeNewAtlasTemplate(t1_image,deformed_list,
-            AtlasTemplate,outDefinition):
+            AtlasTemplate,outDefinition,maxVolumesInMemory=8,clippedExtension='.nii.gz'):
+    """
+    The brain mask is binarized and dilated once, and the interior priors are clipped
+    by forked workers.  The dilated mask and the binary mask are two volumes, and each
+    worker holds about two more, so at most (maxVolumesInMemory-2)/2 workers run at once,
+    and never more than the NSLOTS threads granted to the node, see its resource profile.
+    Use clippedExtension='.nii' to skip the gzip compression when the CLIPPED_ images
+    are only read by the next pipeline stage.
+    """
     import os
+    import signal
     import sys
     import SimpleITK as sitk
+    from ImageFormatPolicy import StripImageExtension
+    ## The deformed images and the atlas entries they replace, without their image extension.
     patternDict= {
-        'AVG_AIRWARP_AVG_AIR.nii.gz':'@ATLAS_DIRECTORY@/EXTENDED_AIR.nii.gz',
-        'AVG_BGMWARP_AVG_BGM.nii.gz':'@ATLAS_DIRECTORY@/EXTENDED_BASALTISSUE.nii.gz',
-        'AVG_CRBLGMWARP_AVG_CRBLGM.nii.gz':'@ATLAS_DIRECTORY@/EXTENDED_CRBLGM.nii.gz',
-        'AVG_CRBLWMWARP_AVG_CRBLWM.nii.gz':'@ATLAS_DIRECTORY@/EXTENDED_CRBLWM.nii.gz',
-        'AVG_CSFWARP_AVG_CSF.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_CSF.nii.gz',
-        'AVG_NOTCSFWARP_AVG_NOTCSF.nii.gz' :'@ATLAS_DIRECTORY@/EXTENDED_NOTCSF.nii.gz',
-        'AVG_NOTGMWARP_AVG_NOTGM.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_NOTGM.nii.gz',
-        'AVG_NOTVBWARP_AVG_NOTVB.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_NOTVB.nii.gz',
-        'AVG_NOTWMWARP_AVG_NOTWM.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_NOTWM.nii.gz',
-        'AVG_SURFGMWARP_AVG_SURFGM.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_SURFGM.nii.gz',
-        'AVG_VBWARP_AVG_VB.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_VB.nii.gz',
-        'AVG_WMWARP_AVG_WM.nii.gz':'@ATLAS_DIRECTORY@/EXTENDED_WM.nii.gz',
-        'AVG_ACCUMBENWARP_AVG_ACCUMBEN.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_ACCUMBEN.nii.gz',
-        'AVG_CAUDATEWARP_AVG_CAUDATE.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_CAUDATE.nii.gz',
-        'AVG_PUTAMENWARP_AVG_PUTAMEN.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_PUTAMEN.nii.gz',
-        'AVG_GLOBUSWARP_AVG_GLOBUS.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_GLOBUS.nii.gz',
-        'AVG_THALAMUSWARP_AVG_THALAMUS.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_THALAMUS.nii.gz',
-        'AVG_HIPPOCAMPUSWARP_AVG_HIPPOCAMPUS.nii.gz': '@ATLAS_DIRECTORY@/EXTENDED_HIPPOCAMPUS.nii.gz',
-        'AVG_T2WARP_AVG_T2.nii.gz':'@ATLAS_DIRECTORY@/template_t2.nii.gz',
-        'AVG_BRAINMASKWARP_AVG_BRAINMASK.nii.gz':'@ATLAS_DIRECTORY@/template_brain.nii.gz',
-        'T1_RESHAPED.nii.gz':'@ATLAS_DIRECTORY@/template_t1.nii.gz'
+        'AVG_AIRWARP_AVG_AIR':'@ATLAS_DIRECTORY@/EXTENDED_AIR.nii.gz',
+        'AVG_BGMWARP_AVG_BGM':'@ATLAS_DIRECTORY@/EXTENDED_BASALTISSUE.nii.gz',
+        'AVG_CRBLGMWARP_AVG_CRBLGM':'@ATLAS_DIRECTORY@/EXTENDED_CRBLGM.nii.gz',
+        'AVG_CRBLWMWARP_AVG_CRBLWM':'@ATLAS_DIRECTORY@/EXTENDED_CRBLWM.nii.gz',
+        'AVG_CSFWARP_AVG_CSF': '@ATLAS_DIRECTORY@/EXTENDED_CSF.nii.gz',
+        'AVG_NOTCSFWARP_AVG_NOTCSF' :'@ATLAS_DIRECTORY@/EXTENDED_NOTCSF.nii.gz',
+        'AVG_NOTGMWARP_AVG_NOTGM': '@ATLAS_DIRECTORY@/EXTENDED_NOTGM.nii.gz',
+        'AVG_NOTVBWARP_AVG_NOTVB': '@ATLAS_DIRECTORY@/EXTENDED_NOTVB.nii.gz',
+        'AVG_NOTWMWARP_AVG_NOTWM': '@ATLAS_DIRECTORY@/EXTENDED_NOTWM.nii.gz',
+        'AVG_SURFGMWARP_AVG_SURFGM': '@ATLAS_DIRECTORY@/EXTENDED_SURFGM.nii.gz',
+        'AVG_VBWARP_AVG_VB': '@ATLAS_DIRECTORY@/EXTENDED_VB.nii.gz',
+        'AVG_WMWARP_AVG_WM':'@ATLAS_DIRECTORY@/EXTENDED_WM.nii.gz',
+        'AVG_ACCUMBENWARP_AVG_ACCUMBEN': '@ATLAS_DIRECTORY@/EXTENDED_ACCUMBEN.nii.gz',
+        'AVG_CAUDATEWARP_AVG_CAUDATE': '@ATLAS_DIRECTORY@/EXTENDED_CAUDATE.nii.gz',
+        'AVG_PUTAMENWARP_AVG_PUTAMEN': '@ATLAS_DIRECTORY@/EXTENDED_PUTAMEN.nii.gz',
+        'AVG_GLOBUSWARP_AVG_GLOBUS': '@ATLAS_DIRECTORY@/EXTENDED_GLOBUS.nii.gz',
+        'AVG_THALAMUSWARP_AVG_THALAMUS': '@ATLAS_DIRECTORY@/EXTENDED_THALAMUS.nii.gz',
+        'AVG_HIPPOCAMPUSWARP_AVG_HIPPOCAMPUS': '@ATLAS_DIRECTORY@/EXTENDED_HIPPOCAMPUS.nii.gz',
+        'AVG_T2WARP_AVG_T2':'@ATLAS_DIRECTORY@/template_t2.nii.gz',
+        'AVG_BRAINMASKWARP_AVG_BRAINMASK':'@ATLAS_DIRECTORY@/template_brain.nii.gz',
+        'T1_RESHAPED':'@ATLAS_DIRECTORY@/template_t1.nii.gz'
         }
     templateFile = open(AtlasTemplate,'r')
     content = templateFile.read()              # read entire file into memory
@@ -151,58 +173,103 @@ def MakeNewAtlasTemplate(t1_image,deformed_list,
     ## Now clean up the posteriors based on anatomical knowlege.
     ## sometimes the posteriors are not relevant for priors
     ## due to anomolies around the edges.
-    load_images_list=dict()
-    for full_pathname in deformed_list:
-        base_name=os.path.basename(full_pathname)
-        if base_name in patternDict.keys():
-            load_images_list[base_name]=sitk.ReadImage(full_pathname)
+    brainmask_pathname=[ full_pathname for full_pathname in deformed_list
+                         if StripImageExtension(os.path.basename(full_pathname)) == 'AVG_BRAINMASKWARP_AVG_BRAINMASK' ][0]
     ## Make binary dilated mask
-    binmask=sitk.BinaryThreshold(load_images_list['AVG_BRAINMASKWARP_AVG_BRAINMASK.nii.gz'],1,1000000)
+    binmask=sitk.BinaryThreshold(sitk.ReadImage(brainmask_pathname),1,1000000)
     dilated5=sitk.DilateObjectMorphology(binmask,5)
     dilated5=sitk.Cast(dilated5,sitk.sitkFloat32) # Convert to Float32 for multiply
     ## Now clip the interior brain mask with dilated5
     interiorPriors = [
-        'AVG_BGMWARP_AVG_BGM.nii.gz',
-        'AVG_CRBLGMWARP_AVG_CRBLGM.nii.gz',
-        'AVG_CRBLWMWARP_AVG_CRBLWM.nii.gz',
-        'AVG_CSFWARP_AVG_CSF.nii.gz',
-        'AVG_SURFGMWARP_AVG_SURFGM.nii.gz',
-        'AVG_VBWARP_AVG_VB.nii.gz',
-        'AVG_WMWARP_AVG_WM.nii.gz',
-        'AVG_ACCUMBENWARP_AVG_ACCUMBEN.nii.gz',
-        'AVG_CAUDATEWARP_AVG_CAUDATE.nii.gz',
-        'AVG_PUTAMENWARP_AVG_PUTAMEN.nii.gz',
-        'AVG_GLOBUSWARP_AVG_GLOBUS.nii.gz',
-        'AVG_THALAMUSWARP_AVG_THALAMUS.nii.gz',
-        'AVG_HIPPOCAMPUSWARP_AVG_HIPPOCAMPUS.nii.gz',
+        'AVG_BGMWARP_AVG_BGM',
+        'AVG_CRBLGMWARP_AVG_CRBLGM',
+        'AVG_CRBLWMWARP_AVG_CRBLWM',
+        'AVG_CSFWARP_AVG_CSF',
+        'AVG_SURFGMWARP_AVG_SURFGM',
+        'AVG_VBWARP_AVG_VB',
+        'AVG_WMWARP_AVG_WM',
+        'AVG_ACCUMBENWARP_AVG_ACCUMBEN',
+        'AVG_CAUDATEWARP_AVG_CAUDATE',
+        'AVG_PUTAMENWARP_AVG_PUTAMEN',
+        'AVG_GLOBUSWARP_AVG_GLOBUS',
+        'AVG_THALAMUSWARP_AVG_THALAMUS',
+        'AVG_HIPPOCAMPUSWARP_AVG_HIPPOCAMPUS',
         ]
-    clean_deformed_list=deformed_list
-    for index in range(0,len(deformed_list)):
-        full_pathname=deformed_list[index]
-        base_name=os.path.basename(full_pathname)
-        if base_name == 'AVG_BRAINMASKWARP_AVG_BRAINMASK.nii.gz':
-            ### Make Brain Mask Binary
-            clipped_name='CLIPPED_'+base_name
-            patternDict[clipped_name]=patternDict[base_name]
-            sitk.WriteImage(binmask,clipped_name)
-            clean_deformed_list[index]=os.path.realpath(clipped_name)
-        if base_name in interiorPriors:
-            ### Make clipped posteriors for brain regions
-            curr=sitk.Cast(sitk.ReadImage(full_pathname),sitk.sitkFloat32)
-            curr=curr*dilated5
-            clipped_name='CLIPPED_'+base_name
-            patternDict[clipped_name]=patternDict[base_name]
-            sitk.WriteImage(curr,clipped_name)
-            clean_deformed_list[index]=os.path.realpath(clipped_name)
-            print "HACK: ", clean_deformed_list[index]
-            curr=None
+    def ClipWithDilatedMask(full_pathname,clipped_name):
+        curr=sitk.Cast(sitk.ReadImage(full_pathname),sitk.sitkFloat32)
+        sitk.WriteImage(curr*dilated5,clipped_name)
+    def WriteBinaryMask(full_pathname,clipped_name):
+        sitk.WriteImage(binmask,clipped_name)
+    ## Each worker is one of the threads granted to this node, SGE and the ResourceLimitedMultiProcPlugin set NSLOTS.
+    grantedThreads=max(1,int(os.environ.get('NSLOTS','1')))
+    maxWorkers=max(1,min((int(maxVolumesInMemory)-2)/2,grantedThreads))
+    runningWorkers=list()
+    def WaitForOldestWorker():
+        pid,clipped_name=runningWorkers.pop(0)
+        finishedPid,status=os.waitpid(pid,0)
+        if status != 0:
+            print "ERROR:  Failed to write {0}".format(clipped_name)
+            sys.exit(-1)
+    def StopAllWorkers():
+        """ Kills and reaps the workers that are still running, so a failure leaves no children behind """
+        for pid,clipped_name in runningWorkers:
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except OSError:
+                pass ## It already exited.
+        for pid,clipped_name in runningWorkers:
+            os.waitpid(pid,0)
+        del runningWorkers[:]
+    def StartWorker(function,full_pathname,clipped_name):
+        """ The children inherit dilated5 and binmask, so nothing is pickled or re-read """
+        if not hasattr(os,'fork'):
+            function(full_pathname,clipped_name)
+            return
+        while len(runningWorkers) >= maxWorkers:
+            WaitForOldestWorker()
+        pid=os.fork()
+        if pid == 0:
+            try:
+                ## The workers are the threads of this node, ITK must not start its own in each of them.
+                os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']='1'
+                if hasattr(sitk.ProcessObject,'SetGlobalDefaultNumberOfThreads'):
+                    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+                function(full_pathname,clipped_name)
+                os._exit(0)
+            except:
+                import traceback
+                traceback.print_exc()
+                os._exit(1)
+        runningWorkers.append( (pid,clipped_name) )
+
+    clean_deformed_list=list(deformed_list)
+    try:
+        for index in range(0,len(deformed_list)):
+            full_pathname=deformed_list[index]
+            image_name=StripImageExtension(os.path.basename(full_pathname))
+            clipped_image_name='CLIPPED_'+image_name
+            clipped_name=clipped_image_name+clippedExtension
+            if image_name == 'AVG_BRAINMASKWARP_AVG_BRAINMASK':
+                ### Make Brain Mask Binary
+                patternDict[clipped_image_name]=patternDict[image_name]
+                StartWorker(WriteBinaryMask,full_pathname,clipped_name)
+                clean_deformed_list[index]=os.path.realpath(clipped_name)
+            if image_name in interiorPriors:
+                ### Make clipped posteriors for brain regions
+                patternDict[clipped_image_name]=patternDict[image_name]
+                StartWorker(ClipWithDilatedMask,full_pathname,clipped_name)
+                clean_deformed_list[index]=os.path.realpath(clipped_name)
+        while len(runningWorkers) > 0:
+            WaitForOldestWorker()
+    finally:
+        StopAllWorkers()
     binmask=None
     dilated5=None
 
     for full_pathname in clean_deformed_list:
-        base_name=os.path.basename(full_pathname)
-        if base_name in patternDict.keys():
-            content=content.replace(patternDict[base_name],full_pathname)
+        image_name=StripImageExtension(os.path.basename(full_pathname))
+        if image_name in patternDict.keys():
+            content=content.replace(patternDict[image_name],full_pathname)
     content=content.replace('@ATLAS_DIRECTORY@/template_t1.nii.gz',t1_image)
     ## NOTE:  HEAD REGION CAN JUST BE T1 image.
     content=content.replace('@ATLAS_DIRECTORY@/template_headregion.nii.gz',t1_image)
@@ -215,60 +282,71 @@ def MakeNewAtlasTemplate(t1_image,deformed_list,
 
 def AccumulateLikeTissuePosteriors(posteriorImages):
     import os
-    import sys
     import SimpleITK as sitk
+    from ImageFormatPolicy import IntermediateImageName, StripImageExtension
     ## Now clean up the posteriors based on anatomical knowlege.
     ## sometimes the posteriors are not relevant for priors
     ## due to anomolies around the edges.
-    load_images_list=dict()
+    ##
+    ## Only one accumulated total and one posterior are held in memory at a time,
+    ## the posteriors are read when their group is summed and added in place.
+    ## Each total is written before the next group is read.  The totals are
+    ## intermediate images, the ACCUMULATED_POSTERIORS sink compresses them.
+    posteriorPathsByName=dict()
     for full_pathname in posteriorImages.values():
-        base_name=os.path.basename(full_pathname)
-        load_images_list[base_name]=sitk.ReadImage(full_pathname)
+        base_name=StripImageExtension(os.path.basename(full_pathname))
+        posteriorPathsByName[base_name]=full_pathname
+    def ReadAsArray(base_name):
+        image=sitk.ReadImage(posteriorPathsByName[base_name])
+        return image,sitk.GetArrayFromImage(image)
     GM_ACCUM=[
-              'POSTERIOR_ACCUMBEN.nii.gz',
-              'POSTERIOR_CAUDATE.nii.gz',
-              'POSTERIOR_CRBLGM.nii.gz',
-              'POSTERIOR_HIPPOCAMPUS.nii.gz',
-              'POSTERIOR_PUTAMEN.nii.gz',
-              'POSTERIOR_THALAMUS.nii.gz',
-              'POSTERIOR_SURFGM.nii.gz',
+              'POSTERIOR_ACCUMBEN',
+              'POSTERIOR_CAUDATE',
+              'POSTERIOR_CRBLGM',
+              'POSTERIOR_HIPPOCAMPUS',
+              'POSTERIOR_PUTAMEN',
+              'POSTERIOR_THALAMUS',
+              'POSTERIOR_SURFGM',
              ]
     WM_ACCUM=[
-              'POSTERIOR_CRBLWM.nii.gz',
-              'POSTERIOR_WM.nii.gz'
+              'POSTERIOR_CRBLWM',
+              'POSTERIOR_WM'
               ]
     CSF_ACCUM=[
-              'POSTERIOR_CSF.nii.gz',
+              'POSTERIOR_CSF',
               ]
     VB_ACCUM=[
-              'POSTERIOR_VB.nii.gz',
+              'POSTERIOR_VB',
               ]
     GLOBUS_ACCUM=[
-              'POSTERIOR_GLOBUS.nii.gz',
+              'POSTERIOR_GLOBUS',
               ]
     BACKGROUND_ACCUM=[
-              'POSTERIOR_AIR.nii.gz',
-              'POSTERIOR_NOTCSF.nii.gz',
-              'POSTERIOR_NOTGM.nii.gz',
-              'POSTERIOR_NOTVB.nii.gz',
-              'POSTERIOR_NOTWM.nii.gz',
+              'POSTERIOR_AIR',
+              'POSTERIOR_NOTCSF',
+              'POSTERIOR_NOTGM',
+              'POSTERIOR_NOTVB',
+              'POSTERIOR_NOTWM',
               ]
     ## The next 2 items MUST be syncronized
-    AccumulatePriorsNames=['POSTERIOR_GM_TOTAL.nii.gz','POSTERIOR_WM_TOTAL.nii.gz',
-                        'POSTERIOR_CSF_TOTAL.nii.gz','POSTERIOR_VB_TOTAL.nii.gz',
-                        'POSTERIOR_GLOBUS_TOTAL.nii.gz','POSTERIOR_BACKGROUND_TOTAL.nii.gz']
+    AccumulatePriorsNames=[ IntermediateImageName(baseName) for baseName in
+                          ['POSTERIOR_GM_TOTAL','POSTERIOR_WM_TOTAL',
+                           'POSTERIOR_CSF_TOTAL','POSTERIOR_VB_TOTAL',
+                           'POSTERIOR_GLOBUS_TOTAL','POSTERIOR_BACKGROUND_TOTAL'] ]
     ForcedOrderingLists=[GM_ACCUM,WM_ACCUM,CSF_ACCUM,VB_ACCUM,GLOBUS_ACCUM,BACKGROUND_ACCUM]
     AccumulatePriorsList=list()
     for index in range(0,len(ForcedOrderingLists)):
         outname=AccumulatePriorsNames[index]
         inlist=ForcedOrderingLists[index]
-        accum_image= load_images_list[ inlist[0] ] # copy first image
+        reference_image,accum_array = ReadAsArray(inlist[0]) # The first array is the accumulation buffer
         for curr_image in range(1,len(inlist)):
-            accum_image=accum_image + load_images_list[ inlist[curr_image] ]
+            accum_array += ReadAsArray(inlist[curr_image])[1]
+        accum_image=sitk.GetImageFromArray(accum_array)
+        accum_image.CopyInformation(reference_image)
+        del reference_image,accum_array
         sitk.WriteImage(accum_image,outname)
+        del accum_image
         AccumulatePriorsList.append(os.path.realpath(outname))
-    print "HACK \n\n\n\n\n\n\n HACK \n\n\n: {APL}\n".format(APL=AccumulatePriorsList)
-    print ": {APN}\n".format(APN=AccumulatePriorsNames)
     return AccumulatePriorsList,AccumulatePriorsNames
 ###########################################################################
 ###########################################################################
@@ -283,26 +361,27 @@ def AccumulateLikeTissuePosteriors(posteriorImages):
 ###########################################################################
 ###########################################################################
 def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBaseDirectoryResults, ExperimentDatabase, atlas_fname_wpath, BCD_model_path,
-               InterpolationMode="Linear", Mode=10,DwiList=[],WORKFLOW_COMPONENTS=[],CLUSTER_QUEUE=''):
+               InterpolationMode="Linear", Mode=10,DwiList=[],WORKFLOW_COMPONENTS=[],CLUSTER_QUEUE='',WorkflowName="BAW_20120813"):
     """
     Run autoworkup on all subjects data defined in the ExperimentDatabase
 
     This is the main function to call when processing a data set with T1 & T2
     data.  ExperimentBaseDirectoryPrefix is the base of the directory to place results, T1Images & T2Images
     are the lists of images to be used in the auto-workup. atlas_fname_wpath is
-    the path and filename of the atlas to use.
+    the path and filename of the atlas to use.  WorkflowName must be unique per
+    subject when several subject workflows are combined with MakeMultiSubjectWorkflow.
     """
 
     print "Building Pipeline"
     ########### PIPELINE INITIALIZATION #############
-    baw200 = pe.Workflow(name="BAW_20120813")
+    baw200 = pe.Workflow(name=WorkflowName)
     baw200.config['execution'] = {
                                      'plugin':'Linear',
                                      #'stop_on_first_crash':'true',
                                      #'stop_on_first_rerun': 'true',
                                      'stop_on_first_crash':'false',
                                      'stop_on_first_rerun': 'false',      ## This stops at first attempt to rerun, before running, and before deleting previous results.
-                                     'hash_method': 'timestamp',
+                                     'hash_method': 'content',          ## FastContentHash remembers the digests by (inode,size,mtime)
                                      'single_thread_matlab':'true',       ## Multi-core 2011a  multi-core for matrix multiplication.
                                      'remove_unnecessary_outputs':'false',
                                      'use_relative_paths':'false',         ## relative paths should be on, require hash update when changed.
@@ -331,24 +410,21 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
         print("===================== SUBJECT: {0} ===========================".format(subjectid))
         PHASE_1_oneSubjWorkflow=dict()
         PHASE_1_subjInfoNode=dict()
-        allSessions = ExperimentDatabase.getSessionsFromSubject(subjectid)
+        ## One query for the whole subject, shared by both phases below.
+        allSessions,sessionsInfo = ExperimentDatabase.getSubjectSessionsInfo(subjectid)
         print("Running sessions: {ses} for subject {sub}".format(ses=allSessions,sub=subjectid))
         BAtlas[subjectid] = MakeAtlasNode(atlas_fname_wpath,"BAtlas_"+str(subjectid)) ## Call function to create node
 
        
         for sessionid in allSessions:
-            global_AllT1s=ExperimentDatabase.getFilenamesByScantype(sessionid,['T1-30','T1-15'])
-            global_AllT2s=ExperimentDatabase.getFilenamesByScantype(sessionid,['T2-30','T2-15'])
-            global_AllPDs=ExperimentDatabase.getFilenamesByScantype(sessionid,['PD-30','PD-15'])
-            global_AllFLs=ExperimentDatabase.getFilenamesByScantype(sessionid,['FL-30','FL-15'])
-            global_AllOthers=ExperimentDatabase.getFilenamesByScantype(sessionid,['OTHER-30','OTHER-15'])
-            print("HACK:  all T1s: {0} {1}".format(global_AllT1s, len(global_AllT1s) ))
-            print("HACK:  all T2s: {0} {1}".format(global_AllT2s, len(global_AllT2s) ))
-            print("HACK:  all PDs: {0} {1}".format(global_AllPDs, len(global_AllPDs) ))
-            print("HACK:  all FLs: {0} {1}".format(global_AllFLs, len(global_AllFLs) ))
-            print("HACK:  all Others: {0} {1}".format(global_AllOthers, len(global_AllOthers) ))
-
-            projectid = ExperimentDatabase.getProjFromSession(sessionid)
+            sessionScans=sessionsInfo[sessionid]['scans']
+            global_AllT1s=getFilenamesByScantype(sessionScans,['T1-30','T1-15'])
+            global_AllT2s=getFilenamesByScantype(sessionScans,['T2-30','T2-15'])
+            global_AllPDs=getFilenamesByScantype(sessionScans,['PD-30','PD-15'])
+            global_AllFLs=getFilenamesByScantype(sessionScans,['FL-30','FL-15'])
+            global_AllOthers=getFilenamesByScantype(sessionScans,['OTHER-30','OTHER-15'])
+
+            projectid = sessionsInfo[sessionid]['project']
             print("PROJECT: {0} SUBJECT: {1} SESSION: {2}".format(projectid,subjectid,sessionid))
             PHASE_1_subjInfoNode[sessionid] = pe.Node(interface=IdentityInterface(fields=
                     ['sessionid','subjectid','projectid',
@@ -415,7 +491,6 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                                           run_without_submitting=True,
                                           name=mergeSubjectSessionNamesPosteriors)
             index=1
-            #print("HACK: HACK: HACK:  {0}".format(allSessions))
             for sessionid in allSessions:
                 index_name='in'+str(index)
                 index+=1
@@ -441,45 +516,45 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
 
             from BRAINSTools.BTants.antsSimpleAverageWF import antsSimpleAverageWF
             ### USE ANTS
-            from BRAINSTools.BTants.buildtemplateparallel import ANTSTemplateBuildSingleIterationWF
+            from BRAINSTools.BTants.buildtemplateparallel import ANTSTemplateBuildAdaptiveWF
             ### USE ANTS REGISTRATION
             #from BRAINSTools.BTants.buildtemplateparallel_antsRegistration import antsRegistrationTemplateBuildSingleIterationWF
 
-            myInitAvgWF = antsSimpleAverageWF()
-            baw200.connect(MergeT1s[subjectid], 'out', myInitAvgWF, 'InputSpec.images')
-
             TEMPLATE_BUILD_RUN_MODE='MULTI_IMAGE'
             if numSessions == 1:
                 TEMPLATE_BUILD_RUN_MODE='SINGLE_IMAGE'
 
-            buildTemplateIteration1 = ANTSTemplateBuildSingleIterationWF('Iteration01',CLUSTER_QUEUE,TEMPLATE_BUILD_RUN_MODE)
-            baw200.connect(myInitAvgWF, 'OutputSpec.average_image', buildTemplateIteration1, 'InputSpec.fixed_image')
-            baw200.connect(MergeT1s[subjectid], 'out', buildTemplateIteration1, 'InputSpec.images')
-            baw200.connect(MergeByExtendListElementsNode, 'ListOfExtendedPassiveImages', buildTemplateIteration1, 'InputSpec.ListOfPassiveImagesDictionararies')
-
-            buildTemplateIteration2 = buildTemplateIteration1.clone(name='buildTemplateIteration2')
-            buildTemplateIteration2 = ANTSTemplateBuildSingleIterationWF('Iteration02',CLUSTER_QUEUE,TEMPLATE_BUILD_RUN_MODE)
-            baw200.connect(buildTemplateIteration1, 'OutputSpec.template', buildTemplateIteration2, 'InputSpec.fixed_image')
-            baw200.connect(MergeT1s[subjectid], 'out', buildTemplateIteration2, 'InputSpec.images')
-            baw200.connect(MergeByExtendListElementsNode, 'ListOfExtendedPassiveImages', buildTemplateIteration2, 'InputSpec.ListOfPassiveImagesDictionararies')
+            ## Iterate the template until successive templates agree, see ANTSTemplateBuildAdaptiveWF.
+            ## A single session is its own template, so it needs neither the initial average nor any registration.
+            buildTemplateIterations = ANTSTemplateBuildAdaptiveWF(CLUSTER_QUEUE,TEMPLATE_BUILD_RUN_MODE)
+            if TEMPLATE_BUILD_RUN_MODE != 'SINGLE_IMAGE':
+                myInitAvgWF = antsSimpleAverageWF()
+                baw200.connect(MergeT1s[subjectid], 'out', myInitAvgWF, 'InputSpec.images')
+                baw200.connect(myInitAvgWF, 'OutputSpec.average_image', buildTemplateIterations, 'InputSpec.fixed_image')
+            baw200.connect(MergeT1s[subjectid], 'out', buildTemplateIterations, 'InputSpec.images')
+            baw200.connect(MergeByExtendListElementsNode, 'ListOfExtendedPassiveImages', buildTemplateIterations, 'InputSpec.ListOfPassiveImagesDictionararies')
 
             #baw200.connect(InitAvgImages, 'average_image', outputSpec, 'average_image')
 
             ### Now define where the final organized outputs should go.
-            SubjectTemplate_DataSink=pe.Node(nio.DataSink(),name="SubjectTemplate_DS")
+            SubjectTemplate_DataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="SubjectTemplate_DS")
             SubjectTemplate_DataSink.inputs.base_directory=ExperimentBaseDirectoryResults
             SubjectTemplate_DataSink.inputs.regexp_substitutions = GenerateSubjectOutputPattern(subjectid)
-            baw200.connect(buildTemplateIteration2,'OutputSpec.template',SubjectTemplate_DataSink,'ANTSTemplate.@template')
+            baw200.connect(buildTemplateIterations,'OutputSpec.template',SubjectTemplate_DataSink,'ANTSTemplate.@template')
 
             MakeNewAtlasTemplateNode = pe.Node(interface=Function(function=MakeNewAtlasTemplate,
-                    input_names=['t1_image', 'deformed_list','AtlasTemplate','outDefinition'],
+                    input_names=['t1_image', 'deformed_list','AtlasTemplate','outDefinition','maxVolumesInMemory','clippedExtension'],
                     output_names=['outAtlasFullPath','clean_deformed_list']),
                     # This is a lot of work, so submit it run_without_submitting=True,
                     name='99_MakeNewAtlasTemplate')
+            ## Its clipping workers run within the threads of this profile.
+            MakeNewAtlasTemplateNode.plugin_args=ResourceProfiles.GetPluginArgs('MakeNewAtlasTemplate',CLUSTER_QUEUE)
             MakeNewAtlasTemplateNode.inputs.outDefinition='AtlasDefinition_'+subjectid+'.xml'
+            MakeNewAtlasTemplateNode.inputs.maxVolumesInMemory=8
+            MakeNewAtlasTemplateNode.inputs.clippedExtension='.nii.gz' ## The CLIPPED_ images also go to the DataSink
             baw200.connect(BAtlas[subjectid],'ExtendedAtlasDefinition_xml_in',MakeNewAtlasTemplateNode,'AtlasTemplate')
-            baw200.connect(buildTemplateIteration2,'OutputSpec.template',MakeNewAtlasTemplateNode,'t1_image')
-            baw200.connect(buildTemplateIteration2,'OutputSpec.passive_deformed_templates',MakeNewAtlasTemplateNode,'deformed_list')
+            baw200.connect(buildTemplateIterations,'OutputSpec.template',MakeNewAtlasTemplateNode,'t1_image')
+            baw200.connect(buildTemplateIterations,'OutputSpec.passive_deformed_templates',MakeNewAtlasTemplateNode,'deformed_list')
             baw200.connect(MakeNewAtlasTemplateNode,'clean_deformed_list',SubjectTemplate_DataSink,'ANTSTemplate.@passive_deformed_templates')
 
             ###### Starting Phase II
@@ -490,7 +565,13 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
             AddLikeTissueSink=dict()
             AccumulateLikeTissuePosteriorsNode=dict()
             for sessionid in allSessions:
-                projectid = ExperimentDatabase.getProjFromSession(sessionid)
+                projectid = sessionsInfo[sessionid]['project']
+                sessionScans=sessionsInfo[sessionid]['scans']
+                global_AllT1s=getFilenamesByScantype(sessionScans,['T1-30','T1-15'])
+                global_AllT2s=getFilenamesByScantype(sessionScans,['T2-30','T2-15'])
+                global_AllPDs=getFilenamesByScantype(sessionScans,['PD-30','PD-15'])
+                global_AllFLs=getFilenamesByScantype(sessionScans,['FL-30','FL-15'])
+                global_AllOthers=getFilenamesByScantype(sessionScans,['OTHER-30','OTHER-15'])
                 print("PHASE II PROJECT: {0} SUBJECT: {1} SESSION: {2}".format(projectid,subjectid,sessionid))
                 PHASE_2_subjInfoNode[sessionid] = pe.Node(interface=IdentityInterface(fields=
                         ['sessionid','subjectid','projectid',
@@ -504,11 +585,11 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                 PHASE_2_subjInfoNode[sessionid].inputs.projectid=projectid
                 PHASE_2_subjInfoNode[sessionid].inputs.subjectid=subjectid
                 PHASE_2_subjInfoNode[sessionid].inputs.sessionid=sessionid
-                PHASE_2_subjInfoNode[sessionid].inputs.allT1s=ExperimentDatabase.getFilenamesByScantype(sessionid,['T1-30','T1-15'])
-                PHASE_2_subjInfoNode[sessionid].inputs.allT2s=ExperimentDatabase.getFilenamesByScantype(sessionid,['T2-30','T2-15'])
-                PHASE_2_subjInfoNode[sessionid].inputs.allPDs=ExperimentDatabase.getFilenamesByScantype(sessionid,['PD-30','PD-15'])
-                PHASE_2_subjInfoNode[sessionid].inputs.allFLs=ExperimentDatabase.getFilenamesByScantype(sessionid,['FL-30','FL-15'])
-                PHASE_2_subjInfoNode[sessionid].inputs.allOthers=ExperimentDatabase.getFilenamesByScantype(sessionid,['OTHER-30','OTHER-15'])
+                PHASE_2_subjInfoNode[sessionid].inputs.allT1s=global_AllT1s
+                PHASE_2_subjInfoNode[sessionid].inputs.allT2s=global_AllT2s
+                PHASE_2_subjInfoNode[sessionid].inputs.allPDs=global_AllPDs
+                PHASE_2_subjInfoNode[sessionid].inputs.allFLs=global_AllFLs
+                PHASE_2_subjInfoNode[sessionid].inputs.allOthers=global_AllOthers
 
                 PROCESSING_PHASE='PHASE_2'
                 PHASE_2_oneSubjWorkflow[sessionid]=WorkupT1T2Single.MakeOneSubWorkFlow(
@@ -526,11 +607,11 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
 
                 baw200.connect(BAtlas[subjectid],'template_landmarks_31_fcsv', PHASE_2_oneSubjWorkflow[sessionid],'InputSpec.template_landmarks_31_fcsv')
                 baw200.connect(BAtlas[subjectid],'template_landmark_weights_31_csv', PHASE_2_oneSubjWorkflow[sessionid],'InputSpec.template_landmark_weights_31_csv')
-                baw200.connect(buildTemplateIteration2,'OutputSpec.template', PHASE_2_oneSubjWorkflow[sessionid],'InputSpec.template_t1')
+                baw200.connect(buildTemplateIterations,'OutputSpec.template', PHASE_2_oneSubjWorkflow[sessionid],'InputSpec.template_t1')
                 baw200.connect(MakeNewAtlasTemplateNode,'outAtlasFullPath', PHASE_2_oneSubjWorkflow[sessionid],'InputSpec.atlasDefinition')
 
                 ### Now define where the final organized outputs should go.
-                BASIC_DataSink[sessionid]=pe.Node(nio.DataSink(),name="BASIC_DS_"+str(subjectid)+"_"+str(sessionid))
+                BASIC_DataSink[sessionid]=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="BASIC_DS_"+str(subjectid)+"_"+str(sessionid))
                 BASIC_DataSink[sessionid].inputs.base_directory=ExperimentBaseDirectoryResults
                 BASIC_DataSink[sessionid].inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'ACPCAlign')
 
@@ -541,7 +622,7 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                 baw200.connect(PHASE_2_oneSubjWorkflow[sessionid],'OutputSpec.atlasToSubjectTransform',BASIC_DataSink[sessionid],'ACPCAlign.@atlasToSubjectTransform')
 
                 ### Now define where the final organized outputs should go.
-                TC_DataSink[sessionid]=pe.Node(nio.DataSink(),name="TISSUE_CLASSIFY_DS_"+str(subjectid)+"_"+str(sessionid))
+                TC_DataSink[sessionid]=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="TISSUE_CLASSIFY_DS_"+str(subjectid)+"_"+str(sessionid))
                 TC_DataSink[sessionid].inputs.base_directory=ExperimentBaseDirectoryResults
                 TC_DataSink[sessionid].inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'TissueClassify')
                 baw200.connect(PHASE_2_oneSubjWorkflow[sessionid], 'OutputSpec.TissueClassifyOutputDir', TC_DataSink[sessionid],'TissueClassify.@TissueClassifyOutputDir')
@@ -552,11 +633,12 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                      input_names=['posteriorImages'],
                      output_names=['AccumulatePriorsList','AccumulatePriorsNames']),
                      name=currentAccumulateLikeTissuePosteriorsName)
+                MarkLightweightNode(AccumulateLikeTissuePosteriorsNode[sessionid])
                 baw200.connect(PHASE_2_oneSubjWorkflow[sessionid],'OutputSpec.posteriorImages',
                                AccumulateLikeTissuePosteriorsNode[sessionid],'posteriorImages')
 
                 ### Now define where the final organized outputs should go.
-                AddLikeTissueSink[sessionid]=pe.Node(nio.DataSink(),name="ACCUMULATED_POSTERIORS_"+str(subjectid)+"_"+str(sessionid))
+                AddLikeTissueSink[sessionid]=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="ACCUMULATED_POSTERIORS_"+str(subjectid)+"_"+str(sessionid))
                 AddLikeTissueSink[sessionid].inputs.base_directory=ExperimentBaseDirectoryResults
                 #AddLikeTissueSink[sessionid].inputs.regexp_substitutions = GenerateAccumulatorImagesOutputPattern(projectid, subjectid, sessionid)
                 AddLikeTissueSink[sessionid].inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'ACCUMULATED_POSTERIORS')
@@ -580,7 +662,8 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                           input_names=['t1_image','brain_labels','clipped_file_name'],
                           output_names=['clipped_file']),
                           name=currentClipT1ImageWithBrainMaskName)
-                    ClipT1ImageWithBrainMaskNode[sessionid].inputs.clipped_file_name = 'clipped_t1.nii.gz'
+                    MarkLightweightNode(ClipT1ImageWithBrainMaskNode[sessionid])
+                    ClipT1ImageWithBrainMaskNode[sessionid].inputs.clipped_file_name = ImageFormatPolicy.IntermediateImageName('clipped_t1')
                     baw200.connect(PHASE_2_oneSubjWorkflow[sessionid],'OutputSpec.t1_average',ClipT1ImageWithBrainMaskNode[sessionid],'t1_image')
                     baw200.connect(BAtlas[subjectid],'template_t1_clipped',ClipT1ImageWithBrainMaskNode[sessionid],'brain_labels')
 
@@ -604,21 +687,6 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                     baw200.connect(ClipT1ImageWithBrainMaskNode[sessionid], 'clipped_file', AtlasToSubjectantsRegistration[subjectid], 'fixed_image')
                     baw200.connect(PHASE_2_oneSubjWorkflow[sessionid],'OutputSpec.atlasToSubjectTransform',AtlasToSubjectantsRegistration[subjectid],'initial_moving_transform')
 
-                global_AllT1s=ExperimentDatabase.getFilenamesByScantype(sessionid,['T1-30','T1-15'])
-                global_AllT2s=ExperimentDatabase.getFilenamesByScantype(sessionid,['T2-30','T2-15'])
-                global_AllPDs=ExperimentDatabase.getFilenamesByScantype(sessionid,['PD-30','PD-15'])
-                global_AllFLs=ExperimentDatabase.getFilenamesByScantype(sessionid,['FL-30','FL-15'])
-                global_AllOthers=ExperimentDatabase.getFilenamesByScantype(sessionid,['OTHER-30','OTHER-15'])
-                print("HACK2:  all T1s: {0} {1}".format(global_AllT1s, len(global_AllT1s) ))
-                print("HACK2:  all T2s: {0} {1}".format(global_AllT2s, len(global_AllT2s) ))
-                print("HACK2:  all PDs: {0} {1}".format(global_AllPDs, len(global_AllPDs) ))
-                print("HACK2:  all FLs: {0} {1}".format(global_AllFLs, len(global_AllFLs) ))
-                print("HACK2:  all Others: {0} {1}".format(global_AllOthers, len(global_AllOthers) ))
-                if ( 'SEGMENTATION' in WORKFLOW_COMPONENTS ) : # Currently only works with multi-modal_data
-                     print("HACK SEGMENTATION IN  WORKFLOW_COMPONENTS")
-                if ( len(global_AllT2s) > 0 ): # Currently only works with multi-modal_data
-                    print("HACK len(global_AllT2s) > 0 ")
-                print("HACK")
                 if ( 'SEGMENTATION' in WORKFLOW_COMPONENTS ) and ( len(global_AllT2s) > 0 ): # Currently only works with multi-modal_data
                     from WorkupT1T2BRAINSCut import CreateBRAINSCutWorkflow
                     myLocalSegWF[subjectid] = CreateBRAINSCutWorkflow(projectid, subjectid, sessionid,'Segmentation',CLUSTER_QUEUE,BAtlas[subjectid]) ##Note:  Passing in the entire BAtlas Object here!
@@ -633,7 +701,7 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
                     baw200.connect( PHASE_2_oneSubjWorkflow[sessionid],'OutputSpec.atlasToSubjectTransform',myLocalSegWF[subjectid],'InputSpec.atlasToSubjectTransform')
 
                     ### Now define where the final organized outputs should go.
-                    SEGMENTATION_DataSink[subjectid]=pe.Node(nio.DataSink(),name="SEGMENTATION_DS_"+str(subjectid)+"_"+str(sessionid))
+                    SEGMENTATION_DataSink[subjectid]=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="SEGMENTATION_DS_"+str(subjectid)+"_"+str(sessionid))
                     SEGMENTATION_DataSink[subjectid].inputs.base_directory=ExperimentBaseDirectoryResults
                     SEGMENTATION_DataSink[subjectid].inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'BRAINSCut')
                     baw200.connect(myLocalSegWF[subjectid], 'OutputSpec.outputBinaryLeftCaudate',SEGMENTATION_DataSink[subjectid], 'BRAINSCut.@outputBinaryLeftCaudate')
@@ -661,27 +729,37 @@ def WorkupT1T2(subjectid,mountPrefix,ExperimentBaseDirectoryCache, ExperimentBas
 
                     ### Now define where the final organized outputs should go.
                     if RunAllFSComponents == True:
-                        FS_DS[subjectid]=pe.Node(nio.DataSink(),name="FREESURFER_DS_"+str(subjectid)+"_"+str(sessionid))
+                        FS_DS[subjectid]=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="FREESURFER_DS_"+str(subjectid)+"_"+str(sessionid))
                         FS_DS[subjectid].inputs.base_directory=ExperimentBaseDirectoryResults
                         FS_DS[subjectid].inputs.regexp_substitutions = [
                             ('/_uid_(?P<myuid>[^/]*)',r'/\g<myuid>')
                             ]
                         baw200.connect(myLocalFSWF[subjectid], 'OutputSpec.FreesurferOutputDirectory', FS_DS[subjectid],'FREESURFER_SUBJ.@FreesurferOutputDirectory')
                     ### Now define where the final organized outputs should go.
-                    FSPREP_DataSink[subjectid]=pe.Node(nio.DataSink(),name="FREESURFER_PREP_"+str(subjectid)+"_"+str(sessionid))
+                    FSPREP_DataSink[subjectid]=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="FREESURFER_PREP_"+str(subjectid)+"_"+str(sessionid))
                     FSPREP_DataSink[subjectid].inputs.base_directory=ExperimentBaseDirectoryResults
                     FREESURFER_PREP_PATTERNS = GenerateOutputPattern(projectid, subjectid, sessionid,'FREESURFER_PREP')
                     FSPREP_DataSink[subjectid].inputs.regexp_substitutions = FREESURFER_PREP_PATTERNS
-                    print "========================="
-                    print "========================="
-                    print "========================="
-                    print FREESURFER_PREP_PATTERNS
-                    print "========================="
-                    print "========================="
-                    print "========================="
                     baw200.connect(myLocalFSWF[subjectid], 'OutputSpec.cnr_optimal_image', FSPREP_DataSink[subjectid],'FREESURFER_PREP.@cnr_optimal_image')
 
                 else:
                     print "Skipping freesurfer"
 
+    ## Must follow the creation of every node, so that remote jobs also install the hash method.
+    FastContentHash.AttachFastContentHash(baw200,os.path.join(ExperimentBaseDirectoryCache,'InternalContentHashCache.db'))
     return baw200
+
+def MakeMultiSubjectWorkflow(subjectWorkflowList, ExperimentBaseDirectoryCache, WorkflowName="BAW_MultiSubject"):
+    """
+    Combine independent per-subject WorkupT1T2 workflows into one top-level workflow,
+    so that the execution plugin sees every subject's nodes at once and can fill
+    idle slots during one subject's serial template building with work from another.
+    The execution and logging configuration are taken from the first subject workflow.
+    """
+    import copy
+    multiSubjectWF = pe.Workflow(name=WorkflowName)
+    multiSubjectWF.config = copy.deepcopy(subjectWorkflowList[0].config)
+    multiSubjectWF.config['logging']['log_directory'] = ExperimentBaseDirectoryCache
+    multiSubjectWF.base_dir = ExperimentBaseDirectoryCache
+    multiSubjectWF.add_nodes(subjectWorkflowList)
+    return multiSubjectWF
@@ -14,6 +14,9 @@ from BRAINSTools.BTants.antsRegistration import *
 
 from BRAINSTools.BTants.ants import *
 
+import ResourceProfiles
+import ImageFormatPolicy
+
 """
     from WorkupT1T2ANTS import CreateANTSRegistrationWorkflow
     myLocalAntsWF = CreateANTSRegistrationWorkflow("ANTSRegistration",CLUSTER_QUEUE)
@@ -31,8 +34,7 @@ def CreateANTSRegistrationWorkflow(WFname,CLUSTER_QUEUE,NumberOfThreads=-1):
     print("""Run ANTS Registration""")
 
     BFitAtlasToSubject = pe.Node(interface=BRAINSFit(),name="bfA2S")
-    BF_cpu_sge_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 1-8 -l mem_free=4000M -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    BFitAtlasToSubject.plugin_args=BF_cpu_sge_options_dictionary
+    BFitAtlasToSubject.plugin_args=ResourceProfiles.GetPluginArgs('BRAINSFit',CLUSTER_QUEUE)
     BFitAtlasToSubject.inputs.costMetric="MMI"
     BFitAtlasToSubject.inputs.numberOfSamples=1000000
     BFitAtlasToSubject.inputs.numberOfIterations=[1500]
@@ -41,7 +43,7 @@ def CreateANTSRegistrationWorkflow(WFname,CLUSTER_QUEUE,NumberOfThreads=-1):
     BFitAtlasToSubject.inputs.minimumStepLength=[0.000005]
     BFitAtlasToSubject.inputs.useAffine=True  ## Using initial transform from BRAINSABC
     BFitAtlasToSubject.inputs.maskInferiorCutOffFromCenter=65
-    BFitAtlasToSubject.inputs.outputVolume="Trial_Initializer_Output.nii.gz"
+    BFitAtlasToSubject.inputs.outputVolume=ImageFormatPolicy.IntermediateImageName("Trial_Initializer_Output")
     # Bug in BRAINSFit PREDICTIMG-1379 BFitAtlasToSubject.inputs.outputFixedVolumeROI="FixedROI.nii.gz"
     # Bug in BRAINSFit PREDICTIMG-1379 BFitAtlasToSubject.inputs.outputMovingVolumeROI="MovingROI.nii.gz"
     BFitAtlasToSubject.inputs.outputTransform="Trial_Initializer_Output.mat"
@@ -55,8 +57,7 @@ def CreateANTSRegistrationWorkflow(WFname,CLUSTER_QUEUE,NumberOfThreads=-1):
     ANTSWF.connect(inputsSpec,'initial_moving_transform',BFitAtlasToSubject,'initialTransform')
 
     ComputeAtlasToSubjectTransform = pe.Node(interface=antsRegistration(), name="antsA2S")
-    many_cpu_sge_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 4-12 -l mem_free=7000M -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    ComputeAtlasToSubjectTransform.plugin_args=many_cpu_sge_options_dictionary
+    ComputeAtlasToSubjectTransform.plugin_args=ResourceProfiles.GetPluginArgs('antsRegistration',CLUSTER_QUEUE)
 
     ComputeAtlasToSubjectTransform.inputs.dimension=3
     ComputeAtlasToSubjectTransform.inputs.metric='CC'                  ## This is a family of interfaces, CC,MeanSquares,Demons,GC,MI,Mattes
@@ -69,8 +70,8 @@ def CreateANTSRegistrationWorkflow(WFname,CLUSTER_QUEUE,NumberOfThreads=-1):
     ComputeAtlasToSubjectTransform.inputs.use_histogram_matching=True
     ComputeAtlasToSubjectTransform.inputs.invert_initial_moving_transform=False
     ComputeAtlasToSubjectTransform.inputs.output_transform_prefix='antsRegPrefix_'
-    ComputeAtlasToSubjectTransform.inputs.output_warped_image='moving_to_fixed.nii.gz'
-    ComputeAtlasToSubjectTransform.inputs.output_inverse_warped_image='fixed_to_moving.nii.gz'
+    ComputeAtlasToSubjectTransform.inputs.output_warped_image=ImageFormatPolicy.IntermediateImageName('moving_to_fixed')
+    ComputeAtlasToSubjectTransform.inputs.output_inverse_warped_image=ImageFormatPolicy.IntermediateImageName('fixed_to_moving')
     #ComputeAtlasToSubjectTransform.inputs.num_threads=-1
     #if os.environ.has_key('NSLOTS'):
     #    ComputeAtlasToSubjectTransform.inputs.num_threads=int(os.environ.has_key('NSLOTS'))
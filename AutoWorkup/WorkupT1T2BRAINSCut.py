@@ -9,6 +9,10 @@ import nipype.pipeline.engine as pe  # pypeline engine
 from BRAINSTools import *
 from BRAINSTools.RF8BRAINSCutWrapper import RF8BRAINSCutWrapper
 
+import ResourceProfiles
+import ImageFormatPolicy
+from LightweightNodes import MarkLightweightNode
+
 def GenerateWFName(projectid, subjectid, sessionid,WFName):
     return WFName+'_'+str(subjectid)+"_"+str(sessionid)+"_"+str(projectid)
 
@@ -29,6 +33,7 @@ def CreateLabelMap(listOfImages,LabelImageName,CSVFileName):
     subjectANNLabel_r_thalamus.nii.gz
     """
     import SimpleITK as sitk
+    import numpy as np
     import os
     import csv
     orderOfPriority = [
@@ -39,7 +44,11 @@ def CreateLabelMap(listOfImages,LabelImageName,CSVFileName):
       "l_hippocampus" ,
       "r_hippocampus" ,
       "l_thalamus"    ,
-      "r_thalamus"
+      "r_thalamus"    ,
+      "l_accumben"    ,
+      "r_accumben"    ,
+      "l_globus"      ,
+      "r_globus"
     ]
 
     valueDict={
@@ -50,27 +59,46 @@ def CreateLabelMap(listOfImages,LabelImageName,CSVFileName):
         "l_hippocampus" : 5,
         "r_hippocampus" : 6,
         "l_thalamus"    : 7,
-        "r_thalamus"    : 8
+        "r_thalamus"    : 8,
+        "l_accumben"    : 9,
+        "r_accumben"    : 10,
+        "l_globus"      : 11,
+        "r_globus"      : 12
     }
 
-    labelImage = None
-    for segFN in listOfImages:
+    ## Stack all masks once, a later mask in listOfImages wins where masks overlap.
+    referenceImage = None
+    structNames = list()
+    maskStack = None
+    for index,segFN in enumerate(listOfImages):
         im = sitk.ReadImage(segFN)
-        im.GetSize()
         remove_pre_postfix=os.path.basename(segFN.replace(".nii.gz","").replace("subjectANNLabel_","").replace("_seg",""))
         structName=remove_pre_postfix.lower()
-        if labelImage is None:
-            labelImage = im*valueDict[structName]
-        else:
-            mask=sitk.Not(im)
-            ## Clear out an empty space for the next mask to be inserted
-            labelImage *= mask
-            ## Add in the mask image with it's proper label
-            labelImage = labelImage + im*valueDict[structName]
+        if structName not in valueDict:
+            valueDict[structName]=max(valueDict.values())+1
+            orderOfPriority.append(structName)
+            print "WARNING: No label code for {0}, using {1}".format(structName,valueDict[structName])
+        structNames.append(structName)
+        maskArray=sitk.GetArrayFromImage(im)
+        if maskStack is None:
+            referenceImage = im
+            maskStack=np.zeros( (len(listOfImages),)+maskArray.shape, dtype=np.uint8)
+        maskStack[index]=(maskArray != 0)
+        del im,maskArray
+    ## Index of the last mask covering each voxel, from one argmax over the reversed stack.
+    lastMaskIndex=len(listOfImages)-1-np.argmax(maskStack[::-1],axis=0)
+    labelCodes=np.array([0]+[ valueDict[name] for name in structNames ])
+    labelArray=np.where(maskStack.any(axis=0),labelCodes[lastMaskIndex+1],0)
+    del maskStack,lastMaskIndex
+    if labelCodes.max() < 256:
+        labelArray=labelArray.astype(np.uint8)
+    else:
+        labelArray=labelArray.astype(np.uint16)
+    labelImage=sitk.GetImageFromArray(labelArray)
+    labelImage.CopyInformation(referenceImage)
     sitk.WriteImage(labelImage,LabelImageName)
 
-    ls = sitk.LabelStatisticsImageFilter()
-    ls.Execute(labelImage,labelImage)
+    labelCounts=np.bincount(labelArray.ravel())
     ImageSpacing=labelImage.GetSpacing()
     csvFile=open(CSVFileName,'w')
     dWriter=csv.DictWriter(csvFile,['Structure','LabelCode','Volume_mm3','FileName'],restval='', extrasaction='raise', dialect='excel')
@@ -78,18 +106,14 @@ def CreateLabelMap(listOfImages,LabelImageName,CSVFileName):
     writeDictionary=dict()
     for name in orderOfPriority:
         value = valueDict[name]
-        if ls.HasLabel(value):
-            #print "Displaying: ", name, value
-            myMeasurementMap = ls.GetMeasurementMap(value)
-            dictKeys=myMeasurementMap.GetVectorOfMeasurementNames()
-            dictValues=myMeasurementMap.GetVectorOfMeasurementValues()
-            measurementDict=dict(zip(dictKeys, dictValues))
-            structVolume=ImageSpacing[0]*ImageSpacing[1]*ImageSpacing[2]*measurementDict['Count']
+        if value < len(labelCounts) and labelCounts[value] > 0:
+            structVolume=ImageSpacing[0]*ImageSpacing[1]*ImageSpacing[2]*float(labelCounts[value])
             writeDictionary['Volume_mm3']=structVolume
             writeDictionary['Structure']=name
             writeDictionary['LabelCode']=value
             writeDictionary['FileName']=os.path.abspath(LabelImageName)
             dWriter.writerow(writeDictionary)
+    csvFile.close()
     return os.path.abspath(LabelImageName),os.path.abspath(CSVFileName)
 
 #==============================================
@@ -99,6 +123,97 @@ def CreateLabelMap(listOfImages,LabelImageName,CSVFileName):
 #==============================================
 #==============================================
 
+
+def ComputeSummedGradientImage(T1Volume,T2Volume,timeStep,conductance,numberOfIterations,outputFileName):
+    """
+    The GADT1, GADT2 and SGI nodes in one process, without writing the two
+    diffused volumes.  Each step repeats the ITK filters of the program it
+    replaces:  GradientAnisotropicDiffusionImageFilter rescales the diffused
+    volume to 0..255 unsigned char, and GenerateSummedGradientImage windows
+    the gradient magnitude of each volume from its 50% histogram quantile to
+    an extrapolated 95% quantile as 0..127 unsigned char before adding them.
+    SummedGradientImageTest compares the result with the two programs.
+    """
+    import os
+    import numpy as np
+    import SimpleITK as sitk
+    def RescaledDiffusion(volumeFileName):
+        ## GradientAnisotropicDiffusionImageFilter, then RescaleIntensityImageFilter<float,unsigned char>
+        diffused=sitk.GradientAnisotropicDiffusion(sitk.Cast(sitk.ReadImage(volumeFileName),sitk.sitkFloat32),
+            timeStep,conductance,1,numberOfIterations)
+        diffusedArray=sitk.GetArrayFromImage(diffused).astype(np.float64)
+        inputMinimum=diffusedArray.min()
+        inputMaximum=diffusedArray.max()
+        if inputMinimum != inputMaximum:
+            scale=255.0/(inputMaximum-inputMinimum)
+        elif inputMaximum != 0:
+            scale=255.0/inputMaximum
+        else:
+            scale=0.0
+        diffusedArray*=scale
+        diffusedArray+=0.0-inputMinimum*scale
+        rescaled=sitk.GetImageFromArray(np.clip(diffusedArray,0,255).astype(np.uint8))
+        rescaled.CopyInformation(diffused)
+        return rescaled
+    def HistogramQuantile(frequencies,binMinimums,binMaximums,p):
+        ## itk::Statistics::Histogram::Quantile() for p >= 0.5, accumulating from the top bin down
+        totalFrequency=float(frequencies.sum())
+        n=len(frequencies)-1
+        cumulated=0.0
+        p_n=1.0
+        while True:
+            f_n=frequencies[n]
+            cumulated+=f_n
+            p_n_prev=p_n
+            p_n=1.0-cumulated/totalFrequency
+            n-=1
+            if n < 0 or p_n <= p:
+                break
+        binMinimum=binMinimums[n+1]
+        binMaximum=binMaximums[n+1]
+        return binMaximum-((p_n_prev-p)/(f_n/totalFrequency))*(binMaximum-binMinimum)
+    def WindowedGradientMagnitude(rescaled):
+        ## GenerateSummedGradientImage reads the unsigned char volume as float
+        gradient=sitk.GradientMagnitude(sitk.Cast(rescaled,sitk.sitkFloat32))
+        gradientArray=sitk.GetArrayFromImage(gradient)
+        ## ScalarImageToHistogramGenerator: 1024 bins from the minimum to the maximum plus a margin of 1/10 bin.
+        ## The SetHistogramMin/Max of the program only set the bin bounds of its SampleToHistogramFilter, which
+        ## leaves AutoMinimumMaximum on and so bins from the image extrema with the MarginalScale(10) margin.
+        numberOfBins=1024
+        lower=float(gradientArray.min())
+        upper=float(gradientArray.max())
+        upper+=((upper-lower)/numberOfBins)/10.0
+        interval=(upper-lower)/numberOfBins
+        binMinimums=lower+np.arange(numberOfBins)*interval
+        binMaximums=lower+np.arange(1,numberOfBins+1)*interval
+        binMaximums[-1]=upper
+        frequencies=np.bincount(np.searchsorted(binMinimums,gradientArray.ravel(),side='right')-1,minlength=numberOfBins)
+        ## The quantiles are doubles, the slope and the window are stored as float
+        upperPercentile=float(np.float32(0.95))
+        lowerQuantile=HistogramQuantile(frequencies,binMinimums,binMaximums,0.50)
+        upperQuantile=HistogramQuantile(frequencies,binMinimums,binMaximums,upperPercentile)
+        slope=float(np.float32((upperQuantile-lowerQuantile)/80.0))
+        windowMinimum=np.float32(lowerQuantile)
+        windowMaximum=np.float32(upperQuantile+slope*100.0*(1.0-upperPercentile))
+        ## IntensityWindowingImageFilter<float,unsigned char> to 0..127
+        scale=127.0/(float(windowMaximum)-float(windowMinimum))
+        windowed=gradientArray.astype(np.float64)
+        windowed*=scale
+        windowed+=0.0-float(windowMinimum)*scale
+        windowed=np.clip(windowed,0,127).astype(np.uint8)
+        windowed[gradientArray < windowMinimum]=0
+        windowed[gradientArray > windowMaximum]=127
+        return windowed,gradient
+    T1Windowed,gradient=WindowedGradientMagnitude(RescaledDiffusion(T1Volume))
+    T2Windowed,gradient=WindowedGradientMagnitude(RescaledDiffusion(T2Volume))
+    ## Both are at most 127, so the unsigned char sum can not overflow.
+    T1Windowed+=T2Windowed
+    del T2Windowed
+    summedGradient=sitk.GetImageFromArray(T1Windowed)
+    summedGradient.CopyInformation(gradient)
+    sitk.WriteImage(summedGradient,outputFileName)
+    return os.path.realpath(outputFileName)
+
 """
     from WorkupT1T2BRAINSCutSegmentation import CreateBRAINSCutSegmentationWorkflow
     myLocalcutWF= CreateBRAINSCutSegmentationWorkflow("999999_PersistanceCheckingWorkflow")
@@ -116,38 +231,25 @@ def CreateBRAINSCutWorkflow(projectid, subjectid, sessionid,WFName,CLUSTER_QUEUE
         'atlasToSubjectTransform']), name='InputSpec' )
 
     """
-    Gradient Anistropic Diffusion images for BRAINSCut
-    """
-    GADT1=pe.Node(interface=GradientAnisotropicDiffusionImageFilter(),name="GADT1")
-    GADT1.inputs.timeStep = 0.025
-    GADT1.inputs.conductance = 1
-    GADT1.inputs.numberOfIterations = 5
-    GADT1.inputs.outputVolume = "GADT1.nii.gz"
-
-    cutWF.connect(inputsSpec,'T1Volume',GADT1,'inputVolume')
-
-    GADT2=pe.Node(interface=GradientAnisotropicDiffusionImageFilter(),name="GADT2")
-    GADT2.inputs.timeStep = 0.025
-    GADT2.inputs.conductance = 1
-    GADT2.inputs.numberOfIterations = 5
-    GADT2.inputs.outputVolume = "GADT2.nii.gz"
-    cutWF.connect(inputsSpec,'T2Volume',GADT2,'inputVolume')
-
-    """
-    Sum the gradient images for BRAINSCut
+    Gradient Anistropic Diffusion images of T1 and T2, and the sum of their gradients for BRAINSCut
     """
-    SGI=pe.Node(interface=GenerateSummedGradientImage(),name="SGI")
-    SGI.inputs.outputFileName = "SummedGradImage.nii.gz"
+    SGI=pe.Node(interface=Function(function=ComputeSummedGradientImage,
+        input_names=['T1Volume','T2Volume','timeStep','conductance','numberOfIterations','outputFileName'],
+        output_names=['outputFileName']),name="SGI")
+    SGI.plugin_args=ResourceProfiles.GetPluginArgs('GAD_SGI',CLUSTER_QUEUE)
+    SGI.inputs.timeStep = 0.025
+    SGI.inputs.conductance = 1
+    SGI.inputs.numberOfIterations = 5
+    SGI.inputs.outputFileName = ImageFormatPolicy.IntermediateImageName("SummedGradImage")
 
-    cutWF.connect(GADT1,'outputVolume',SGI,'inputVolume1')
-    cutWF.connect(GADT2,'outputVolume',SGI,'inputVolume2')
+    cutWF.connect(inputsSpec,'T1Volume',SGI,'T1Volume')
+    cutWF.connect(inputsSpec,'T2Volume',SGI,'T2Volume')
 
     """
     BRAINSCut
     """
     RF8BC = pe.Node(interface=RF8BRAINSCutWrapper(),name="RF8_BRAINSCut")
-    many_cpu_RF8BC_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 4-12 -l mem_free=8000M -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    RF8BC.plugin_args=many_cpu_RF8BC_options_dictionary
+    RF8BC.plugin_args=ResourceProfiles.GetPluginArgs('BRAINSCut',CLUSTER_QUEUE)
     RF8BC.inputs.trainingVectorFilename = "trainingVectorFilename.txt"
     RF8BC.inputs.xmlFilename = "BRAINSCutSegmentationDefinition.xml"
 
@@ -213,6 +315,7 @@ def CreateBRAINSCutWorkflow(projectid, subjectid, sessionid,WFName,CLUSTER_QUEUE
     computeOneLabelMap = pe.Node(interface=Function(['listOfImages','LabelImageName','CSVFileName'],
         ['outputLabelImageName','outputCSVFileName'],
         function=CreateLabelMap),name="ComputeOneLabelMap")
+    MarkLightweightNode(computeOneLabelMap)
     computeOneLabelMap.inputs.LabelImageName="consolidated12LabelMap.nii.gz"
     computeOneLabelMap.inputs.CSVFileName = "consolidated12LabelVolumes.csv"
     cutWF.connect(mergeAllLabels,'out',computeOneLabelMap,'listOfImages')
@@ -24,8 +24,6 @@ def CreatePERSISTANCE_CHECKWorkflow(WFname):
     PERSISTANCE_CHECKWF= pe.Workflow(name=WFname)
 
     inputsSpec = pe.Node(interface=IdentityInterface(fields=['fixedVolume','fixedBinaryVolume','movingVolume','movingBinaryVolume','initialTransform']), name='InputSpec' )
-    PERSISTANCE_CHECKWF.connect(inputsSpec,'subject_id',fs_reconall,'subject_id')
-    PERSISTANCE_CHECKWF.connect(inputsSpec,'T1_files',  fs_reconall,'T1_files')
 
     print("DOING FILE PERSISTANCE CHECK")
     PERSISTANCE_CHECK = pe.Node(interface=BRAINSFit(),name="99999_PERSISTANCE_CHECK_PERSISTANCE_CHECK")
@@ -51,5 +49,7 @@ def CreatePERSISTANCE_CHECKWorkflow(WFname):
     PERSISTANCE_CHECKWF.connect(inputsSpec,'initialTransform',  PERSISTANCE_CHECK,'initialTransform')
 
     outputsSpec = pe.Node(interface=IdentityInterface(fields=['outputVolume','outputTransform']), name='OutputSpec' )
+    PERSISTANCE_CHECKWF.connect(PERSISTANCE_CHECK,'outputVolume',   outputsSpec,'outputVolume')
+    PERSISTANCE_CHECKWF.connect(PERSISTANCE_CHECK,'outputTransform',outputsSpec,'outputTransform')
 
     return PERSISTANCE_CHECKWF
@@ -42,6 +42,7 @@ from BRAINSTools import *
 from BRAINSTools.BTants.normalize import WarpImageMultiTransform
 
 from WorkupT1T2AtlasNode import MakeAtlasNode
+import ImageFormatPolicy
 
 
 #############################################################################
@@ -115,7 +116,6 @@ def MakeOneSubWorkFlow(projectid, subjectid, sessionid, BAtlas, WORKFLOW_COMPONE
     the path and filename of the atlas to use.
     """
 
-    # print "Building Pipeline for ",sessionid
     ########### PIPELINE INITIALIZATION #############
     T1T2WorkupSingle = pe.Workflow(name=GenerateWFName(projectid, subjectid, sessionid))
 
@@ -149,7 +149,7 @@ def MakeOneSubWorkFlow(projectid, subjectid, sessionid, BAtlas, WORKFLOW_COMPONE
             T1T2WorkupSingle.connect(BAtlas,'template_t1',myLocalLMIWF,'InputSpec.atlasVolume')
 
         ### Now define where the final organized outputs should go.
-        BASIC_DataSink=pe.Node(nio.DataSink(),name="BASIC_DS")
+        BASIC_DataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="BASIC_DS")
         BASIC_DataSink.inputs.base_directory=ExperimentBaseDirectoryResults
         BASIC_DataSink.inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'ACPCAlign',False)
 
@@ -174,7 +174,7 @@ def MakeOneSubWorkFlow(projectid, subjectid, sessionid, BAtlas, WORKFLOW_COMPONE
         T1T2WorkupSingle.connect( myLocalLMIWF,'OutputSpec.atlasToSubjectTransform',myLocalTCWF,'InputSpec.atlasToSubjectInitialTransform')
 
         ### Now define where the final organized outputs should go.
-        TC_DataSink=pe.Node(nio.DataSink(),name="TISSUE_CLASSIFY_DS")
+        TC_DataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="TISSUE_CLASSIFY_DS")
         TC_DataSink.inputs.base_directory=ExperimentBaseDirectoryResults
         TC_DataSink.inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'TissueClassify',False)
         T1T2WorkupSingle.connect(myLocalTCWF, 'OutputSpec.TissueClassifyOutputDir', TC_DataSink,'TissueClassify.@TissueClassifyOutputDir')
@@ -195,7 +195,7 @@ def MakeOneSubWorkFlow(projectid, subjectid, sessionid, BAtlas, WORKFLOW_COMPONE
         T1T2WorkupSingle.connect(BAtlas,'template_headregion',myLocalAntsWF,'InputSpec.movingBinaryVolume')
 
         ### Now define where the final organized outputs should go.
-        ANTS_DataSink=pe.Node(nio.DataSink(),name="ANTSRegistration_DS")
+        ANTS_DataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="ANTSRegistration_DS")
         ANTS_DataSink.inputs.base_directory=ExperimentBaseDirectoryResults
         ANTS_DataSink.inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'ANTSRegistration',False)
         T1T2WorkupSingle.connect(myLocalAntsWF, 'OutputSpec.warped_image', ANTS_DataSink,'ANTSRegistration.@warped_image')
@@ -213,7 +213,7 @@ def MakeOneSubWorkFlow(projectid, subjectid, sessionid, BAtlas, WORKFLOW_COMPONE
         T1T2WorkupSingle.connect( myLocalTCWF,'OutputSpec.atlasToSubjectTransform',myLocalSegWF,'InputSpec.atlasToSubjectTransform')
 
         ### Now define where the final organized outputs should go.
-        SEGMENTATION_DataSink=pe.Node(nio.DataSink(),name="SEGMENTATION_DS")
+        SEGMENTATION_DataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="SEGMENTATION_DS")
         SEGMENTATION_DataSink.inputs.base_directory=ExperimentBaseDirectoryResults
         SEGMENTATION_DataSink.inputs.regexp_substitutions = GenerateOutputPattern(projectid, subjectid, sessionid,'BRAINSCut',False)
         T1T2WorkupSingle.connect(myLocalSegWF, 'OutputSpec.outputBinaryLeftAccumben',SEGMENTATION_DataSink, 'BRAINSCut.@outputBinaryLeftAccumben')
@@ -243,34 +243,18 @@ def MakeOneSubWorkFlow(projectid, subjectid, sessionid, BAtlas, WORKFLOW_COMPONE
 
         ### Now define where the final organized outputs should go.
         if RunAllFSComponents == True:
-            T1T2WorkupSingleDataSink=pe.Node(nio.DataSink(),name="FREESURFER_DS")
+            T1T2WorkupSingleDataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="FREESURFER_DS")
             T1T2WorkupSingleDataSink.inputs.base_directory=ExperimentBaseDirectoryResults
             T1T2WorkupSingleDataSink.inputs.regexp_substitutions = [
                 ('/_uid_(?P<myuid>[^/]*)',r'/\g<myuid>')
                 ]
             T1T2WorkupSingle.connect(myLocalFSWF, 'OutputSpec.FreesurferOutputDirectory', T1T2WorkupSingleDataSink,'FREESURFER_SUBJ.@FreesurferOutputDirectory')
         ### Now define where the final organized outputs should go.
-        FSPREP_DataSink=pe.Node(nio.DataSink(),name="FREESURFER_PREP")
+        FSPREP_DataSink=pe.Node(ImageFormatPolicy.CompressingDataSink(),name="FREESURFER_PREP")
         FSPREP_DataSink.inputs.base_directory=ExperimentBaseDirectoryResults
         FREESURFER_PREP_PATTERNS = GenerateOutputPattern(projectid, subjectid, sessionid,'FREESURFER_PREP',False)
         FSPREP_DataSink.inputs.regexp_substitutions = FREESURFER_PREP_PATTERNS
-        print "========================="
-        print "========================="
-        print "========================="
-        print FREESURFER_PREP_PATTERNS
-        print "========================="
-        print "========================="
-        print "========================="
         T1T2WorkupSingle.connect(myLocalFSWF, 'OutputSpec.cnr_optimal_image', FSPREP_DataSink,'FREESURFER_PREP.@cnr_optimal_image')
-    else:
-        pass
-        #print "Skipping freesurfer"
-    """
-    try:
-        T1T2WorkupSingle.write_graph()
-    except:
-        pass
-    """
 
     return T1T2WorkupSingle
 
@@ -7,6 +7,9 @@ import nipype.interfaces.io as nio   # Data i/o
 import nipype.pipeline.engine as pe  # pypeline engine
 
 from BRAINSTools.BRAINSABCext import *
+
+import ResourceProfiles
+
 """
     from WorkupT1T2TissueClassify import CreateTissueClassifyWorkflow
     myLocalTCWF= CreateTissueClassifyWorkflow("TissueClassify")
@@ -42,6 +45,7 @@ def MakeOneFileTypeList(T1List,T2List,PDList,FLList,OtherList):
     return input_types
 
 def MakeOutFileList(T1List,T2List,PDList,FLList,OtherList):
+    from ImageFormatPolicy import IntermediateImageName
     def GetExtBaseName(filename):
         '''
         Get the filename without the extension.  Works for .ext and .ext.gz
@@ -61,7 +65,7 @@ def MakeOutFileList(T1List,T2List,PDList,FLList,OtherList):
     all_files.extend(OtherList)
     out_corrected_names=[]
     for i in all_files:
-        out_name=GetExtBaseName(i)+"_corrected.nii.gz"
+        out_name=IntermediateImageName(GetExtBaseName(i)+"_corrected")
         out_corrected_names.append(out_name)
     return out_corrected_names
 
@@ -132,9 +136,7 @@ def CreateTissueClassifyWorkflow(WFname,CLUSTER_QUEUE,InterpolationMode):
     tissueClassifyWF.connect( inputsSpec, 'OtherList', makeOutImageList, 'OtherList' )
 
     BABCext= pe.Node(interface=BRAINSABCext(), name="BABC")
-    #many_cpu_BABC_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 4-12                   -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    many_cpu_BABC_options_dictionary={'qsub_args': '-S /bin/bash -pe smp1 4-12 -l mem_free=8000M -o /dev/null -e /dev/null '+CLUSTER_QUEUE, 'overwrite': True}
-    BABCext.plugin_args=many_cpu_BABC_options_dictionary
+    BABCext.plugin_args=ResourceProfiles.GetPluginArgs('BRAINSABC',CLUSTER_QUEUE)
     tissueClassifyWF.connect(makeImagePathList,'imagePathList',BABCext,'inputVolumes')
     tissueClassifyWF.connect(makeImageTypeList,'imageTypeList',BABCext,'inputVolumeTypes')
     tissueClassifyWF.connect(makeOutImageList,'outImageList',BABCext,'outputVolumes')
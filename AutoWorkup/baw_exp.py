@@ -63,6 +63,57 @@ def file_replace(fname, out_fname, pat, s_after):
             out.write(re.sub(pat, s_after, line))
         out.close()
 
+def RunWorkflow(baw200,wfrun,JOB_SCRIPT,CLUSTER_QUEUE,resourceCalibrationFile=None,telemetryFile=None,telemetrySubjects=None):
+    """ Run a workflow with the plugin selected by the -wfrun argument """
+    import ResourceProfiles
+    ## The lightweight helper nodes run on the submit host, or inside the job they wait for, see LightweightNodes.
+    from LightweightNodes import LightweightSGEPlugin, LightweightSGEGraphPlugin
+    SGEFlavor=LightweightSGEPlugin
+    try:
+        if wfrun == 'helium_all.q':
+            baw200.run(plugin=SGEFlavor(
+                plugin_args=dict(template=JOB_SCRIPT,qsub_args=ResourceProfiles.MakeQsubArgs('DEFAULT',CLUSTER_QUEUE))))
+        elif wfrun == 'helium_all.q_graph':
+            SGEFlavor=LightweightSGEGraphPlugin #Use the SGEGraph processing
+            baw200.run(plugin=SGEFlavor(
+                plugin_args=dict(template=JOB_SCRIPT,qsub_args=ResourceProfiles.MakeQsubArgs('DEFAULT',CLUSTER_QUEUE))))
+        elif wfrun == 'ipl_OSX':
+            baw200.write_graph()
+            print "Running On ipl_OSX"
+            baw200.run(plugin=SGEFlavor(
+                plugin_args=dict(template=JOB_SCRIPT,qsub_args=ResourceProfiles.MakeQsubArgs('DEFAULT',CLUSTER_QUEUE))))
+        elif wfrun == 'local_4':
+            baw200.write_graph()
+            print "Running with 4 parallel processes on local machine"
+            baw200.run(plugin='MultiProc', plugin_args={'n_procs' : 4})
+        elif wfrun == 'local_12':
+            baw200.write_graph()
+            print "Running with 12 parallel processes on local machine"
+            baw200.run(plugin='MultiProc', plugin_args={'n_procs' : 12})
+        elif wfrun == 'local_resources':
+            ## Schedule against the -pe and mem_free requests of each node instead of a fixed process count.
+            from ResourceLimitedMultiProc import ResourceLimitedMultiProcPlugin
+            import multiprocessing
+            baw200.write_graph()
+            print "Running with a CPU and memory limited process pool on local machine"
+            baw200.run(plugin=ResourceLimitedMultiProcPlugin(plugin_args={'n_procs' : multiprocessing.cpu_count(),
+                                                                          'calibration_db' : resourceCalibrationFile,
+                                                                          'telemetry_db' : telemetryFile,
+                                                                          'telemetry_subjects' : telemetrySubjects}))
+        elif wfrun == 'local':
+            try:
+                baw200.write_graph()
+            except:
+                pass
+            print "Running sequentially on local machine"
+            baw200.run()
+        else:
+            print "You must specify the run environment type. [helium_all.q,helium_all.q_graph,ipl_OSX,local_4,local_12,local_resources,local]"
+            print wfrun
+            sys.exit(-1)
+    except:
+        pass
+
 def main(argv=None):
     import argparse
     import ConfigParser
@@ -83,6 +134,18 @@ def main(argv=None):
                        help='The name of the subject to process')
     group.add_argument('-ExperimentConfig', action="store", dest='ExperimentConfig', required=True,
                        help='The path to the file that describes the entire experiment')
+    parser.add_argument('--rebuildSessionDB', action='store_true', dest='rebuildSessionDB', default=False,
+                        help='Delete and rebuild the cached session database instead of syncing only the changed rows of SESSION_DB')
+    parser.add_argument('--validationThreads', action='store', dest='validationThreads', type=int, default=16,
+                        help='The number of threads used to check that SESSION_DB image files exist, 0 checks them serially')
+    parser.add_argument('--subjectsPerGraph', action='store', dest='subjectsPerGraph', type=int, default=1,
+                        help='The number of subjects combined into one workflow graph and run together, 0 puts all subjects in one graph')
+    parser.add_argument('--telemetryReport', action='store', dest='telemetryReport', type=int, default=0,
+                        help='Print the N nodes with the most wall time and the critical path of each subject from the recorded node telemetry, then exit')
+    parser.add_argument('--verbose', action='store_true', dest='verbose', default=False,
+                        help='Print every session database row of the selected subjects before building the workflows')
+    parser.add_argument('--dry-run', action='store_true', dest='dryRun', default=False,
+                        help='Build and validate the graphs of the selected subjects, print their predicted cost from the recorded node telemetry, and exit without running them')
     parser.add_argument('--version', action='version', version='%(prog)s 1.0')
     #parser.add_argument('-v', action='store_false', dest='verbose', default=True,
     #                    help='If not present, prints the locations')
@@ -121,36 +184,37 @@ def main(argv=None):
         os.makedirs(ExperimentBaseDirectoryCache)
     if not os.path.exists(ExperimentBaseDirectoryResults):
         os.makedirs(ExperimentBaseDirectoryResults)
+    ## Node measurements from the local_resources runs are kept next to InternalWorkflowSubjectDB.db
+    telemetryFile=os.path.join(ExperimentBaseDirectoryCache,'InternalNodeTelemetry.db')
+    if input_arguments.telemetryReport > 0:
+        import NodeTelemetry
+        NodeTelemetry.PrintTelemetryReport(telemetryFile,input_arguments.telemetryReport)
+        return 0
     #    Define workup common reference data sets
-    #    The ATLAS needs to be copied to the ExperimentBaseDirectoryPrefix
+    #    The ATLAS needs to be staged in the ExperimentBaseDirectoryPrefix
     #    The ATLAS pathing must stay constant
     ATLASPATH=expConfig.get(input_arguments.processingEnvironment,'ATLASPATH')
     if not os.path.exists(ATLASPATH):
         print("ERROR:  Invalid Path for Atlas: {0}".format(ATLASPATH))
         sys.exit(-1)
     CACHE_ATLASPATH=os.path.realpath(os.path.join(ExperimentBaseDirectoryCache,'Atlas'))
-    from distutils.dir_util import copy_tree
-    if not os.path.exists(CACHE_ATLASPATH):
-        print("Copying a reference of the atlas to the experiment cache directory:\n    from: {0}\n    to: {1}".format(ATLASPATH,CACHE_ATLASPATH))
-        copy_tree(ATLASPATH,CACHE_ATLASPATH,preserve_mode=1,preserve_times=1)
+    ## The atlas files are linked, not copied, and a manifest makes later checks a stat of each file.
+    import AtlasStaging
+    ATLAS_TEMPLATE_FILES=['ExtendedAtlasDefinition.xml.in','ExtendedAtlasDefinition.xml']
+    atlasRestaged=AtlasStaging.StageDirectory(ATLASPATH,CACHE_ATLASPATH,excludeNames=ATLAS_TEMPLATE_FILES)
+    CACHE_ATLAS_DEFINITION=os.path.join(CACHE_ATLASPATH,'ExtendedAtlasDefinition.xml')
+    if atlasRestaged or not os.path.exists(CACHE_ATLAS_DEFINITION):
         ## Now generate the xml file with the correct pathing
-        file_replace(os.path.join(ATLASPATH,'ExtendedAtlasDefinition.xml.in'),os.path.join(CACHE_ATLASPATH,'ExtendedAtlasDefinition.xml'),"@ATLAS_DIRECTORY@",CACHE_ATLASPATH)
+        if os.path.lexists(CACHE_ATLAS_DEFINITION):
+            os.remove(CACHE_ATLAS_DEFINITION)
+        file_replace(os.path.join(ATLASPATH,'ExtendedAtlasDefinition.xml.in'),CACHE_ATLAS_DEFINITION,"@ATLAS_DIRECTORY@",CACHE_ATLASPATH)
     else:
         print("Atlas already exists in experiment cache directory: {0}".format(CACHE_ATLASPATH))
-    #  Just to be safe, copy the model file as well
+    #  Just to be safe, stage the model file as well
     BCDMODELPATH=expConfig.get(input_arguments.processingEnvironment,'BCDMODELPATH')
     CACHE_BCDMODELPATH=os.path.join(ExperimentBaseDirectoryCache,os.path.basename(BCDMODELPATH))
-    from distutils.file_util import copy_file
-    for BCDModelFiles in ['LLSModel-2ndVersion.hdf5','T1-2ndVersion.mdl']:
-        orig=os.path.join(BCDMODELPATH,BCDModelFiles)
-        new=os.path.join(CACHE_BCDMODELPATH,BCDModelFiles)
-        if not os.path.exists(CACHE_BCDMODELPATH):
-            os.mkdir(CACHE_BCDMODELPATH)
-        if not os.path.exists(new):
-            print("Copying BCD Model file to cache directory: {0}".format(new))
-            copy_file(  orig, new,preserve_mode=1, preserve_times=1)
-        else:
-            print("BCD Model exists in cache directory: {0}".format(new))
+    if not AtlasStaging.StageDirectory(BCDMODELPATH,CACHE_BCDMODELPATH,fileNames=['LLSModel-2ndVersion.hdf5','T1-2ndVersion.mdl']):
+        print("BCD Model exists in cache directory: {0}".format(CACHE_BCDMODELPATH))
 
 
     CUSTOM_ENVIRONMENT=expConfig.get(input_arguments.processingEnvironment,'CUSTOM_ENVIRONMENT')
@@ -169,6 +233,20 @@ def main(argv=None):
         print "FREESURFER NEEDS TO CHECK FOR SANE ENVIRONMENT HERE."
 
     CLUSTER_QUEUE=expConfig.get(input_arguments.processingEnvironment,'CLUSTER_QUEUE')
+    ## The cross experiment result cache is only used when it is configured.
+    SHARED_RESULT_CACHE=None
+    if expConfig.has_option(input_arguments.processingEnvironment,'SHARED_RESULT_CACHE'):
+        SHARED_RESULT_CACHE=expConfig.get(input_arguments.processingEnvironment,'SHARED_RESULT_CACHE')
+    SHARED_RESULT_CACHE_SIZE_GB=100.0
+    if expConfig.has_option(input_arguments.processingEnvironment,'SHARED_RESULT_CACHE_SIZE_GB'):
+        SHARED_RESULT_CACHE_SIZE_GB=expConfig.getfloat(input_arguments.processingEnvironment,'SHARED_RESULT_CACHE_SIZE_GB')
+    ## Registrations are cached separately, keyed by image content so that reruns and new sessions find them.
+    REGISTRATION_CACHE=None
+    if expConfig.has_option(input_arguments.processingEnvironment,'REGISTRATION_CACHE'):
+        REGISTRATION_CACHE=expConfig.get(input_arguments.processingEnvironment,'REGISTRATION_CACHE')
+    REGISTRATION_CACHE_SIZE_GB=100.0
+    if expConfig.has_option(input_arguments.processingEnvironment,'REGISTRATION_CACHE_SIZE_GB'):
+        REGISTRATION_CACHE_SIZE_GB=expConfig.getfloat(input_arguments.processingEnvironment,'REGISTRATION_CACHE_SIZE_GB')
 
     ## Setup environment for CPU load balancing of ITK based programs.
     import multiprocessing
@@ -183,10 +261,12 @@ def main(argv=None):
         os.environ['NSLOTS']="{0}".format(total_CPUS/4)
     elif input_arguments.wfrun == 'local_12':
         os.environ['NSLOTS']="{0}".format(total_CPUS/12)
+    elif input_arguments.wfrun == 'local_resources':
+        pass ## NSLOTS is set per job by the ResourceLimitedMultiProcPlugin
     elif input_arguments.wfrun == 'local':
         os.environ['NSLOTS']="{0}".format(total_CPUS/1)
     else:
-        print "FAILED RUN: You must specify the run environment type. [helium_all.q,helium_all.q_graph,ipl_OSX,local_4,local_12,local]"
+        print "FAILED RUN: You must specify the run environment type. [helium_all.q,helium_all.q_graph,ipl_OSX,local_4,local_12,local_resources,local]"
         print input_arguments.wfrun
         sys.exit(-1)
 
@@ -197,68 +277,95 @@ def main(argv=None):
     import SessionDB
     subjectDatabaseFile=os.path.join( ExperimentBaseDirectoryCache,'InternalWorkflowSubjectDB.db')
     subject_list=input_arguments.subject.split(',')
-    ExperimentDatabase=SessionDB.SessionDB(subjectDatabaseFile,subject_list)
-    ## TODO:  Only make DB if db is older than subject_data_file.
-    if ( not os.path.exists(subjectDatabaseFile) ) or ( os.path.getmtime(subjectDatabaseFile) < os.path.getmtime(subject_data_file) ):
+    fileValidator=None
+    if input_arguments.validationThreads > 0:
+        import FileValidation
+        fileValidator=FileValidation.FileValidator(os.path.join(ExperimentBaseDirectoryCache,'InternalFileValidationCache.db'),
+                                                   input_arguments.validationThreads)
+    ExperimentDatabase=SessionDB.SessionDB(subjectDatabaseFile,subject_list,fileValidator)
+    if input_arguments.rebuildSessionDB:
         ExperimentDatabase.MakeNewDB(subject_data_file,mountPrefix)
+    elif ExperimentDatabase.NeedsSync(subject_data_file):
+        ## Only the rows that changed since the last run are re-read and re-checked on disk.
+        ExperimentDatabase.SyncDB(subject_data_file,mountPrefix)
     else:
         print("Using cached database, {0}".format(subjectDatabaseFile))
-    print "ENTIRE DB for {_subjid}: ".format(_subjid=ExperimentDatabase.getSubjectFilter())
-    print "^^^^^^^^^^^^^"
-    for row in ExperimentDatabase.getEverything():
-        print row
-    print "^^^^^^^^^^^^^"
+    if input_arguments.verbose:
+        print "ENTIRE DB for {_subjid}: ".format(_subjid=ExperimentDatabase.getSubjectFilter())
+        print "^^^^^^^^^^^^^"
+        for row in ExperimentDatabase.getEverything():
+            print row
+        print "^^^^^^^^^^^^^"
 
     import WorkupT1T2 ## NOTE:  This needs to occur AFTER the PYTHON_AUX_PATHS has been modified
-    for subjectid in ExperimentDatabase.getAllSubjects():
-        baw200=WorkupT1T2.WorkupT1T2(subjectid,mountPrefix,
-          os.path.join(ExperimentBaseDirectoryCache,str(subjectid)),
-          ExperimentBaseDirectoryResults,
-          ExperimentDatabase,
-          CACHE_ATLASPATH,
-          CACHE_BCDMODELPATH,WORKFLOW_COMPONENTS=WORKFLOW_COMPONENTS,CLUSTER_QUEUE=CLUSTER_QUEUE)
-        print "Start Processing"
+    import ResourceProfiles
+    import SharedResultCache
+    import RegistrationCache
+    import PreflightCheck
+    ## The memory reservations are rendered into each node when the workflow is built, so calibrate first.
+    resourceCalibrationFile=os.path.join(ExperimentBaseDirectoryCache,'InternalResourceCalibration.db')
+    ResourceProfiles.CalibrateResourceProfiles(resourceCalibrationFile)
+    ## Create the shell wrapper script for ensuring that all jobs running on remote hosts from SGE
+    #  have the same environment as the job submission host.
+    JOB_SCRIPT=get_global_sge_script(sys.path,PROGRAM_PATHS,CUSTOM_ENVIRONMENT)
+    #print JOB_SCRIPT
 
-        ## Create the shell wrapper script for ensuring that all jobs running on remote hosts from SGE
-        #  have the same environment as the job submission host.
-        JOB_SCRIPT=get_global_sge_script(sys.path,PROGRAM_PATHS,CUSTOM_ENVIRONMENT)
-        #print JOB_SCRIPT
-
-        SGEFlavor='SGE'
-        try:
-            if input_arguments.wfrun == 'helium_all.q':
-                baw200.run(plugin=SGEFlavor,
-                    plugin_args=dict(template=JOB_SCRIPT,qsub_args="-S /bin/bash -pe smp1 2-12 -l mem_free=4000M -o /dev/null -e /dev/null "+CLUSTER_QUEUE))
-            elif input_arguments.wfrun == 'helium_all.q_graph':
-                SGEFlavor='SGEGraph' #Use the SGEGraph processing
-                baw200.run(plugin=SGEFlavor,
-                    plugin_args=dict(template=JOB_SCRIPT,qsub_args="-S /bin/bash -pe smp1 2-12 -l mem_free=4000M -o /dev/null -e /dev/null "+CLUSTER_QUEUE))
-            elif input_arguments.wfrun == 'ipl_OSX':
-                baw200.write_graph()
-                print "Running On ipl_OSX"
-                baw200.run(plugin=SGEFlavor,
-                    plugin_args=dict(template=JOB_SCRIPT,qsub_args="-S /bin/bash -pe smp1 2-12 -l mem_free=4000M -o /dev/null -e /dev/null "+CLUSTER_QUEUE))
-            elif input_arguments.wfrun == 'local_4':
-                baw200.write_graph()
-                print "Running with 4 parallel processes on local machine"
-                baw200.run(plugin='MultiProc', plugin_args={'n_procs' : 4})
-            elif input_arguments.wfrun == 'local_12':
-                baw200.write_graph()
-                print "Running with 12 parallel processes on local machine"
-                baw200.run(plugin='MultiProc', plugin_args={'n_procs' : 12})
-            elif input_arguments.wfrun == 'local':
-                try:
-                    baw200.write_graph()
-                except:
-                    pass
-                print "Running sequentially on local machine"
-                baw200.run()
-            else:
-                print "You must specify the run environment type. [helium_all.q,helium_all.q_graph,ipl_OSX,local_4,local_12,local]"
-                print input_arguments.wfrun
-                sys.exit(-1)
-        except:
-            pass
+    allSubjects=ExperimentDatabase.getAllSubjects()
+    dryRunResults=list()
+    if input_arguments.subjectsPerGraph == 1:
+        for subjectid in allSubjects:
+            baw200=WorkupT1T2.WorkupT1T2(subjectid,mountPrefix,
+              os.path.join(ExperimentBaseDirectoryCache,str(subjectid)),
+              ExperimentBaseDirectoryResults,
+              ExperimentDatabase,
+              CACHE_ATLASPATH,
+              CACHE_BCDMODELPATH,WORKFLOW_COMPONENTS=WORKFLOW_COMPONENTS,CLUSTER_QUEUE=CLUSTER_QUEUE)
+            if REGISTRATION_CACHE is not None:
+                RegistrationCache.EnableRegistrationCache(baw200,REGISTRATION_CACHE,REGISTRATION_CACHE_SIZE_GB)
+            if SHARED_RESULT_CACHE is not None:
+                SharedResultCache.EnableSharedResultCache(baw200,SHARED_RESULT_CACHE,SHARED_RESULT_CACHE_SIZE_GB)
+            if input_arguments.dryRun:
+                dryRunResults.append(PreflightCheck.DryRunWorkflow(baw200,telemetryFile))
+                continue
+            print "Start Processing"
+            RunWorkflow(baw200,input_arguments.wfrun,JOB_SCRIPT,CLUSTER_QUEUE,resourceCalibrationFile,
+              telemetryFile,{baw200.name:subjectid})
+    else:
+        ## Several subjects share one graph so that independent subjects fill idle slots.
+        #  Subjects are run in groups of subjectsPerGraph to bound memory and scratch disk use.
+        subjectsPerGraph=input_arguments.subjectsPerGraph
+        if subjectsPerGraph < 1:
+            subjectsPerGraph=len(allSubjects)
+        for firstSubject in range(0,len(allSubjects),subjectsPerGraph):
+            subjectGroup=allSubjects[firstSubject:firstSubject+subjectsPerGraph]
+            subjectWorkflowList=list()
+            for subjectid in subjectGroup:
+                subjectWorkflowList.append(WorkupT1T2.WorkupT1T2(subjectid,mountPrefix,
+                  ExperimentBaseDirectoryCache,
+                  ExperimentBaseDirectoryResults,
+                  ExperimentDatabase,
+                  CACHE_ATLASPATH,
+                  CACHE_BCDMODELPATH,WORKFLOW_COMPONENTS=WORKFLOW_COMPONENTS,CLUSTER_QUEUE=CLUSTER_QUEUE,
+                  WorkflowName="BAW_20120813_"+str(subjectid)))
+            baw200=WorkupT1T2.MakeMultiSubjectWorkflow(subjectWorkflowList,ExperimentBaseDirectoryCache)
+            if REGISTRATION_CACHE is not None:
+                RegistrationCache.EnableRegistrationCache(baw200,REGISTRATION_CACHE,REGISTRATION_CACHE_SIZE_GB)
+            if SHARED_RESULT_CACHE is not None:
+                SharedResultCache.EnableSharedResultCache(baw200,SHARED_RESULT_CACHE,SHARED_RESULT_CACHE_SIZE_GB)
+            if input_arguments.dryRun:
+                dryRunResults.append(PreflightCheck.DryRunWorkflow(baw200,telemetryFile))
+                continue
+            print "Start Processing subjects: {0}".format(subjectGroup)
+            RunWorkflow(baw200,input_arguments.wfrun,JOB_SCRIPT,CLUSTER_QUEUE,resourceCalibrationFile,
+              telemetryFile,dict([ (subjectWorkflow.name,subjectid) for subjectWorkflow,subjectid in zip(subjectWorkflowList,subjectGroup) ]))
+    if input_arguments.dryRun:
+        ## The graphs are run one after another, so their critical paths add up.
+        errorCount=sum([ len(errors) for errors,estimate in dryRunResults ])
+        print("Dry run of {0} graphs: {1} problems".format(len(dryRunResults),errorCount))
+        PreflightCheck.PrintCostEstimate(PreflightCheck.CombineEstimates([ estimate for errors,estimate in dryRunResults ]))
+        if errorCount > 0:
+            return 1
+        return 0
 
 if __name__ == "__main__":
     sys.exit(main())